@@ -3,7 +3,9 @@
 Compare the count of events in a window to percentiles of counts in prior windows.
 """
 
-from typing import List, Optional
+from typing import List, Optional, Sequence, Union
+
+import fire
 
 from runners.helpers import db
 from runners.helpers.dbconfig import WAREHOUSE
@@ -50,28 +52,34 @@ CREATE OR REPLACE TABLE {base_table}_counts (
 ;
 """
 
+# hours before the latest counted slice which are counted again, for events
+# landing in the base table late
+LATENESS_HOURS = 3
+
+HISTORY_START_SQL = "DATEADD(HOUR, -{days}*24, DATE_TRUNC(HOUR, CURRENT_TIMESTAMP))"
+
+# since the latest counted slice, less LATENESS_HOURS, or the start of the
+# history window when nothing was counted yet
+COUNT_HOURLY_SINCE_SQL = """(
+      SELECT DATEADD(HOUR, -{lateness_hours}, IFNULL(MAX(slice_start), {history_start}))
+      FROM {base_table}_counts
+    )"""
+
 COUNT_HOURLY_MERGE_SQL = """
 MERGE INTO {base_table}_counts stored
 USING (
-  -- calculate sums
+  -- calculate sums in the complete hours to count
   SELECT COUNT(*) n
-       , slice_start
-       , slice_end
+       , DATE_TRUNC(HOUR, event_time) slice_start
+       , DATEADD(HOUR, 1, slice_start) slice_end
        , groups
   FROM (
-    -- make the slices
-    SELECT slice_start, slice_end
-    FROM TABLE(data.TIME_SLICES_BEFORE_T(
-      {days}*24, 60*60, DATE_TRUNC(HOUR, CURRENT_TIMESTAMP)
-    ))
-  ) t
-  JOIN (
-    -- calculate sums in those slices
     SELECT event_time
          , {groups} AS groups
     FROM {base_table}
-  ) c
-  ON c.event_time BETWEEN t.slice_start AND t.slice_end
+    WHERE event_time >= {since}
+      AND event_time < DATE_TRUNC(HOUR, CURRENT_TIMESTAMP)
+  )
   GROUP BY slice_start, slice_end, groups
 ) calcd
 ON (
@@ -79,6 +87,7 @@ ON (
   AND stored.slice_start = calcd.slice_start
   AND stored.slice_end = calcd.slice_end
 )
+WHEN MATCHED AND stored.n <> calcd.n THEN UPDATE SET n = calcd.n
 WHEN NOT MATCHED THEN INSERT (
   slice_start,
   slice_end,
@@ -98,9 +107,32 @@ CREATE OR REPLACE TASK {{base_table}}_count
   SCHEDULE='USING CRON 0 * * * * UTC'
   WAREHOUSE={WAREHOUSE}
 AS
-{COUNT_HOURLY_MERGE_SQL}
+{{merge}}
 """
 
+
+def count_hourly_merge_sql(
+    base_table: str, groups: Optional[List[str]], days: int, rebuild: bool = False
+) -> str:
+    """merges counts of the hours since the latest counted, or of every hour in
+    the history window, to rebuild
+    """
+    history_start = HISTORY_START_SQL.format(days=days)
+    return COUNT_HOURLY_MERGE_SQL.format(
+        base_table=base_table,
+        groups=db.dict_to_sql({g: g for g in groups or []}, indent=11),
+        since=(
+            history_start
+            if rebuild
+            else COUNT_HOURLY_SINCE_SQL.format(
+                base_table=base_table,
+                lateness_hours=LATENESS_HOURS,
+                history_start=history_start,
+            )
+        ),
+    )
+
+
 BASIC_BASELINE_VIEW = """
 CREATE OR REPLACE VIEW {base_table}_pct_baseline AS
 SELECT * FROM (
@@ -251,8 +283,7 @@ def generate_baseline_sql(
         COUNT_HOURLY_TABLE_SQL.format(base_table=base_table),
         COUNT_HOURLY_TASK_SQL.format(
             base_table=base_table,
-            groups=db.dict_to_sql({g: g for g in groups or []}, indent=11),
-            days=days,
+            merge=count_hourly_merge_sql(base_table, groups, days),
         ),
         f'ALTER TASK {base_table}_count RESUME',
         BASIC_BASELINE_VIEW_NO_ZEROS.format(base_table=base_table, days=days)
@@ -267,13 +298,41 @@ def generate_baseline_sql(
     ]
 
 
+def group_names(groups: Union[str, Sequence[str]]) -> List[str]:
+    """group columns from a comma-separated string, or from a sequence, which
+    is how Fire passes --groups=a,b
+    """
+    names = groups.split(',') if isinstance(groups, str) else groups
+    return list(filter(None, [str(g).strip() for g in names]))
+
+
 def create(options):
     base_table = options['base_table']
-    groups = list(
-        filter(None, [g.strip() for g in options.get('groups', '').split(',')])
-    )
+    groups = group_names(options.get('groups', ''))
     days = int(options.get('history_size_days', '30'))
     return [
         next(db.fetch(sql, fix_errors=False), {}).get('status')
         for sql in generate_baseline_sql(base_table, groups, days)
     ]
+
+
+def rebuild_counts(
+    base_table: str, groups: Union[str, Sequence[str]] = '', days: int = 30
+):
+    """recounts every hour in the history window of a percentiles baseline,
+    with the groups it was created with, e.g.
+
+    python -m baselines.percentiles rebuild --base_table=data.x --groups=a,b --days=90
+    """
+    group_list = group_names(groups)
+    return [
+        next(db.fetch(sql, fix_errors=False), {'status': None}).get('status')
+        for sql in [
+            COUNT_HOURLY_TABLE_SQL.format(base_table=base_table),
+            count_hourly_merge_sql(base_table, group_list, days, rebuild=True),
+        ]
+    ]
+
+
+if __name__ == '__main__':
+    fire.Fire({'rebuild': rebuild_counts})
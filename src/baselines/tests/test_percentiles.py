@@ -0,0 +1,30 @@
+import fire
+
+from baselines import percentiles
+
+
+def test_rebuild_counts_groups(monkeypatch):
+    queries = []
+
+    def fetch(sql, fix_errors=True):
+        queries.append(sql)
+        return iter([{'status': 'ok'}])
+
+    monkeypatch.setattr(percentiles.db, 'fetch', fetch)
+
+    for groups in ['a, b', ('a', 'b')]:
+        queries.clear()
+        assert percentiles.rebuild_counts('data.x', groups, 90) == ['ok', 'ok']
+        create_table, merge = queries
+        assert 'data.x_counts' in create_table
+        assert merge == percentiles.count_hourly_merge_sql(
+            'data.x', ['a', 'b'], 90, rebuild=True
+        )
+        assert "'a', a" in merge and "'b', b" in merge
+
+    queries.clear()
+    fire.Fire(
+        {'rebuild': percentiles.rebuild_counts},
+        ['rebuild', '--base_table=data.x', '--groups=a,b', '--days=90'],
+    )
+    assert queries[1] == merge
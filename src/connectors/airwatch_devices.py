@@ -8,9 +8,7 @@ from runners.helpers.dbconfig import ROLE as SA_ROLE
 
 from datetime import datetime
 
-import requests
-from urllib.error import HTTPError
-from .utils import yaml_dump
+from .utils import InsertSink, PageNumbers, get_pages, http_session, yaml_dump
 
 PAGE_SIZE = 500
 
@@ -115,22 +113,90 @@ LANDING_TABLE_COLUMNS_CUSTOM_ATTRIBUTES = [
 ]
 
 
-def get_data(url: str, cms_auth: str, api_key: str, params: dict = {}) -> dict:
-    headers: dict = {
-        'Content-Type': 'application/json',
-        'aw-tenant-code': api_key,
-        'Accept': 'application/json',
-        'Authorization': cms_auth,
-    }
-    try:
-        log.debug(f"Preparing GET: url={url} with params={params}")
-        req = requests.get(url, params=params, headers=headers)
-        req.raise_for_status()
-    except HTTPError as http_err:
-        log.error(f"Error GET: url={url}")
-        log.error(f"HTTP error occurred: {http_err}")
-        raise
-    return req.json()
+def get_pages_airwatch(url: str, cms_auth: str, api_key: str):
+    session = http_session(
+        headers={
+            'Content-Type': 'application/json',
+            'aw-tenant-code': api_key,
+            'Accept': 'application/json',
+            'Authorization': cms_auth,
+        }
+    )
+    pagination = PageNumbers(
+        PAGE_SIZE,
+        total=lambda result: result['Total'],
+        page_param='Page',
+        size_param='PageSize',
+        start=0,
+    )
+    return get_pages(session, url, pagination=pagination)
+
+
+def device_row(timestamp, device):
+    return (
+        timestamp,
+        device,
+        device.get('EasIds'),
+        device.get('Udid'),
+        device.get('SerialNumber'),
+        device.get('MacAddress'),
+        device.get('Imei'),
+        device.get('EasId'),
+        device.get('AssetNumber'),
+        device.get('DeviceFriendlyName'),
+        device.get('LocationGroupId'),
+        device.get('LocationGroupName'),
+        device.get('UserId'),
+        device.get('UserName'),
+        device.get('DataProtectionStatus'),
+        device.get('UserEmailAddress'),
+        device.get('Ownership'),
+        device.get('PlatformId'),
+        device.get('Platform'),
+        device.get('ModelId'),
+        device.get('Model'),
+        device.get('OperatingSystem'),
+        device.get('PhoneNumber'),
+        device.get('LastSeen'),
+        device.get('EnrollmentStatus'),
+        device.get('ComplianceStatus'),
+        device.get('CompromisedStatus'),
+        device.get('LastEnrolledOn'),
+        device.get('LastComplianceCheckOn'),
+        device.get('LastCompromisedCheckOn'),
+        device.get('IsSupervised'),
+        device.get('VirtualMemory'),
+        device.get('DeviceCapacity'),
+        device.get('AvailableDeviceCapacity'),
+        device.get('IsDeviceDNDEnabled'),
+        device.get('IsDeviceLocatorEnabled'),
+        device.get('IsCloudBackupEnabled'),
+        device.get('IsActivationLockEnabled'),
+        device.get('IsNetworkTethered'),
+        device.get('BatteryLevel'),
+        device.get('IsRoaming'),
+        device.get('SystemIntegrityProtectionEnabled'),
+        device.get('ProcessorArchitecture'),
+        device.get('TotalPhysicalMemory'),
+        device.get('AvailablePhysicalMemory'),
+        device.get('DeviceCellularNetworkInfo'),
+        device.get('EnrollmentUserUuid'),
+        device.get('Id'),
+        device.get('Uuid'),
+    )
+
+
+def custom_attributes_row(timestamp, device_attr):
+    return (
+        timestamp,
+        device_attr,
+        device_attr.get('DeviceId'),
+        device_attr.get('Udid'),
+        device_attr.get('SerialNumber'),
+        device_attr.get('EnrollmentUserName'),
+        device_attr.get('AssetNumber'),
+        device_attr.get('CustomAttributes'),
+    )
 
 
 def connect(connection_name, options):
@@ -170,123 +236,30 @@ def ingest(table_name, options):
     landing_table = f'data.{table_name}'
 
     if ingest_type == 'device':
-
-        device_params: dict = {'PageSize': PAGE_SIZE, 'Page': 0}
         url = f'https://{host_airwatch}/api/mdm/devices/search'
-
-        while 1:
-            result: dict = get_data(url, device_auth, api_key, device_params)
-
-            devices = result['Devices']
-
-            db.insert(
-                landing_table,
-                values=[
-                    (
-                        timestamp,
-                        device,
-                        device.get('EasIds'),
-                        device.get('Udid'),
-                        device.get('SerialNumber'),
-                        device.get('MacAddress'),
-                        device.get('Imei'),
-                        device.get('EasId'),
-                        device.get('AssetNumber'),
-                        device.get('DeviceFriendlyName'),
-                        device.get('LocationGroupId'),
-                        device.get('LocationGroupName'),
-                        device.get('UserId'),
-                        device.get('UserName'),
-                        device.get('DataProtectionStatus'),
-                        device.get('UserEmailAddress'),
-                        device.get('Ownership'),
-                        device.get('PlatformId'),
-                        device.get('Platform'),
-                        device.get('ModelId'),
-                        device.get('Model'),
-                        device.get('OperatingSystem'),
-                        device.get('PhoneNumber'),
-                        device.get('LastSeen'),
-                        device.get('EnrollmentStatus'),
-                        device.get('ComplianceStatus'),
-                        device.get('CompromisedStatus'),
-                        device.get('LastEnrolledOn'),
-                        device.get('LastComplianceCheckOn'),
-                        device.get('LastCompromisedCheckOn'),
-                        device.get('IsSupervised'),
-                        device.get('VirtualMemory'),
-                        device.get('DeviceCapacity'),
-                        device.get('AvailableDeviceCapacity'),
-                        device.get('IsDeviceDNDEnabled'),
-                        device.get('IsDeviceLocatorEnabled'),
-                        device.get('IsCloudBackupEnabled'),
-                        device.get('IsActivationLockEnabled'),
-                        device.get('IsNetworkTethered'),
-                        device.get('BatteryLevel'),
-                        device.get('IsRoaming'),
-                        device.get('SystemIntegrityProtectionEnabled'),
-                        device.get('ProcessorArchitecture'),
-                        device.get('TotalPhysicalMemory'),
-                        device.get('AvailablePhysicalMemory'),
-                        device.get('DeviceCellularNetworkInfo'),
-                        device.get('EnrollmentUserUuid'),
-                        device.get('Id'),
-                        device.get('Uuid'),
-                    )
-                    for device in devices
-                ],
-                select=db.derive_insert_select(LANDING_TABLE_COLUMNS_DEVICE),
-                columns=db.derive_insert_columns(LANDING_TABLE_COLUMNS_DEVICE),
-            )
-
-            log.info(f'Inserted {len(devices)} rows ({landing_table}).')
-
-            yield len(devices)
-
-            processed_total = (result['Page'] + 1) * result['PageSize']
-            if processed_total >= result['Total']:
-                break
-
-            device_params['Page'] += 1
+        cols = LANDING_TABLE_COLUMNS_DEVICE
+        pages = get_pages_airwatch(url, device_auth, api_key)
+        row = device_row
 
     else:
-        custom_device_params: dict = {'PageSize': PAGE_SIZE, 'Page': 0}
         url = f'https://{host_airwatch}/api/mdm/devices/customattribute/search'
+        cols = LANDING_TABLE_COLUMNS_CUSTOM_ATTRIBUTES
+        pages = get_pages_airwatch(url, custom_attributes_auth, api_key)
+        row = custom_attributes_row
+
+    sink = InsertSink(
+        lambda table, values: db.insert(
+            table,
+            values=values,
+            select=db.derive_insert_select(cols),
+            columns=db.derive_insert_columns(cols),
+        )
+    )
 
-        while 1:
-            result: dict = get_data(
-                url, custom_attributes_auth, api_key, custom_device_params
-            )
-
-            device_attributes = result['Devices']
-
-            db.insert(
-                landing_table,
-                values=[
-                    (
-                        timestamp,
-                        device_attr,
-                        device_attr.get('DeviceId'),
-                        device_attr.get('Udid'),
-                        device_attr.get('SerialNumber'),
-                        device_attr.get('EnrollmentUserName'),
-                        device_attr.get('AssetNumber'),
-                        device_attr.get('CustomAttributes'),
-                    )
-                    for device_attr in device_attributes
-                ],
-                select=db.derive_insert_select(LANDING_TABLE_COLUMNS_CUSTOM_ATTRIBUTES),
-                columns=db.derive_insert_columns(
-                    LANDING_TABLE_COLUMNS_CUSTOM_ATTRIBUTES
-                ),
-            )
-
-            log.info(f'Inserted {len(device_attributes)} rows ({landing_table}).')
-
-            yield len(device_attributes)
-
-            processed_total = (result['Page'] + 1) * result['PageSize']
-            if processed_total >= result['Total']:
-                break
+    with sink:
+        for result in pages:
+            for device in result['Devices']:
+                sink.add(landing_table, row(timestamp, device))
 
-            custom_device_params['Page'] += 1
+    log.info(f'Inserted {sink.num_inserted} rows ({landing_table}).')
+    yield sink.num_inserted
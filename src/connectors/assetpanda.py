@@ -5,14 +5,12 @@ Collect asset information from Asset Panda using an API token
 from datetime import datetime
 from functools import reduce
 import re
-import requests
 from typing import Tuple
-from urllib.error import HTTPError
 
 from runners.helpers import db, log
 from runners.helpers.dbconfig import ROLE as SA_ROLE
 
-from .utils import yaml_dump
+from .utils import InsertSink, OffsetPages, get_json, get_pages, http_session, yaml_dump
 
 # 50 is the max page size supported by the AssetPanda API for this endpoint currently.
 PAGE_SIZE = 50
@@ -100,19 +98,8 @@ def replace_device_key(list_device: list, replace_key: dict):
 ###
 
 
-def get_data(token: str, url: str, params: dict = {}) -> dict:
-    headers: dict = {"Authorization": f"Bearer {token}"}
-    try:
-        log.debug(f"Preparing GET: url={url} with params={params}")
-        req = requests.get(url, params=params, headers=headers)
-        req.raise_for_status()
-    except HTTPError as http_err:
-        log.error(f"Error GET: url={url}")
-        log.error(f"HTTP error occurred: {http_err}")
-        raise http_err
-    log.debug(req.status_code)
-
-    return req.json()
+def asset_row(entry, insert_time):
+    return (entry, entry.get('id', None), insert_time)
 
 
 def connect(connection_name, options):
@@ -141,46 +128,38 @@ def ingest(table_name, options):
     )
     fields_url = f"https://api.assetpanda.com:443//v2/entities/{asset_entity_id}"
 
-    params = {"offset": 0, "limit": PAGE_SIZE}
-
-    total_object_count = 0
-
     insert_time = datetime.utcnow()
 
-    while params['offset'] <= total_object_count:
-
-        log.debug("total_object_count: ", total_object_count)
-
-        assets = get_data(token=token, url=general_url, params=params)
+    session = http_session(headers={"Authorization": f"Bearer {token}"})
 
-        list_object, total_object_count = get_list_objects_and_total_from_get_object(
-            assets
-        )
-
-        dict_fields = get_data(token, fields_url, params=params)
-        list_field = dict_fields["fields"]
+    dict_fields = get_json(session, fields_url)
+    list_field = dict_fields["fields"]
 
-        # Stripping down the metadata to remove unnecessary fields. We only really care about the following:
-        # {"field_140": "MAC_Address", "field_135" :"IP"}
-        clear_fields: dict = reduce(reduce_fields, list_field, {})
+    # Stripping down the metadata to remove unnecessary fields. We only really care about the following:
+    # {"field_140": "MAC_Address", "field_135" :"IP"}
+    clear_fields: dict = reduce(reduce_fields, list_field, {})
 
-        # replace every key "field_NO" by the value of the clear_field["field_NO"]
-        list_object_without_field_id = replace_device_key(list_object, clear_fields)
+    pages = OffsetPages(PAGE_SIZE, total=lambda page: page["totals"]["objects"])
 
-        db.insert(
-            landing_table,
-            values=[
-                (entry, entry.get('id', None), insert_time)
-                for entry in list_object_without_field_id
-            ],
+    sink = InsertSink(
+        lambda table, values: db.insert(
+            table,
+            values=values,
             select=db.derive_insert_select(LANDING_TABLE_COLUMNS),
             columns=db.derive_insert_columns(LANDING_TABLE_COLUMNS),
         )
+    )
 
-        log.info(
-            f'Inserted {len(list_object_without_field_id)} rows ({landing_table}).'
-        )
-        yield len(list_object_without_field_id)
+    with sink:
+        for assets in get_pages(session, general_url, pagination=pages):
+            list_object, total = get_list_objects_and_total_from_get_object(assets)
+            log.debug("total_object_count: ", total)
+
+            # replace every key "field_NO" by the value of the clear_field["field_NO"]
+            list_object_without_field_id = replace_device_key(list_object, clear_fields)
+
+            for entry in list_object_without_field_id:
+                sink.add(landing_table, asset_row(entry, insert_time))
 
-        # increment the offset to get new entries each iteration in the while loop
-        params["offset"] += PAGE_SIZE
+    log.info(f'Inserted {sink.num_inserted} rows ({landing_table}).')
+    yield sink.num_inserted
@@ -3,6 +3,7 @@ Load inventory from accounts in your Org via API using auditor Roles
 """
 
 import asyncio
+from botocore.config import Config
 from botocore.exceptions import (
     # BotoCoreError,
     ClientError,
@@ -11,17 +12,27 @@ from botocore.exceptions import (
 from aiohttp.client_exceptions import ServerTimeoutError
 from collections import defaultdict, namedtuple
 import csv
-from datetime import datetime, timedelta
+from datetime import datetime
 from dateutil.parser import parse as parse_date
+import hashlib
 import json
 import fire
 import io
-from typing import Tuple, AsyncGenerator, Dict
+from typing import Tuple, AsyncGenerator, DefaultDict, Dict, List, Set
 
+from runners.config import RUN_ID
 from runners.helpers.dbconfig import ROLE as SA_ROLE
-from runners.utils import format_exception_only, format_exception
-
-from connectors.utils import aio_sts_assume_role, updated, yaml_dump, bytes_to_str
+from runners.utils import format_exception_only, format_exception, json_dumps
+
+from connectors.utils import (
+    aio_sts_assume_role,
+    updated,
+    yaml_dump,
+    bytes_to_str,
+    KeyedTokenBuckets,
+    AioInsertSink,
+    InsertSink,
+)
 from runners.helpers import db, log
 
 
@@ -29,11 +40,31 @@ AUDIT_ASSUMER_ARN = 'arn:aws:iam::111111111111:role/security-auditor'
 AUDIT_READER_ROLE = 'audit-reader'
 READER_EID = ''
 
-_SESSION_CACHE: dict = {}
+# requests are paced by a (rate/s, capacity) token bucket per (account, region,
+# service), halving the rate when AWS throttles and slowly growing it back, see
+# https://docs.aws.amazon.com/AWSEC2/latest/APIReference/throttling.html#throttling-limits
+_REQUEST_RATE_LIMITS = KeyedTokenBuckets(
+    default=(10, 50),
+    limits={'ec2': (20, 100), 'iam': (10, 20), 'organizations': (1, 5)},
+    key_prefix=lambda key: key[2],
+)
+_THROTTLING_ERROR_CODES = {
+    'Throttling',
+    'ThrottlingException',
+    'ThrottledException',
+    'RequestThrottled',
+    'RequestLimitExceeded',
+    'TooManyRequestsException',
+    'SlowDown',
+}
+_THROTTLING_RETRIES = 5
+_NUM_WORKERS = 200  # tasks in flight, each waits on its own key's bucket
 
-# see https://docs.aws.amazon.com/AWSEC2/latest/APIReference/throttling.html#throttling-limits
-_REQUEST_PACE_PER_SECOND = 24  # depletes Throttling bucket of 100 at 4/s in 25s
-_REQUEST_BATCH_SIZE = 600  # 100 in Throttling bucket + 500 replenished over 25s
+# clients live for the whole run, keeping their connections alive across tasks
+_CLIENT_CONFIG = Config(max_pool_connections=25)
+_CLIENTS: Dict[tuple, tuple] = {}  # (account, region, service) -> (session, client)
+_STALE_CLIENTS: List[asyncio.Future] = []  # clients of expired sessions
+_REGION_NAMES: Dict[tuple, asyncio.Future] = {}  # (account, service) -> regions
 
 CONNECTION_OPTIONS = [
     {
@@ -67,6 +98,18 @@ CONNECTION_OPTIONS = [
         'prompt': "External Id on the roles that need assuming",
         'secret': True,
     },
+    {
+        'type': 'select',
+        'options': [
+            {'value': 'full', 'label': "Full snapshot on every run"},
+            {'value': 'differential', 'label': "Only new, changed, and deleted"},
+        ],
+        'default': 'full',
+        'name': 'snapshot_mode',
+        'title': "Snapshot Mode",
+        'prompt': "Differential mode records unchanged entities in a hash table, "
+        "and the full snapshot is in the data.aws_collect_*_current views",
+    },
 ]
 
 CollectTask = namedtuple('CollectTask', ['account_id', 'method', 'args'])
@@ -92,6 +135,44 @@ LANDING_TABLE_COLUMNS = [
     ('joined_timestamp', 'TIMESTAMP_NTZ'),
 ]
 
+# in differential snapshot mode, every run records the hash of every entity it
+# saw here, while landing tables only get entities whose hash is new
+SNAPSHOT_HASHES_TABLE = 'data.aws_collect_snapshot_hashes'
+SNAPSHOT_HASHES_TABLE_COLUMNS = [
+    ('recorded_at', 'TIMESTAMP_LTZ'),
+    ('run_id', 'STRING'),
+    ('table_name', 'STRING'),
+    ('account_id', 'STRING'),
+    ('entity_hash', 'STRING'),
+    ('change', 'STRING'),  # new, present, or deleted
+]
+
+# hashes of each (table, account) as of the last run that collected it, up to
+# SNAPSHOT_HASHES_MAX_AGE ago; ones collected before that are landed in full
+SNAPSHOT_HASHES_MAX_AGE = '7 days'
+LATEST_SNAPSHOT_HASHES_SQL = f'''
+SELECT table_name, account_id, entity_hash
+FROM (
+  SELECT *
+  FROM {SNAPSHOT_HASHES_TABLE}
+  WHERE recorded_at > CURRENT_TIMESTAMP - INTERVAL '{SNAPSHOT_HASHES_MAX_AGE}'
+  QUALIFY run_id = FIRST_VALUE(run_id) OVER (
+    PARTITION BY table_name, account_id ORDER BY recorded_at DESC
+  )
+)
+WHERE change <> 'deleted'
+'''
+
+CURRENT_SNAPSHOT_VIEW_SQL = f'''
+CREATE OR REPLACE VIEW data.aws_collect_{{table_postfix}}_current COPY GRANTS AS
+SELECT t.*
+FROM data.aws_collect_{{table_postfix}} t
+JOIN ({LATEST_SNAPSHOT_HASHES_SQL}) h
+ON h.table_name = '{{table_postfix}}'
+  AND t.entity_hash = h.entity_hash
+QUALIFY ROW_NUMBER() OVER (PARTITION BY t.entity_hash ORDER BY t.recorded_at DESC) = 1
+'''
+
 SUPPLEMENTARY_TABLES = {
     # https://docs.aws.amazon.com/cli/latest/reference/iam/generate-credential-report.html#output
     'iam_generate_credential_report': [
@@ -1129,6 +1210,7 @@ def connect(connection_name, options):
         audit_reader_role=audit_reader_role,
         reader_eid=reader_eid,
         collect_apis='all',
+        snapshot_mode=options.get('snapshot_mode', 'full'),
     )
 
     db.create_table(name=landing_table, cols=LANDING_TABLE_COLUMNS, comment=comment)
@@ -1136,7 +1218,7 @@ def connect(connection_name, options):
 
     for table_postfix, cols in SUPPLEMENTARY_TABLES.items():
         supp_table = f'data.{table_prefix}_{table_postfix}'
-        db.create_table(name=supp_table, cols=cols)
+        db.create_table(name=supp_table, cols=cols + [('entity_hash', 'STRING')])
         db.execute(f'GRANT INSERT, SELECT ON {supp_table} TO ROLE {SA_ROLE}')
 
     return {
@@ -1229,26 +1311,110 @@ def process_aws_response(task, page):
                 yield CollectTask(task.account_id, method, args)
 
 
-async def load_task_response(client, task):
+def is_throttling_error(e):
+    return (
+        isinstance(e, ClientError)
+        and e.response.get('Error', {}).get('Code') in _THROTTLING_ERROR_CODES
+    )
+
+
+async def load_pages(client, method_name, args, bucket=None):
+    if client.can_paginate(method_name):
+        pages = client.get_paginator(method_name).paginate(**args).__aiter__()
+        while True:
+            if bucket:
+                await bucket.acquire()
+            try:
+                page = await pages.__anext__()
+            except StopAsyncIteration:
+                return
+            yield page
+    else:
+        if bucket:
+            await bucket.acquire()
+        yield await getattr(client, method_name)(**args)
+
+
+async def load_task_response(client, task, bucket=None):
     args = task.args or {}
 
     client_name, method_name = task.method.split('.', 1)
 
-    try:
-        if client.can_paginate(method_name):
-            async for page in client.get_paginator(method_name).paginate(**args):
+    for attempt in range(_THROTTLING_RETRIES + 1):
+        num_pages = 0
+        try:
+            async for page in load_pages(client, method_name, args, bucket):
+                num_pages += 1
+                if bucket:
+                    bucket.succeeded()
                 for x in process_aws_response(task, page):
                     yield x
-        else:
-            for x in process_aws_response(
-                task, await getattr(client, method_name)(**args)
-            ):
+            return
+
+        except (ClientError, DataNotFoundError, ServerTimeoutError) as e:
+            if bucket and is_throttling_error(e):
+                bucket.throttled()
+                # pages already yielded can't be taken back, so only retry
+                # requests which were throttled before producing any rows
+                if num_pages == 0 and attempt < _THROTTLING_RETRIES:
+                    log.info(f'throttled {task.method}, now at {bucket.rate:.2f}/s')
+                    continue
+
+            log.info(format_exception_only(e))
+            for x in process_aws_response(task, e):
                 yield x
+            return
 
-    except (ClientError, DataNotFoundError, ServerTimeoutError) as e:
-        log.info(format_exception_only(e))
-        for x in process_aws_response(task, e):
-            yield x
+
+def failed(future):
+    return future.done() and future.exception() is not None
+
+
+async def get_client(session, account_id, region_name, client_name):
+    key = (account_id, region_name, client_name)
+    cached_session, client = _CLIENTS.get(key, (None, None))
+    if cached_session is not session or failed(client):
+        if client and not failed(client):
+            _STALE_CLIENTS.append(client)
+        client = asyncio.ensure_future(
+            session.client(
+                client_name, region_name=region_name, config=_CLIENT_CONFIG
+            ).__aenter__()
+        )
+        _CLIENTS[key] = (session, client)
+    return await asyncio.shield(client)
+
+
+async def close_clients():
+    clients = _STALE_CLIENTS + [client for session, client in _CLIENTS.values()]
+    _STALE_CLIENTS.clear()
+    _CLIENTS.clear()
+    _REGION_NAMES.clear()
+    for client in clients:
+        if client.done() and not failed(client):
+            await client.result().close()
+
+
+async def load_region_names(session, account_id, client_name):
+    client = await get_client(session, account_id, None, client_name)
+    if not hasattr(client, 'describe_regions'):
+        return None
+    await _REQUEST_RATE_LIMITS[(account_id, None, client_name)].acquire()
+    response = await client.describe_regions()
+    return [region['RegionName'] for region in response['Regions']]
+
+
+async def get_region_names(session, task):
+    client_name, method_name = task.method.split('.', 1)
+    key = (task.account_id, client_name)
+    region_names = _REGION_NAMES.get(key)
+    if region_names is None or failed(region_names):
+        region_names = _REGION_NAMES[key] = asyncio.ensure_future(
+            load_region_names(session, task.account_id, client_name)
+        )
+    return await asyncio.shield(region_names) or API_METHOD_SPECS[task.method].get(
+        'regions', [None]
+    )
 
 
 async def process_task(task, add_task) -> AsyncGenerator[Tuple[str, dict], None]:
@@ -1258,39 +1424,24 @@ async def process_task(task, add_task) -> AsyncGenerator[Tuple[str, dict], None]
     client_name, method_name = task.method.split('.', 1)
 
     try:
-        now = datetime.utcnow()
-        expires = (
-            _SESSION_CACHE.get('account_arn', {})
-            .get('Credentials', {})
-            .get('Expiration')
-        )
-        session = _SESSION_CACHE[account_arn] = (
-            _SESSION_CACHE[account_arn]
-            if expires and expires > now + timedelta(minutes=5)
-            else await aio_sts_assume_role(
-                src_role_arn=AUDIT_ASSUMER_ARN,
-                dest_role_arn=account_arn,
-                dest_external_id=READER_EID,
-            )
+        # cached per role and refreshed ahead of expiry, see connectors.utils
+        session = await aio_sts_assume_role(
+            src_role_arn=AUDIT_ASSUMER_ARN,
+            dest_role_arn=account_arn,
+            dest_external_id=READER_EID,
         )
-        async with session.client(client_name) as client:
-            if hasattr(client, 'describe_regions'):
-                response = await client.describe_regions()
-                region_names = [region['RegionName'] for region in response['Regions']]
-            else:
-                region_names = API_METHOD_SPECS[task.method].get('regions', [None])
-
-        for rn in region_names:
-            async with session.client(client_name, region_name=rn) as client:
-                async for response in load_task_response(client, task):
-                    if type(response) is DBEntry:
-                        if rn is not None:
-                            response.entity['region'] = rn
-                        yield (task.method, response.entity)
-                    elif type(response) is CollectTask:
-                        add_task(response)
-                    else:
-                        log.info('log response', response)
+        for rn in await get_region_names(session, task):
+            bucket = _REQUEST_RATE_LIMITS[(task.account_id, rn, client_name)]
+            client = await get_client(session, task.account_id, rn, client_name)
+            async for response in load_task_response(client, task, bucket):
+                if type(response) is DBEntry:
+                    if rn is not None:
+                        response.entity['region'] = rn
+                    yield (task.method, response.entity)
+                elif type(response) is CollectTask:
+                    add_task(response)
+                else:
+                    log.info('log response', response)
 
     except ClientError as e:
         # record missing auditor role as empty account summary
@@ -1312,6 +1463,98 @@ async def process_task(task, add_task) -> AsyncGenerator[Tuple[str, dict], None]
         )
 
 
+def entity_hash(entity):
+    content = {k: v for k, v in entity.items() if k != 'recorded_at'}
+    return hashlib.md5(json_dumps(content).encode()).hexdigest()
+
+
+class SnapshotDiff:
+    """Compares entities to the previous run's hashes, per (table, account)
+
+    Only (table, account) pairs whose tasks all completed without errors are
+    diffed to deletions. Ones that errored keep their previous entities, and
+    ones not collected this run are left as they were. Changed entities count
+    as current once inserted(), so ones whose insert failed land again later.
+    """
+
+    def __init__(self, previous: Dict[tuple, Set[str]]):
+        self.previous = previous
+        self.seen: DefaultDict[tuple, Set[str]] = defaultdict(set)
+        self.current: DefaultDict[tuple, Set[str]] = defaultdict(set)
+        self.collected: Set[tuple] = set()
+        self.errored: Set[tuple] = set()
+        self.recorded_at = datetime.utcnow()
+
+    def is_changed(self, name, entity):
+        key = (name.replace('.', '_'), entity.get('account_id'))
+        if entity.get('error'):
+            self.errored.add(key)
+            return True
+
+        h = entity['entity_hash'] = entity_hash(entity)
+        if h in self.seen[key]:
+            return False
+        self.seen[key].add(h)
+        if h in self.previous.get(key, ()):
+            self.current[key].add(h)
+            return False
+        return True
+
+    def inserted(self, name, entities):
+        for entity in entities:
+            if 'entity_hash' in entity:
+                key = (name.replace('.', '_'), entity.get('account_id'))
+                self.current[key].add(entity['entity_hash'])
+
+    def task_done(self, task, failed=False):
+        key = (task.method.replace('.', '_'), task.account_id)
+        (self.errored if failed else self.collected).add(key)
+
+    def hash_rows(self):
+        for key in set(self.previous) | set(self.current):
+            table_name, account_id = key
+            previous = self.previous.get(key, set())
+            current = self.current.get(key, set())
+            if key in self.errored:
+                current = current | previous
+            elif key not in self.collected:
+                continue
+
+            changes = [(h, 'present' if h in previous else 'new') for h in current]
+            changes += [(h, 'deleted') for h in previous - current]
+            for h, change in changes:
+                yield {
+                    'recorded_at': self.recorded_at,
+                    'run_id': RUN_ID,
+                    'table_name': table_name,
+                    'account_id': account_id,
+                    'entity_hash': h,
+                    'change': change,
+                }
+
+
+def create_snapshot_objects():
+    db.create_table(
+        SNAPSHOT_HASHES_TABLE,
+        SNAPSHOT_HASHES_TABLE_COLUMNS,
+        ifnotexists=True,
+        rw_role=SA_ROLE,
+    )
+    for table_postfix in SUPPLEMENTARY_TABLES:
+        table = f'data.aws_collect_{table_postfix}'
+        if not any(c['name'] == 'ENTITY_HASH' for c in db.fetch(f'DESC TABLE {table}')):
+            db.execute(f'ALTER TABLE {table} ADD COLUMN entity_hash STRING')
+        db.execute(CURRENT_SNAPSHOT_VIEW_SQL.format(table_postfix=table_postfix))
+        db.execute(f'GRANT SELECT ON {table}_current TO ROLE {SA_ROLE}')
+
+
+def load_snapshot_diff(dryrun=False):
+    previous: DefaultDict[tuple, Set[str]] = defaultdict(set)
+    for row in [] if dryrun else db.fetch(LATEST_SNAPSHOT_HASHES_SQL):
+        previous[(row['TABLE_NAME'], row['ACCOUNT_ID'])].add(row['ENTITY_HASH'])
+    return SnapshotDiff(previous)
+
+
 def insert_list(name, values, table_name=None, dryrun=False):
     name = name.replace('.', '_')
     table_name = table_name or f'data.aws_collect_{name}'
@@ -1319,15 +1562,46 @@ def insert_list(name, values, table_name=None, dryrun=False):
     return db.insert(table_name, values, dryrun=dryrun)
 
 
-async def aws_collect_task(task, wait=0.0, add_task=None):
-    if wait:
-        await asyncio.sleep(wait)
+async def collect_tasks(tasks, sink, snapshot_diff=None):
+    """Processes tasks, and the tasks they add, with _NUM_WORKERS workers
 
-    # log.info(f'processing {task}')
-    result_lists = defaultdict(list)
-    async for k, v in process_task(task, add_task):
-        result_lists[k].append(v)
-    return result_lists
+    A task that fails is logged and the rest carry on, but a failed insert
+    stops the workers and is raised, so its rows are not silently lost.
+    """
+
+    async def task_rows(task):
+        try:
+            async for k, v in process_task(task, tasks.put_nowait):
+                if snapshot_diff is None or snapshot_diff.is_changed(k, v):
+                    yield k, v
+        except Exception as e:
+            log.error(e, f'failed to process {task}')
+            if snapshot_diff is not None:
+                snapshot_diff.task_done(task, failed=True)
+        else:
+            if snapshot_diff is not None:
+                snapshot_diff.task_done(task)
+
+    async def collect_worker():
+        while True:
+            task = await tasks.get()
+            try:
+                async for k, v in task_rows(task):
+                    await sink.add(k, v)
+            finally:
+                tasks.task_done()
+
+    workers = [asyncio.ensure_future(collect_worker()) for _ in range(_NUM_WORKERS)]
+    joined = asyncio.ensure_future(tasks.join())
+    try:
+        await asyncio.wait([joined, *workers], return_when=asyncio.FIRST_COMPLETED)
+        for w in workers:
+            if w.done():
+                w.result()
+    finally:
+        joined.cancel()
+        for w in workers:
+            w.cancel()
 
 
 async def aioingest(table_name, options, dryrun=False):
@@ -1363,6 +1637,12 @@ async def aioingest(table_name, options, dryrun=False):
         else options.get('collect_apis').split(',')
     )
 
+    snapshot_diff = None
+    if options.get('snapshot_mode') == 'differential':
+        if not dryrun:
+            create_snapshot_objects()
+        snapshot_diff = load_snapshot_diff(dryrun=dryrun)
+
     oids = options.get('org_account_ids', '')
     oids = (
         [oid.strip() for oid in oids.split(',')]
@@ -1410,44 +1690,37 @@ async def aioingest(table_name, options, dryrun=False):
         )
         num_entries += len(accounts)
 
-        collection_tasks = [
-            CollectTask(a['id'], method, {})
-            for method in collect_apis
-            for a in accounts
-        ]
+        tasks: asyncio.Queue = asyncio.Queue()
+        for method in collect_apis:
+            for a in accounts:
+                tasks.put_nowait(CollectTask(a['id'], method, {}))
 
-        def add_task(t):
-            collection_tasks.append(t)
+        def insert_entities(name, values):
+            response = insert_list(name, values, dryrun=dryrun)
+            if snapshot_diff is not None:
+                snapshot_diff.inserted(name, values)
+            return response
 
-        while collection_tasks:
-            coroutines = [
-                aws_collect_task(
-                    t, wait=(i / _REQUEST_PACE_PER_SECOND), add_task=add_task
-                )
-                for i, t in enumerate(collection_tasks[:_REQUEST_BATCH_SIZE])
-            ]
-            del collection_tasks[:_REQUEST_BATCH_SIZE]
-            log.info(
-                f'progress: starting {len(coroutines)}, queued {len(collection_tasks)}'
-            )
-
-            all_results = defaultdict(list)
-            for coro in asyncio.as_completed(coroutines):
-                result_lists = await coro
-                for k, vs in result_lists.items():
-                    all_results[k] += vs
-            for name, vs in all_results.items():
-                response = insert_list(name, vs, dryrun=dryrun)
-                num_entries += len(vs)
-                log.info(f'finished {name} {response}')
+        sink = AioInsertSink(insert_entities)
+        async with sink:
+            await collect_tasks(tasks, sink, snapshot_diff)
+
+        num_entries += sink.num_inserted
+
+    if snapshot_diff is not None:
+        with InsertSink(lambda t, vs: db.insert(t, vs, dryrun=dryrun)) as hashes:
+            for row in snapshot_diff.hash_rows():
+                hashes.add(SNAPSHOT_HASHES_TABLE, row)
 
     return num_entries
 
 
 def ingest(table_name, options, dryrun=False):
-    return asyncio.get_event_loop().run_until_complete(
-        aioingest(table_name, options, dryrun=dryrun)
-    )
+    loop = asyncio.get_event_loop()
+    try:
+        return loop.run_until_complete(aioingest(table_name, options, dryrun=dryrun))
+    finally:
+        loop.run_until_complete(close_clients())
 
 
 def main(
@@ -1458,6 +1731,7 @@ def main(
     collect_apis,
     master_reader_arn='',
     org_account_ids='',
+    snapshot_mode='full',
     dryrun=False,
 ):
     ingest(
@@ -1469,6 +1743,7 @@ def main(
             'reader_eid': reader_eid,
             'audit_reader_role': audit_reader_role,
             'collect_apis': collect_apis,
+            'snapshot_mode': snapshot_mode,
         },
         dryrun=dryrun,
     )
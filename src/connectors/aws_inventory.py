@@ -8,17 +8,31 @@ it does not provide (e.g. limits on what is collected)
 
 
 from datetime import datetime
+from functools import lru_cache
 import json
+import threading
 
 import boto3
 
 from runners.helpers import db, log
 from runners.helpers.dbconfig import REGION, ROLE as SA_ROLE
 from runners.config import RUN_ID
-from .utils import create_metadata_table, sts_assume_role, yaml_dump
+from .utils import (
+    InsertSink,
+    concurrently,
+    create_metadata_table,
+    sts_assume_role,
+    yaml_dump,
+)
 
 AWS_ACCOUNTS_METADATA = 'data.aws_accounts_information'
 
+# accounts are collected ACCOUNT_POOL_SIZE at a time, each REGION_POOL_SIZE
+# regions at a time
+ACCOUNT_POOL_SIZE = 4
+REGION_POOL_SIZE = 8
+CLIENTS_LOCK = threading.Lock()
+
 CONNECTION_OPTIONS = [
     {
         'type': 'select',
@@ -234,14 +248,6 @@ def ingest(table_name, options: dict):
     if not accounts_connection_name.startswith('data.'):
         accounts_connection_name = 'data.' + accounts_connection_name
 
-    ingest_of_type = {
-        'EC2': ec2_dispatch,
-        'SG': sg_dispatch,
-        'ELB': elb_dispatch,
-        'IAM': iam_dispatch,
-        'AMI': ami_dispatch,
-    }[connection_type]
-
     if (
         source_role_arn
         and destination_role_name
@@ -257,18 +263,24 @@ def ingest(table_name, options: dict):
             f"  FROM {accounts_connection_name}"
             f")"
         )
-        accounts = db.fetch(query)
-        count = ingest_of_type(
+        accounts = list(db.fetch(query))
+        count = dispatch(
+            connection_type,
             landing_table,
             accounts=accounts,
             source_role_arn=source_role_arn,
             destination_role_name=destination_role_name,
             external_id=external_id,
         )
+        log.info(f'Inserted {count} rows.')
+        yield count
 
     elif aws_access_key and aws_secret_key:
-        count = ingest_of_type(
-            landing_table, aws_access_key=aws_access_key, aws_secret_key=aws_secret_key
+        count = dispatch(
+            connection_type,
+            landing_table,
+            aws_access_key=aws_access_key,
+            aws_secret_key=aws_secret_key,
         )
         log.info(f'Inserted {count} rows.')
         yield count
@@ -276,117 +288,8 @@ def ingest(table_name, options: dict):
         log.error()
 
 
-def iam_dispatch(
-    landing_table,
-    aws_access_key='',
-    aws_secret_key='',
-    accounts=None,
-    source_role_arn='',
-    destination_role_name='',
-    external_id='',
-):
-    results = 0
-    if accounts:
-        for account in accounts:
-            id = account['ACCOUNT_ID']
-            name = account['ACCOUNT_ALIAS']
-            target_role = f'arn:aws:iam::{id}:role/{destination_role_name}'
-            log.info(f"Using role {target_role}")
-            try:
-                session = sts_assume_role(source_role_arn, target_role, external_id)
-
-                results += ingest_iam(landing_table, session=session, account=account)
-
-                db.insert(
-                    AWS_ACCOUNTS_METADATA,
-                    values=[(datetime.utcnow(), RUN_ID, id, name, results)],
-                    columns=[
-                        'snapshot_at',
-                        'run_id',
-                        'account_id',
-                        'account_alias',
-                        'iam_count',
-                    ],
-                )
-
-            except Exception as e:
-                db.insert(
-                    AWS_ACCOUNTS_METADATA,
-                    values=[(datetime.utcnow(), RUN_ID, id, name, 0, e)],
-                    columns=[
-                        'snapshot_at',
-                        'run_id',
-                        'account_id',
-                        'account_alias',
-                        'iam_count',
-                        'error',
-                    ],
-                )
-                log.error(f"Unable to assume role {target_role} with error", e)
-    else:
-        results += ingest_iam(
-            landing_table, aws_access_key=aws_access_key, aws_secret_key=aws_secret_key
-        )
-
-    return results
-
-
-def ec2_dispatch(
-    landing_table,
-    aws_access_key='',
-    aws_secret_key='',
-    accounts=None,
-    source_role_arn='',
-    destination_role_name='',
-    external_id='',
-):
-    results = 0
-    if accounts:
-        for account in accounts:
-            id = account['ACCOUNT_ID']
-            name = account['ACCOUNT_ALIAS']
-            target_role = f'arn:aws:iam::{id}:role/{destination_role_name}'
-            log.info(f"Using role {target_role}")
-            try:
-                session = sts_assume_role(source_role_arn, target_role, external_id)
-
-                results += ingest_ec2(landing_table, session=session, account=account)
-
-                db.insert(
-                    AWS_ACCOUNTS_METADATA,
-                    values=[(datetime.utcnow(), RUN_ID, id, name, results)],
-                    columns=[
-                        'snapshot_at',
-                        'run_id',
-                        'account_id',
-                        'account_alias',
-                        'ec2_count',
-                    ],
-                )
-
-            except Exception as e:
-                db.insert(
-                    AWS_ACCOUNTS_METADATA,
-                    values=[(datetime.utcnow(), RUN_ID, id, name, 0, e)],
-                    columns=[
-                        'snapshot_at',
-                        'run_id',
-                        'account_id',
-                        'account_alias',
-                        'ec2_count',
-                        'error',
-                    ],
-                )
-                log.error(f"Unable to assume role {target_role} with error", e)
-    else:
-        results += ingest_ec2(
-            landing_table, aws_access_key=aws_access_key, aws_secret_key=aws_secret_key
-        )
-
-    return results
-
-
-def ami_dispatch(
+def dispatch(
+    asset_type,
     landing_table,
     aws_access_key='',
     aws_secret_key='',
@@ -395,354 +298,200 @@ def ami_dispatch(
     destination_role_name='',
     external_id='',
 ):
-    results = 0
-    if accounts:
-        for account in accounts:
-            id = account['ACCOUNT_ID']
-            name = account['ACCOUNT_ALIAS']
-            target_role = f'arn:aws:iam::{id}:role/{destination_role_name}'
-            log.info(f"Using role {target_role}")
-            try:
-                session = sts_assume_role(source_role_arn, target_role, external_id)
-
-                results += ingest_ami(landing_table, session=session, account=account)
-
-                db.insert(
-                    AWS_ACCOUNTS_METADATA,
-                    values=[(datetime.utcnow(), RUN_ID, id, name, results)],
-                    columns=[
-                        'snapshot_at',
-                        'run_id',
-                        'account_id',
-                        'account_alias',
-                        'ami_count',
-                    ],
-                )
-
-            except Exception as e:
-                db.insert(
-                    AWS_ACCOUNTS_METADATA,
-                    values=[(datetime.utcnow(), RUN_ID, id, name, 0, e)],
-                    columns=[
-                        'snapshot_at',
-                        'run_id',
-                        'account_id',
-                        'account_alias',
-                        'ami_count',
-                        'error',
-                    ],
-                )
-                log.error(f"Unable to assume role {target_role} with error", e)
-    else:
-        results += ingest_ami(
-            landing_table, aws_access_key=aws_access_key, aws_secret_key=aws_secret_key
-        )
-
-    return results
-
-
-def sg_dispatch(
-    landing_table,
-    aws_access_key='',
-    aws_secret_key='',
-    accounts=None,
-    source_role_arn='',
-    destination_role_name='',
-    external_id='',
-):
-    results = 0
-    if accounts:
-        for account in accounts:
-            id = account['ACCOUNT_ID']
-            name = account['ACCOUNT_ALIAS']
-            target_role = f'arn:aws:iam::{id}:role/{destination_role_name}'
-            log.info(f"Using role {target_role}")
-            try:
-                session = sts_assume_role(source_role_arn, target_role, external_id)
-                results += ingest_sg(landing_table, session=session, account=account)
-
-                db.insert(
-                    AWS_ACCOUNTS_METADATA,
-                    values=[(datetime.utcnow(), RUN_ID, id, name, results)],
-                    columns=[
-                        'snapshot_at',
-                        'run_id',
-                        'account_id',
-                        'account_alias',
-                        'sg_count',
-                    ],
-                )
-            except Exception as e:
-                db.insert(
-                    AWS_ACCOUNTS_METADATA,
-                    values=[(datetime.utcnow(), RUN_ID, id, name, 0, e)],
-                    columns=[
-                        'snapshot_at',
-                        'run_id',
-                        'account_id',
-                        'account_alias',
-                        'sg_count',
-                        'error',
-                    ],
-                )
-                log.error(f"Unable to assume role {target_role} with error", e)
-    else:
-        results += ingest_sg(
-            landing_table, aws_access_key=aws_access_key, aws_secret_key=aws_secret_key
-        )
-
-    return results
-
+    """collects assets of asset_type from accounts ACCOUNT_POOL_SIZE at a time,
+    or with the access key, inserting the rows of all accounts in large batches
+    """
+    get_assets, asset_row, insert_args = ASSET_TYPES[asset_type]
 
-def elb_dispatch(
-    landing_table,
-    aws_access_key='',
-    aws_secret_key='',
-    accounts=None,
-    source_role_arn='',
-    destination_role_name='',
-    external_id='',
-):
-    results = 0
-    if accounts:
-        for account in accounts:
+    def account_rows(account):
+        if account is None:
+            session = None
+        else:
             id = account['ACCOUNT_ID']
-            name = account['ACCOUNT_ALIAS']
             target_role = f'arn:aws:iam::{id}:role/{destination_role_name}'
             log.info(f"Using role {target_role}")
             try:
                 session = sts_assume_role(source_role_arn, target_role, external_id)
-                results += ingest_elb(landing_table, session=session, account=account)
-
-                db.insert(
-                    AWS_ACCOUNTS_METADATA,
-                    values=[(datetime.utcnow(), RUN_ID, id, name, results)],
-                    columns=[
-                        'snapshot_at',
-                        'run_id',
-                        'account_id',
-                        'account_alias',
-                        'elb_count',
-                    ],
-                )
             except Exception as e:
-                db.insert(
-                    AWS_ACCOUNTS_METADATA,
-                    values=[(datetime.utcnow(), RUN_ID, id, name, 0, e)],
-                    columns=[
-                        'snapshot_at',
-                        'run_id',
-                        'account_id',
-                        'account_alias',
-                        'elb_count',
-                        'error',
-                    ],
-                )
                 log.error(f"Unable to assume role {target_role} with error", e)
-    else:
-        results += ingest_elb(
-            landing_table, aws_access_key=aws_access_key, aws_secret_key=aws_secret_key
-        )
-
-    return results
+                return account, [], e
+
+        try:
+            assets = get_assets(
+                aws_access_key=aws_access_key,
+                aws_secret_key=aws_secret_key,
+                session=session,
+                account=account,
+            )
+        except Exception as e:
+            if account is None:
+                raise
+            log.error(f"Unable to collect {asset_type} from {account} with error", e)
+            return account, [], e
 
+        monitor_time = datetime.utcnow().isoformat()
+        return account, [asset_row(a, monitor_time) for a in assets], None
 
-def ingest_iam(
-    landing_table, aws_access_key=None, aws_secret_key=None, session=None, account=None
-):
-    users = get_iam_users(
-        aws_access_key=aws_access_key,
-        aws_secret_key=aws_secret_key,
-        session=session,
-        account=account,
+    sink = InsertSink(
+        lambda table, values: db.insert(table, values=values, **insert_args)
     )
-
-    monitor_time = datetime.utcnow().isoformat()
+    account_metadata = []
+    with sink:
+        for account, rows, error in concurrently(
+            account_rows, accounts or [None], ACCOUNT_POOL_SIZE
+        ):
+            for row in rows:
+                sink.add(landing_table, row)
+            if account is not None:
+                account_metadata.append(
+                    (
+                        datetime.utcnow(),
+                        RUN_ID,
+                        account['ACCOUNT_ID'],
+                        account['ACCOUNT_ALIAS'],
+                        len(rows),
+                        error,
+                    )
+                )
 
     db.insert(
-        landing_table,
-        values=[
-            (
-                row,
-                monitor_time,
-                row['Path'],
-                row['UserName'],
-                row['UserId'],
-                row.get('Arn'),
-                row['CreateDate'],
-                row.get('PasswordLastUsed'),
-                row.get('Account', {}).get('ACCOUNT_ID'),
-            )
-            for row in users
+        AWS_ACCOUNTS_METADATA,
+        values=account_metadata,
+        columns=[
+            'snapshot_at',
+            'run_id',
+            'account_id',
+            'account_alias',
+            f'{asset_type.lower()}_count',
+            'error',
         ],
-        select=db.derive_insert_select(LANDING_TABLES_COLUMNS['IAM']),
-        columns=db.derive_insert_columns(LANDING_TABLES_COLUMNS['IAM']),
     )
 
-    return len(users)
+    return sink.num_inserted
 
 
-def ingest_ec2(
-    landing_table, aws_access_key=None, aws_secret_key=None, session=None, account=None
-):
-    instances = get_ec2_instances(
-        aws_access_key=aws_access_key,
-        aws_secret_key=aws_secret_key,
-        session=session,
-        account=account,
+def iam_row(row, monitor_time):
+    return (
+        row,
+        monitor_time,
+        row['Path'],
+        row['UserName'],
+        row['UserId'],
+        row.get('Arn'),
+        row['CreateDate'],
+        row.get('PasswordLastUsed'),
+        row.get('Account', {}).get('ACCOUNT_ID'),
     )
 
-    monitor_time = datetime.utcnow().isoformat()
-    db.insert(
-        landing_table,
-        values=[
-            (
-                row,
-                row['InstanceId'],
-                row['Architecture'],
-                monitor_time,
-                row['InstanceType'],
-                # can be not present if a managed instance such as EMR
-                row.get('KeyName', ''),
-                row['LaunchTime'],
-                row['Region']['RegionName'],
-                row['State']['Name'],
-                row.get('InstanceName', ''),
-                row.get('Account', {}).get('ACCOUNT_ID'),
-            )
-            for row in instances
-        ],
-        select='PARSE_JSON(column1), column2, column3, column4, column5, column6, column7, column8, column9, column10',
-    )
 
-    return len(instances)
+def ec2_row(row, monitor_time):
+    return (
+        row,
+        row['InstanceId'],
+        row['Architecture'],
+        monitor_time,
+        row['InstanceType'],
+        # can be not present if a managed instance such as EMR
+        row.get('KeyName', ''),
+        row['LaunchTime'],
+        row['Region']['RegionName'],
+        row['State']['Name'],
+        row.get('InstanceName', ''),
+        row.get('Account', {}).get('ACCOUNT_ID'),
+    )
 
 
-def ingest_ami(
-    landing_table, aws_access_key=None, aws_secret_key=None, session=None, account=None
-):
-    images = get_images(
-        aws_access_key=aws_access_key,
-        aws_secret_key=aws_secret_key,
-        session=session,
-        account=account,
+def ami_row(row, monitor_time):
+    return (
+        row,
+        monitor_time,
+        row.get('VirtualizationType'),
+        row.get('Description'),
+        row.get('Tags'),
+        row.get('Hypervisor'),
+        row.get('EnaSupport'),
+        row.get('SriovNetSupport'),
+        row.get('ImageId'),
+        row.get('State'),
+        row.get('BlockDeviceMappings'),
+        row.get('Architecture'),
+        row.get('ImageLocation'),
+        row.get('RootDeviceType'),
+        row.get('RootDeviceName'),
+        row.get('OwnerId'),
+        row.get('CreationDate'),
+        row.get('Public'),
+        row.get('ImageType'),
+        row.get('Name'),
+        row.get('Account', {}).get('ACCOUNT_ID'),
+        row['Region']['RegionName'],
     )
 
-    monitor_time = datetime.utcnow().isoformat()
 
-    db.insert(
-        landing_table,
-        values=[
-            (
-                row,
-                monitor_time,
-                row.get('VirtualizationType'),
-                row.get('Description'),
-                row.get('Tags'),
-                row.get('Hypervisor'),
-                row.get('EnaSupport'),
-                row.get('SriovNetSupport'),
-                row.get('ImageId'),
-                row.get('State'),
-                row.get('BlockDeviceMappings'),
-                row.get('Architecture'),
-                row.get('ImageLocation'),
-                row.get('RootDeviceType'),
-                row.get('RootDeviceName'),
-                row.get('OwnerId'),
-                row.get('CreationDate'),
-                row.get('Public'),
-                row.get('ImageType'),
-                row.get('Name'),
-                row.get('Account', {}).get('ACCOUNT_ID'),
-                row['Region']['RegionName'],
-            )
-            for row in images
-        ],
-        select=db.derive_insert_select(LANDING_TABLES_COLUMNS['AMI']),
-        columns=db.derive_insert_columns(LANDING_TABLES_COLUMNS['AMI']),
+def sg_row(row, monitor_time):
+    return (
+        row,
+        row['Description'],
+        monitor_time,
+        row['GroupId'],
+        row['GroupName'],
+        row['OwnerId'],
+        row['Region']['RegionName'],
+        row.get('VpcId'),
     )
-    return len(images)
 
 
-def ingest_sg(
-    landing_table, aws_access_key=None, aws_secret_key=None, session=None, account=None
-):
-    groups = get_all_security_groups(
-        aws_access_key=aws_access_key,
-        aws_secret_key=aws_secret_key,
-        session=session,
-        account=account,
+def elb_row(row, monitor_time):
+    return (
+        row,
+        monitor_time,
+        row.get('CanonicalHostedZoneName', ''),
+        row.get('CanonicalHostedZoneNameID', ''),
+        row['CreatedTime'],
+        row['DNSName'],
+        row['LoadBalancerName'],
+        row['Region']['RegionName'],
+        row['Scheme'],
+        row.get('VPCId', 'VpcId'),
+        row.get('Account', {}).get('ACCOUNT_ID'),
     )
-    monitor_time = datetime.utcnow().isoformat()
-    db.insert(
-        landing_table,
-        values=[
-            (
-                row,
-                row['Description'],
-                monitor_time,
-                row['GroupId'],
-                row['GroupName'],
-                row['OwnerId'],
-                row['Region']['RegionName'],
-                row.get('VpcId'),
-            )
-            for row in groups
-        ],
-        select='PARSE_JSON(column1), column2, column3, column4, column5, column6, column7, column8',
-    )
-    return len(groups)
 
 
-def ingest_elb(
-    landing_table, aws_access_key=None, aws_secret_key=None, session=None, account=None
+@lru_cache(maxsize=None)
+def get_regions(aws_access_key=None, aws_secret_key=None):
+    return boto3.client(
+        'ec2',
+        aws_access_key_id=aws_access_key,
+        aws_secret_access_key=aws_secret_key,
+        region_name=REGION,
+    ).describe_regions()['Regions']
+
+
+def get_client(
+    service, region_name, aws_access_key=None, aws_secret_key=None, session=None
 ):
-    elbs = get_all_elbs(
-        aws_access_key=aws_access_key,
-        aws_secret_key=aws_secret_key,
-        session=session,
-        account=account,
-    )
-    monitor_time = datetime.utcnow().isoformat()
+    # clients are thread-safe, but creating them from a shared session is not
+    with CLIENTS_LOCK:
+        if session:
+            return session.client(service, region_name=region_name)
+        return boto3.client(
+            service,
+            aws_access_key_id=aws_access_key,
+            aws_secret_access_key=aws_secret_key,
+            region_name=region_name,
+        )
 
-    db.insert(
-        landing_table,
-        values=[
-            (
-                row,
-                monitor_time,
-                row.get('CanonicalHostedZoneName', ''),
-                row.get('CanonicalHostedZoneNameID', ''),
-                row['CreatedTime'],
-                row['DNSName'],
-                row['LoadBalancerName'],
-                row['Region']['RegionName'],
-                row['Scheme'],
-                row.get('VPCId', 'VpcId'),
-                row.get('Account', {}).get('ACCOUNT_ID'),
-            )
-            for row in elbs
-        ],
-        select='PARSE_JSON(column1), column2, column3, column4, column5, column6, '
-        'column7, column8, column9, column10',
-    )
-    return len(elbs)
+
+def in_regions(f, regions):
+    """concatenates the lists f(region), REGION_POOL_SIZE regions at a time"""
+    return [x for xs in concurrently(f, regions, REGION_POOL_SIZE) for x in xs]
 
 
 def get_iam_users(aws_access_key=None, aws_secret_key=None, session=None, account=None):
     log.info(f"Searching for iam users.")
 
     # get list of all users
-    if session:
-        client = session.client('iam', region_name=REGION)
-    else:
-        client = boto3.client(
-            'iam',
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key,
-            region_name=REGION,
-        )
+    client = get_client('iam', REGION, aws_access_key, aws_secret_key, session)
     paginator = client.get_paginator('list_users')
     page_iterator = paginator.paginate()
     results = [user for page in page_iterator for user in page['Users']]
@@ -758,28 +507,15 @@ def get_iam_users(aws_access_key=None, aws_secret_key=None, session=None, accoun
 def get_ec2_instances(
     aws_access_key=None, aws_secret_key=None, session=None, account=None
 ):
-    client = boto3.client(
-        'ec2',
-        aws_access_key_id=aws_access_key,
-        aws_secret_access_key=aws_secret_key,
-        region_name=REGION,
-    )
-    regions = client.describe_regions()['Regions']
+    regions = get_regions(aws_access_key, aws_secret_key)
 
     log.info(f"Searching for EC2 instances in {len(regions)} region(s).")
 
     # get list of all instances in each region
-    instances = []
-    for region in regions:
-        if session:
-            client = session.client('ec2', region_name=region['RegionName'])
-        else:
-            client = boto3.client(
-                'ec2',
-                aws_access_key_id=aws_access_key,
-                aws_secret_access_key=aws_secret_key,
-                region_name=region['RegionName'],
-            )
+    def get_region_instances(region):
+        client = get_client(
+            'ec2', region['RegionName'], aws_access_key, aws_secret_key, session
+        )
         paginator = client.get_paginator('describe_instances')
         page_iterator = paginator.paginate()
         results = [
@@ -793,7 +529,9 @@ def get_ec2_instances(
             instance['Name'] = get_ec2_instance_name(instance)
             if account:
                 instance['Account'] = account
-        instances.extend(results)
+        return results
+
+    instances = in_regions(get_region_instances, regions)
 
     # return list of instances
     log.info(f"Successfully serialized {len(instances)} EC2 instance(s).")
@@ -801,36 +539,23 @@ def get_ec2_instances(
 
 
 def get_images(aws_access_key=None, aws_secret_key=None, session=None, account=None):
-    client = boto3.client(
-        'ec2',
-        aws_access_key_id=aws_access_key,
-        aws_secret_access_key=aws_secret_key,
-        region_name=REGION,
-    )
-    regions = client.describe_regions()['Regions']
+    regions = get_regions(aws_access_key, aws_secret_key)
 
     log.info(f"Searching for images in {len(regions)} region(s).")
 
     # get list of all images in each region
-    images = []
-    for region in regions:
-        if session:
-            client = session.client('ec2', region_name=region['RegionName'])
-        else:
-            client = boto3.client(
-                'ec2',
-                aws_access_key_id=aws_access_key,
-                aws_secret_access_key=aws_secret_key,
-                region_name=region['RegionName'],
-            )
-
+    def get_region_images(region):
+        client = get_client(
+            'ec2', region['RegionName'], aws_access_key, aws_secret_key, session
+        )
         results = client.describe_images(Owners=['self'])['Images']
         for image in results:
             image['Region'] = region
             if account:
                 image['Account'] = account
+        return results
 
-        images.extend(results)
+    images = in_regions(get_region_images, regions)
 
     # return list of images
     log.info(f"Successfully serialized {len(images)} images(s).")
@@ -860,24 +585,16 @@ def get_all_security_groups(
     Each security group is manually given a 'Region' field for clarity
     """
 
-    regions = boto3.client(
-        'ec2', aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key
-    ).describe_regions()['Regions']
+    regions = get_regions(aws_access_key, aws_secret_key)
 
     log.info(f"Searching for Security Groups in {len(regions)} region(s).")
 
     # get list of all groups in each region
-    security_groups = []
-    for region in regions:
-        if session:
-            ec2 = session.client('ec2', region_name=region['RegionName'])
-        else:
-            ec2 = boto3.client(
-                'ec2',
-                aws_access_key_id=aws_access_key,
-                aws_secret_access_key=aws_secret_key,
-                region_name=region['RegionName'],
-            )
+    def get_region_security_groups(region):
+        ec2 = get_client(
+            'ec2', region['RegionName'], aws_access_key, aws_secret_key, session
+        )
+        security_groups = []
         for group in ec2.describe_security_groups()['SecurityGroups']:
             group["Region"] = region
             if account:
@@ -887,6 +604,9 @@ def get_all_security_groups(
             )  # for the boto3 datetime fix
             group = json.loads(group_str)
             security_groups.append(group)
+        return security_groups
+
+    security_groups = in_regions(get_region_security_groups, regions)
 
     # return list of groups
     log.info(f"Successfully serialized {len(security_groups)} security group(s).")
@@ -922,24 +642,16 @@ def get_all_v1_elbs(
     This function grabs each classic elb from each region and returns
     a list of them.
     """
-    regions = boto3.client(
-        'ec2', aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key
-    ).describe_regions()['Regions']
+    regions = get_regions(aws_access_key, aws_secret_key)
 
     log.info(f"Searching {len(regions)} region(s) for classic load balancers.")
 
     # get list of all load balancers in each region
-    elbs = []
-    for region in regions:
-        if session:
-            elb_client = session.client('elb', region_name=region['RegionName'])
-        else:
-            elb_client = boto3.client(
-                'elb',
-                aws_access_key_id=aws_access_key,
-                aws_secret_access_key=aws_secret_key,
-                region_name=region['RegionName'],
-            )
+    def get_region_elbs(region):
+        elb_client = get_client(
+            'elb', region['RegionName'], aws_access_key, aws_secret_key, session
+        )
+        elbs = []
         for elb in elb_client.describe_load_balancers()['LoadBalancerDescriptions']:
             # add region before adding elb to list of elbs
             elb["Region"] = region
@@ -950,6 +662,9 @@ def get_all_v1_elbs(
             )  # for the datetime ser fix
             elb = json.loads(elb_str)
             elbs.append(elb)
+        return elbs
+
+    elbs = in_regions(get_region_elbs, regions)
 
     # return list of load balancers
     log.info(f"Successfully serialized {len(elbs)} classic elastic load balancers(s).")
@@ -963,24 +678,16 @@ def get_all_v2_elbs(
     This function grabs each v2 elb from each region and returns
     a list of them.
     """
-    regions = boto3.client(
-        'ec2', aws_access_key_id=aws_access_key, aws_secret_access_key=aws_secret_key
-    ).describe_regions()['Regions']
+    regions = get_regions(aws_access_key, aws_secret_key)
 
     log.info(f"Searching {len(regions)} region(s) for modern load balancers.")
 
     # get list of all load balancers in each region
-    elbs = []
-    for region in regions:
-        if session:
-            elb_client = session.client('elbv2', region_name=region['RegionName'])
-        else:
-            elb_client = boto3.client(
-                'elbv2',
-                aws_access_key_id=aws_access_key,
-                aws_secret_access_key=aws_secret_key,
-                region_name=region['RegionName'],
-            )
+    def get_region_elbs(region):
+        elb_client = get_client(
+            'elbv2', region['RegionName'], aws_access_key, aws_secret_key, session
+        )
+        elbs = []
         for elb in elb_client.describe_load_balancers()['LoadBalancers']:
             # add region
             elb["Region"] = region
@@ -994,6 +701,9 @@ def get_all_v2_elbs(
             elb = json.dumps(elb, default=datetime_serializer).encode("utf-8")
             elb = json.loads(elb)
             elbs.append(elb)
+        return elbs
+
+    elbs = in_regions(get_region_elbs, regions)
 
     # return list of load balancers
     log.info(f"Successfully serialized {len(elbs)} modern elastic load balancers(s).")
@@ -1004,3 +714,54 @@ def datetime_serializer(obj):
     if isinstance(obj, datetime):
         return obj.isoformat()
     raise TypeError(f"Type {type(obj)} not serializable")
+
+
+# (get assets, asset row, db.insert args) of each connection type
+ASSET_TYPES = {
+    'IAM': (
+        get_iam_users,
+        iam_row,
+        {
+            'select': db.derive_insert_select(LANDING_TABLES_COLUMNS['IAM']),
+            'columns': db.derive_insert_columns(LANDING_TABLES_COLUMNS['IAM']),
+        },
+    ),
+    'EC2': (
+        get_ec2_instances,
+        ec2_row,
+        {
+            'select': (
+                'PARSE_JSON(column1), column2, column3, column4, column5, column6, '
+                'column7, column8, column9, column10'
+            )
+        },
+    ),
+    'AMI': (
+        get_images,
+        ami_row,
+        {
+            'select': db.derive_insert_select(LANDING_TABLES_COLUMNS['AMI']),
+            'columns': db.derive_insert_columns(LANDING_TABLES_COLUMNS['AMI']),
+        },
+    ),
+    'SG': (
+        get_all_security_groups,
+        sg_row,
+        {
+            'select': (
+                'PARSE_JSON(column1), column2, column3, column4, column5, column6, '
+                'column7, column8'
+            )
+        },
+    ),
+    'ELB': (
+        get_all_elbs,
+        elb_row,
+        {
+            'select': (
+                'PARSE_JSON(column1), column2, column3, column4, column5, column6, '
+                'column7, column8, column9, column10'
+            )
+        },
+    ),
+}
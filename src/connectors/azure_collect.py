@@ -1,44 +1,35 @@
 """Azure Inventory and Configuration
 Load Inventory and Configuration of accounts using Service Principals
 """
-from collections import namedtuple, defaultdict, deque
-from datetime import datetime
+import aiohttp
+import asyncio
+from collections import defaultdict
+from datetime import datetime, timezone
 from dateutil.parser import parse as parse_date
-from itertools import chain, islice, takewhile
 import fire
+from itertools import count
 import json
+import random
 import re
-import requests
-from time import time
-from typing import Any, Dict, List
-from urllib.parse import urlencode
+import time
+from typing import Any, AsyncIterator, DefaultDict, Dict, List, Optional
+from urllib.parse import urlencode, urlparse
 import xmltodict
+from xml.parsers.expat import ExpatError
 
-from azure.common.credentials import ServicePrincipalCredentials
-from msrestazure.azure_cloud import AZURE_US_GOV_CLOUD, AZURE_PUBLIC_CLOUD
-
-from connectors.utils import updated, yaml_dump
-from runners.utils import json_dumps, format_exception_only
+from connectors.utils import (
+    AioInsertSink,
+    CircuitBreaker,
+    KeyedTokenBuckets,
+    azure_access_token,
+    updated,
+    yaml_dump,
+)
+from runners.utils import format_exception_only
 from runners.helpers import db, log
 from runners.helpers.dbconfig import ROLE as SA_ROLE
 
 
-def access_token_cache(cloud, client_id, tenant, secret, resource, _creds={}):
-    key = (client_id, tenant, secret, resource)
-    cred = _creds.get(key)
-    if cred is None or cred.token['expires_on'] - time() < 60:
-        cred = _creds[key] = ServicePrincipalCredentials(
-            client_id=client_id,
-            tenant=tenant,
-            secret=secret,
-            resource=f'https://{resource}',
-            cloud_environment=AZURE_US_GOV_CLOUD
-            if cloud == 'usgov'
-            else AZURE_PUBLIC_CLOUD,
-        )
-    return cred.token['access_token']
-
-
 CONNECTION_OPTIONS = [
     {
         'name': 'credentials',
@@ -1790,7 +1781,234 @@ API_SPECS: Dict[str, Dict[str, Any]] = {
 }
 
 
-def GET(kind, params, cred, depth) -> List[Dict]:
+DEFAULT_MAX_CONCURRENCY = 50
+CLIENT_TIMEOUT_SECONDS = 600
+MAX_QUEUED_CALLS = 1000
+
+
+def parse_rate_limit(spec) -> float:
+    rate_limit = spec.get('rate_limit', '1000/s')
+    match = re.fullmatch(r'([0-9\.]+)/s', rate_limit)
+    if match is None:
+        raise ValueError(f"rate_limit should look like '10/s', not {rate_limit!r}")
+    return float(match.group(1))
+
+
+# keyed by (kind, subscription or tenant), burst of 1 keeps calls evenly spaced
+RATE_LIMITS = KeyedTokenBuckets(
+    default=(1000, 1),
+    limits={kind: (parse_rate_limit(spec), 1) for kind, spec in API_SPECS.items()},
+    key_prefix=lambda key: key[0],
+)
+
+TRANSIENT_API_ERRORS = (
+    aiohttp.ClientConnectionError,
+    aiohttp.ClientPayloadError,
+    asyncio.TimeoutError,
+)
+
+
+def rate_key(kind, params, cred):
+    rate_by = API_SPECS[kind].get('rate_by')
+    return (
+        kind,
+        params[rate_by] if rate_by == 'subscriptionId' else cred['tenant'],
+    )
+
+
+# requests are retried with full-jitter exponential backoff, or after the delay
+# in a Retry-After header, which also holds back every other call to the same
+# subscription or tenant, as ARM and Graph throttle those as a whole.
+# transport errors and 5xx responses count towards a per-host circuit breaker.
+MAX_RETRIES = 8
+BACKOFF_BASE_SECONDS = 1
+BACKOFF_MAX_SECONDS = 60
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+# below this many remaining ARM reads, the rate key's bucket slows down
+RATELIMIT_REMAINING_LOW = 100
+
+CIRCUIT_BREAKERS: DefaultDict[str, CircuitBreaker] = defaultdict(CircuitBreaker)
+RETRY_AFTER_UNTIL: DefaultDict[str, float] = defaultdict(float)
+
+
+def backoff_seconds(attempt):
+    return random.uniform(
+        0, min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * 2 ** attempt)
+    )
+
+
+def retry_after_seconds(headers) -> Optional[float]:
+    if 'x-ms-retry-after-ms' in headers:
+        return float(headers['x-ms-retry-after-ms']) / 1000
+    retry_after = headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        return (parse_date(retry_after) - datetime.now(timezone.utc)).total_seconds()
+
+
+def ratelimit_remaining(headers) -> Optional[int]:
+    remaining = [
+        int(v)
+        for k, v in headers.items()
+        if k.lower().startswith('x-ms-ratelimit-remaining-') and v.isdigit()
+    ]
+    return min(remaining) if remaining else None
+
+
+async def wait_retry_after(scope):
+    while RETRY_AFTER_UNTIL[scope] > time.monotonic():
+        await asyncio.sleep(RETRY_AFTER_UNTIL[scope] - time.monotonic())
+
+
+async def request(session, concurrency, key, url, headers, decode):
+    """GETs url at the pace of rate key `key`, returning its status, headers
+    and body as decoded by decode(response), retrying the whole request on
+    transient errors, and raising ones that persist
+    """
+    host = urlparse(url).netloc
+    breaker = CIRCUIT_BREAKERS[host]
+    bucket = RATE_LIMITS[key]
+    _, scope = key
+    attempt = 0
+    while True:
+        await breaker.wait()
+        await wait_retry_after(scope)
+        await bucket.acquire()
+        try:
+            async with concurrency:
+                async with session.get(url, headers=headers) as response:
+                    status_code = response.status
+                    response_headers = response.headers
+                    retrying = (
+                        status_code in RETRY_STATUS_CODES and attempt < MAX_RETRIES
+                    )
+                    body = None if retrying else await decode(response)
+
+        except TRANSIENT_API_ERRORS as e:
+            log.info(f'azure_collect.GET {host}:', format_exception_only(e))
+            breaker.failed()
+            if attempt >= MAX_RETRIES:
+                raise
+
+        else:
+            if status_code not in RETRY_STATUS_CODES or attempt >= MAX_RETRIES:
+                # error responses, once retries run out, are recorded as rows
+                if status_code < 500:
+                    breaker.succeeded()
+                remaining = ratelimit_remaining(response_headers)
+                if remaining is not None and remaining < RATELIMIT_REMAINING_LOW:
+                    bucket.throttled()
+                else:
+                    bucket.succeeded()
+                return status_code, response_headers, body
+
+            log.info(f'azure_collect.GET {host}: {status_code}')
+            if status_code == 429:
+                bucket.throttled()
+                retry_after = retry_after_seconds(response_headers)
+                if retry_after is not None:
+                    RETRY_AFTER_UNTIL[scope] = max(
+                        RETRY_AFTER_UNTIL[scope], time.monotonic() + retry_after
+                    )
+                    attempt += 1
+                    continue
+            else:
+                breaker.failed()
+
+        await asyncio.sleep(backoff_seconds(attempt))
+        attempt += 1
+
+
+# empty lists of values are recorded as empty rows
+# error values are recorded as rows with error and empty value cols
+# normal values are recorded with populated values and an empty error col
+def response_values(value_path, result):
+    for vk in value_path:
+        if result is None or vk not in result:
+            break
+        result = result[vk]
+
+    return (
+        result
+        if type(result) is list
+        else [result]
+        if type(result) is dict
+        else [{'error': result}]
+    ) or [{}]
+
+
+def decode_values(body, value_path, project, status_code):
+    """decodes a JSON or XML response body, returning it and its projected values"""
+    try:
+        result = (
+            xmltodict.parse(body, dict_constructor=dict)
+            if body.startswith(b'<?xml')
+            else json.loads(body)
+        )
+
+    except (ValueError, ExpatError) as e:
+        result = {
+            'error': {
+                'type': type(e).__name__,
+                'status_code': status_code,
+                'response_text': body.decode('utf-8', errors='replace'),
+            }
+        }
+
+    return result, [project(v) for v in response_values(value_path, result)]
+
+
+def projection(response_spec):
+    """compiles a response spec into a function mapping values to rows
+
+    '*' maps the whole value to a column, without it, keys missing from the
+    spec raise KeyError
+    """
+    columns = [(k, c) for k, c in response_spec.items() if k != '*']
+    raw_column = response_spec.get('*')
+    known_keys = response_spec.keys()
+
+    def project(value):
+        if raw_column is None:
+            for k in value.keys() - known_keys:
+                raise KeyError(k)
+        row = {c: value.get(k) for k, c in columns}
+        if raw_column is not None:
+            row[raw_column] = value
+        return row
+
+    return project
+
+
+RESPONSE_PLANS = {
+    kind: (
+        spec.get('response_value_key', 'value').split('.'),
+        projection(spec['response']),
+    )
+    for kind, spec in API_SPECS.items()
+}
+
+
+def error_row(kind, params, cred, e):
+    """the row recording a call that failed with e"""
+    _, project = RESPONSE_PLANS[kind]
+    return project(
+        updated(
+            {'error': {'type': type(e).__name__, 'message': format_exception_only(e)}},
+            params,
+            headerDate=datetime.now(timezone.utc),
+            tenantId=cred['tenant'],
+        )
+    )
+
+
+async def GET(
+    session, concurrency, kind, params, cred, depth
+) -> AsyncIterator[List[Dict]]:
+    """yields the rows of each page of a call as it arrives"""
     spec = API_SPECS[kind]
     request_spec = spec['request']
     path = request_spec['path'].format(**params)
@@ -1816,70 +2034,47 @@ def GET(kind, params, cred, depth) -> List[Dict]:
         )
     )
     api_version_header = api_version or request_spec.get('api-version-header')
-    bearer_token = access_token_cache(
-        cloud, cred['client'], cred['tenant'], cred['secret'], auth_aud
+    bearer_token = await asyncio.get_event_loop().run_in_executor(
+        None,
+        azure_access_token,
+        cloud,
+        cred['client'],
+        cred['tenant'],
+        cred['secret'],
+        f'https://{auth_aud}',
     )
     url = f'https://{host}{path}' + (f'?{query_params}' if query_params else '')
     log.debug(f'GET {url}')
 
-    nextUrl = url
-    values: List[Dict] = []
-    while nextUrl:
-        response = requests.get(
-            nextUrl,
-            headers={
-                'Authorization': 'Bearer ' + bearer_token,
-                'Accept': 'application/json',
-                'Content-Type': 'application/json',
-                'x-ms-version': api_version_header,
-            },
-        )
+    headers = {
+        'Authorization': 'Bearer ' + bearer_token,
+        'Accept': 'application/json',
+        'Content-Type': 'application/json',
+    }
+    if api_version_header:
+        headers['x-ms-version'] = api_version_header
 
-        log.debug(f'<- {response.status_code}')
+    key = rate_key(kind, params, cred)
+    value_path, project = RESPONSE_PLANS[kind]
+    nextUrl = url
 
-        try:
-            result = json.loads(
-                json_dumps(xmltodict.parse(response.text.encode()))
-                if response.text.startswith('<?xml')
-                else response.text
-            )
-
-        except json.JSONDecodeError:
-            result = {
-                'error': {
-                    'type': 'JSONDecodeError',
-                    'status_code': response.status_code,
-                    'response_text': response.text,
-                }
-            }
+    async def decode(response):
+        header_date = parse_date(response.headers['Date'])
+        return decode_values(
+            await response.read(),
+            value_path,
+            lambda v: project(
+                updated(v, params, headerDate=header_date, tenantId=cred['tenant'])
+            ),
+            response.status,
+        )
 
-        # empty lists of values are recorded as empty rows
-        # error values are recorded as rows with error and empty value cols
-        # normal values are recorded with populated values and an empty error col
-        def response_values(result):
-            for vk in spec.get('response_value_key', 'value').split('.'):
-                if result is None or vk not in result:
-                    break
-                result = result[vk]
-
-            return (
-                result
-                if type(result) is list
-                else [result]
-                if type(result) is dict
-                else [{'error': result}]
-            ) or [{}]
-
-        values += [
-            updated(
-                {},
-                v,
-                params,
-                headerDate=parse_date(response.headers['Date']),
-                tenantId=cred['tenant'],
-            )
-            for v in response_values(result)
-        ]
+    while nextUrl:
+        status_code, _, (result, page_values) = await request(
+            session, concurrency, key, nextUrl, headers, decode
+        )
+        log.debug(f'<- {status_code}')
+        yield page_values
 
         if 'nextLink' in result:
             nextUrl = result['nextLink']
@@ -1897,24 +2092,12 @@ def GET(kind, params, cred, depth) -> List[Dict]:
 
         break
 
-    response_spec = spec['response']
-    return [
-        {
-            response_spec[k]: (x if k == '*' else x.get(k))
-            for k in x.keys() | response_spec.keys()
-            if k in response_spec or '*' not in response_spec
-            # raise KeyError iff '*' not in response_spec
-        }
-        for x in values
-    ]
-
 
-def ingest(table_name, options, dryrun=False):
+async def aioingest(table_name, options, dryrun=False):
     connection_name = options['name']
     apis = options.get('apis', '*').split('.')
-    call_depth = 0
+    max_concurrency = int(options.get('max_concurrency', DEFAULT_MAX_CONCURRENCY))
     all_creds = options['credentials']
-    num_loaded = 0
 
     table_name_part = '' if connection_name == 'default' else f'_{connection_name}'
     table_prefix = f'data.azure_collect{table_name_part}'
@@ -1932,118 +2115,131 @@ def ingest(table_name, options, dryrun=False):
         for cred in all_creds
     ]
 
-    def insert_results(kind, results):
-        nonlocal num_loaded
+    concurrency = asyncio.Semaphore(max_concurrency)
+
+    def table_for(kind):
         postfix = 'connection' if kind == 'subscriptions' else kind
-        table_name = f'{table_prefix}_{postfix}'
-        result = db.insert(table_name, results, dryrun=dryrun)
-        rows_inserted = result['number of rows inserted']
-        num_loaded += rows_inserted
-        log.info(f'-> {table_name} ({rows_inserted} rows)')
-
-    while api_calls_remaining:
-        next_call_kind = api_calls_remaining[0]['kind']
-        next_call_depth = api_calls_remaining[0]['depth']
-        next_call_group = list(
-            takewhile(lambda c: c['kind'] == next_call_kind, api_calls_remaining)
-        )
-        num_calls = len(next_call_group)
-        api_calls_remaining = api_calls_remaining[num_calls:]
-
-        api_response = namedtuple('api_response', ['cred', 'results'])
-        transient_api_errors = (
-            requests.exceptions.SSLError,
-            requests.exceptions.ConnectionError,
-            requests.exceptions.ChunkedEncodingError,
-            requests.exceptions.ReadTimeout,
-        )
+        return f'{table_prefix}_{postfix}'
+
+    def child_calls(call, results):
+        for child_spec in API_SPECS[call['kind']].get('children', []):
+            for result in results:
+                argspec = child_spec.get('args', {})
+                params = {
+                    k: v(result) if callable(v) else result.get(v)
+                    for k, v in argspec.items()
+                    if callable(v) and v(result) or result.get(v)
+                }
+
+                # all args are required
+                if len(params) == len(argspec):
+                    yield {
+                        'cred': call['cred'],
+                        'kind': child_spec['kind'],
+                        'params': params,
+                        'depth': call['depth'] + 1,
+                    }
 
+    def wanted(call):
+        depth = call['depth']
         # `apis` option limits what we call
-        calls = deque(
-            call
-            for call in next_call_group
-            if (call['depth'] + 1 >= len(apis) and apis[-1] == '*')
-            or (call['depth'] <= len(apis) and apis[call['depth']] == next_call_kind)
+        return (depth + 1 >= len(apis) and apis[-1] == '*') or (
+            depth < len(apis) and apis[depth] == call['kind']
         )
 
-        if not calls:
-            continue
+    # max_concurrency workers take calls from a queue, deepest first, queueing
+    # children as each page of their parent arrives. at most MAX_QUEUED_CALLS
+    # calls are queued per depth: a worker finding its child's depth full
+    # makes the deepest queued call itself, which is deeper than its own, so
+    # this nests no deeper than API_SPECS' children.
+    calls: asyncio.PriorityQueue = asyncio.PriorityQueue()
+    num_queued: DefaultDict[int, int] = defaultdict(int)
+    call_order = count()
 
-        log.info(
-            f'GET {next_call_kind}: {num_calls} calls, {len(calls)} remain'
-        )
+    def put_call(call):
+        num_queued[call['depth']] += 1
+        calls.put_nowait((-call['depth'], next(call_order), call))
 
-        spec = API_SPECS[next_call_kind]
-        rate_space = 1 / float(
-            re.match(r'([0-9\.]+)/s', spec.get('rate_limit', '1000/s')).group(1)
-        )
-        rate_by = spec.get('rate_by')
-        responses = []
-        last_request = defaultdict(float)
-        while calls:
-            call = calls.popleft()
-            now = time()
-            rate_key = (
-                call['params'][rate_by]
-                if rate_by == 'subscriptionId'
-                else call['cred']['tenant']
-            )
-            if now - last_request[rate_key] < rate_space:
-                calls.append(call)
-                continue
-            else:
-                last_request[rate_key] = now
-
-            responses.append(
-                api_response(
-                    call['cred'],
-                    db.retry(
-                        f=lambda: GET(**call),
-                        E=transient_api_errors,
-                        n=10,
-                        sleep_seconds_btw_retry=30,
-                        loggers=[
-                            (
-                                transient_api_errors,
-                                lambda e: print(
-                                    'azure_collect.ingest:', format_exception_only(e)
-                                ),
-                            )
-                        ],
-                    ),
-                )
-            )
+    def took_call(queued):
+        call = queued[-1]
+        num_queued[call['depth']] -= 1
+        return call
 
-        insert_results(
-            next_call_kind, chain.from_iterable(r.results for r in responses)
-        )
+    async def queue_child(session, call):
+        while num_queued[call['depth']] >= MAX_QUEUED_CALLS:
+            try:
+                await process(session, took_call(calls.get_nowait()))
+            finally:
+                calls.task_done()
+        put_call(call)
 
-        for child_spec in spec.get('children', []):
-            for response in responses:
-                for result in response.results:
-                    argspec = child_spec.get('args', {})
-                    params = {
-                        k: v(result) if callable(v) else result.get(v)
-                        for k, v in argspec.items()
-                        if callable(v) and v(result) or result.get(v)
-                    }
+    async def pages(session, call):
+        try:
+            async for rows in GET(session, concurrency, **call):
+                yield rows
+        except Exception as e:
+            log.error(e, f'failed to GET {call["kind"]} {call["params"]}')
+            yield [error_row(call['kind'], call['params'], call['cred'], e)]
+
+    async def process(session, call):
+        table = table_for(call['kind'])
+        async for rows in pages(session, call):
+            log.debug(f'<- {call["kind"]}: {len(rows)} rows')
+            for row in rows:
+                await sink.add(table, row)
+            for child_call in filter(wanted, child_calls(call, rows)):
+                await queue_child(session, child_call)
+
+    async def worker(session):
+        while True:
+            call = took_call(await calls.get())
+            try:
+                await process(session, call)
+            finally:
+                calls.task_done()
 
-                    # all args are required
-                    if len(params) == len(argspec):
-                        api_calls_remaining.append(
-                            {
-                                'cred': response.cred,
-                                'kind': child_spec['kind'],
-                                'params': params,
-                                'depth': next_call_depth + 1,
-                            }
-                        )
+    sink = AioInsertSink(lambda t, rows: db.insert(t, rows, dryrun=dryrun))
+    async with aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=max_concurrency),
+        timeout=aiohttp.ClientTimeout(total=CLIENT_TIMEOUT_SECONDS),
+    ) as session, sink:
+        workers = [
+            asyncio.ensure_future(worker(session)) for _ in range(max_concurrency)
+        ]
+        joined = asyncio.ensure_future(calls.join())
+        try:
+            for call in filter(wanted, api_calls_remaining):
+                put_call(call)
+            # failed calls are recorded as error rows, a failed insert stops
+            # its worker, and the run
+            await asyncio.wait([joined] + workers, return_when=asyncio.FIRST_COMPLETED)
+            for w in workers:
+                if w.done():
+                    w.result()
+        finally:
+            joined.cancel()
+            for w in workers:
+                w.cancel()
+
+    return sink.num_inserted
 
-    return num_loaded
+
+def ingest(table_name, options, dryrun=False):
+    return asyncio.get_event_loop().run_until_complete(
+        aioingest(table_name, options, dryrun=dryrun)
+    )
 
 
 def main(
-    table_name, tenant, client, secret, cloud, apis='*', dryrun=True, run_now=False
+    table_name,
+    tenant,
+    client,
+    secret,
+    cloud,
+    apis='*',
+    max_concurrency=DEFAULT_MAX_CONCURRENCY,
+    dryrun=True,
+    run_now=False,
 ):
     ingest(
         table_name,
@@ -2053,6 +2249,7 @@ def main(
                 {'tenant': tenant, 'client': client, 'secret': secret, 'cloud': cloud}
             ],
             'apis': apis,
+            'max_concurrency': max_concurrency,
         },
         dryrun=dryrun,
     )
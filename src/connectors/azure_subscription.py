@@ -9,10 +9,9 @@ from dateutil.parser import parse
 
 from runners.helpers import db
 from runners.helpers.dbconfig import ROLE as SA_ROLE
-from .utils import yaml_dump
+from .utils import azure_credentials, yaml_dump
 
 from azure.mgmt.subscription import SubscriptionClient
-from azure.common.client_factory import get_client_from_json_dict
 
 
 CONNECTION_OPTIONS = [
@@ -81,9 +80,22 @@ API_ENDPOINTS = {
 }
 
 
+def get_client(client_class, options, *args, cloud_type='reg'):
+    endpoints = API_ENDPOINTS[cloud_type]
+    credentials = azure_credentials(
+        cloud_type,
+        options['clientId'],
+        options['tenantId'],
+        options['clientSecret'],
+        endpoints['managementEndpointUrl'],
+    )
+    return client_class(
+        credentials, *args, base_url=endpoints['resourceManagerEndpointUrl']
+    )
+
+
 def get_subscription_service(options, cloud_type='reg'):
-    options.update(API_ENDPOINTS[cloud_type])
-    return get_client_from_json_dict(SubscriptionClient, options).subscriptions
+    return get_client(SubscriptionClient, options, cloud_type=cloud_type).subscriptions
 
 
 def connect(connection_name, options):
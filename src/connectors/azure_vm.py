@@ -5,7 +5,6 @@ Collect Azure VM Inventory using an SP and Subscription Inventory
 please use azure_collect instead
 """
 
-from azure.common.client_factory import get_client_from_json_dict
 from azure.mgmt.compute import ComputeManagementClient
 from azure.mgmt.network import NetworkManagementClient
 
@@ -13,13 +12,15 @@ from runners.config import RUN_ID
 from runners.helpers import db
 from runners.helpers.dbconfig import ROLE as SA_ROLE
 from runners.utils import groups_of
-from .utils import create_metadata_table
-from .azure_subscription import API_ENDPOINTS
+from .utils import create_metadata_table, updated
+from .azure_subscription import get_client
 
 from datetime import datetime
 import itertools
+from multiprocessing.pool import ThreadPool
 
 AZURE_COLLECTION_METADATA = 'data.azure_collection_metadata'
+SUBSCRIPTION_POOL_SIZE = 8
 
 CONNECTION_OPTIONS = [
     {
@@ -84,25 +85,42 @@ WHERE event_time
 """
 
 
-def get_vms(options):
-    cli = get_client_from_json_dict(ComputeManagementClient, options)
+def get_vms(options, cloud_type='reg'):
+    cli = get_client(
+        ComputeManagementClient,
+        options,
+        options['subscriptionId'],
+        cloud_type=cloud_type,
+    )
     vms = [vm.as_dict() for vm in cli.virtual_machines.list_all()]
     for vm in vms:
         vm['subscription_id'] = options['subscriptionId']
     return vms
 
 
-def get_nics(options):
-    cli = get_client_from_json_dict(NetworkManagementClient, options)
+def get_nics(options, cloud_type='reg'):
+    cli = get_client(
+        NetworkManagementClient,
+        options,
+        options['subscriptionId'],
+        cloud_type=cloud_type,
+    )
     return [nic.as_dict() for nic in cli.network_interfaces.list_all()]
 
 
-def enrich_vm_with_nics(vm, nics):
-    for nic in nics:
-        for vm_int in vm['network_profile']['network_interfaces']:
-            if nic['id'] == vm_int['id']:
-                vm_int['details'] = nic
-                break
+def enrich_vm_with_nics(vm, nics_by_id):
+    for vm_int in vm['network_profile']['network_interfaces']:
+        nic = nics_by_id.get(vm_int['id'])
+        if nic is not None:
+            vm_int['details'] = nic
+
+
+def get_subscription_vms(options, cloud_type='reg'):
+    vms = get_vms(options, cloud_type)
+    nics_by_id = {nic['id']: nic for nic in get_nics(options, cloud_type)}
+    for vm in vms:
+        enrich_vm_with_nics(vm, nics_by_id)
+    return vms
 
 
 def connect(connection_name, options):
@@ -149,21 +167,28 @@ def ingest(table_name, options):
         'tenantId': options['tenant_id'],
     }
 
-    virtual_machines = []
-    for sub in db.fetch(GET_SUBSCRIPTION_IDS_SQL.format(subscription_connection_name)):
-        options = creds.copy()
-        options.update(API_ENDPOINTS[cloud_type])
-        options['subscriptionId'] = sub['SUBSCRIPTION_ID']
-        vms = get_vms(options)
-        db.insert(
-            table=AZURE_COLLECTION_METADATA,
-            values=[(now, RUN_ID, options['subscriptionId'], len(vms))],
-            columns=['SNAPSHOT_AT', 'RUN_ID', 'SUBSCRIPTION_ID', 'VM_INSTANCE_COUNT'],
+    subscription_options = [
+        updated(creds.copy(), subscriptionId=sub['SUBSCRIPTION_ID'])
+        for sub in db.fetch(
+            GET_SUBSCRIPTION_IDS_SQL.format(subscription_connection_name)
+        )
+    ]
+
+    # the SDK clients block on I/O, so subscriptions are listed in threads
+    with ThreadPool(SUBSCRIPTION_POOL_SIZE) as pool:
+        virtual_machines = pool.map(
+            lambda options: get_subscription_vms(options, cloud_type),
+            subscription_options,
         )
-        nics = get_nics(options)
-        for vm in vms:
-            enrich_vm_with_nics(vm, nics)
-        virtual_machines.append(vms)
+
+    db.insert(
+        table=AZURE_COLLECTION_METADATA,
+        values=[
+            (now, RUN_ID, options['subscriptionId'], len(vms))
+            for options, vms in zip(subscription_options, virtual_machines)
+        ],
+        columns=['SNAPSHOT_AT', 'RUN_ID', 'SUBSCRIPTION_ID', 'VM_INSTANCE_COUNT'],
+    )
 
     virtual_machines = [
         (
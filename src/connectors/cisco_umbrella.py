@@ -8,7 +8,7 @@ from runners.helpers.dbconfig import ROLE as SA_ROLE
 import requests
 
 from datetime import datetime
-from .utils import yaml_dump
+from .utils import InsertSink, PageNumbers, get_pages, http_session, yaml_dump
 
 PAGE_SIZE = 500
 
@@ -57,33 +57,23 @@ LANDING_TABLE_COLUMNS = [
 ]
 
 
-def get_data(organization_id: int, key: str, secret: str, params: dict = {}) -> dict:
-    url = f"https://management.api.umbrella.com/v1/organizations/{organization_id}/roamingcomputers"
-    headers: dict = {"Content-Type": "application/json", "Accept": "application/json"}
-    try:
-        req = requests.get(
-            url,
-            params=params,
-            headers=headers,
-            auth=requests.auth.HTTPBasicAuth(key, secret),
-        )
-        req.raise_for_status()
-
-    except requests.HTTPError as http_err:
-        log.error(f"Error GET: url={url}")
-        log.error(f"HTTP error occurred: {http_err}")
-        raise
-
-    try:
-        log.debug(req.status_code)
-        json = req.json()
-
-    except Exception as json_error:
-        log.error(f"JSON error occurred: {json_error}")
-        log.debug(f"requests response {req}")
-        raise
-
-    return json
+def device_row(timestamp, device):
+    return (
+        timestamp,
+        device,
+        device.get('deviceId'),
+        device.get('osVersionName', None),
+        device.get('lastSyncStatus', None),
+        device.get('type', None),
+        device.get('version', None),
+        device.get('lastSync', None),
+        device.get('osVersion', None),
+        device.get('name', None),
+        device.get('status', None),
+        device.get('originId', None),
+        device.get('appliedBundle', None),
+        device.get('hasIpBlocking', None),
+    )
 
 
 def connect(connection_name, options):
@@ -108,38 +98,26 @@ def ingest(table_name, options):
     api_secret = options['api_secret']
     api_key = options['api_key']
 
-    params: dict = {"limit": PAGE_SIZE, "page": 1}  # API starts at 1
-
-    while 1:
-        devices: dict = get_data(organization_id, api_key, api_secret, params)
-        params["page"] += 1
-
-        if len(devices) == 0:
-            break
-
-        db.insert(
-            landing_table,
-            values=[
-                (
-                    timestamp,
-                    device,
-                    device.get('deviceId'),
-                    device.get('osVersionName', None),
-                    device.get('lastSyncStatus', None),
-                    device.get('type', None),
-                    device.get('version', None),
-                    device.get('lastSync', None),
-                    device.get('osVersion', None),
-                    device.get('name', None),
-                    device.get('status', None),
-                    device.get('originId', None),
-                    device.get('appliedBundle', None),
-                    device.get('hasIpBlocking', None),
-                )
-                for device in devices
-            ],
+    url = f"https://management.api.umbrella.com/v1/organizations/{organization_id}/roamingcomputers"
+    session = http_session(
+        headers={"Content-Type": "application/json", "Accept": "application/json"},
+        auth=requests.auth.HTTPBasicAuth(api_key, api_secret),
+    )
+    pagination = PageNumbers(PAGE_SIZE, start=1)  # API starts at 1
+
+    sink = InsertSink(
+        lambda table, values: db.insert(
+            table,
+            values=values,
             select=db.derive_insert_select(LANDING_TABLE_COLUMNS),
             columns=db.derive_insert_columns(LANDING_TABLE_COLUMNS),
         )
-        log.info(f'Inserted {len(devices)} rows.')
-        yield len(devices)
+    )
+
+    with sink:
+        for devices in get_pages(session, url, pagination=pagination):
+            for device in devices:
+                sink.add(landing_table, device_row(timestamp, device))
+
+    log.info(f'Inserted {sink.num_inserted} rows.')
+    yield sink.num_inserted
@@ -6,12 +6,32 @@ from runners.helpers import db, log
 from runners.helpers.dbconfig import ROLE as SA_ROLE
 
 from datetime import datetime
+import threading
+import time
 
 import requests
-from .utils import yaml_dump
+from .utils import (
+    CursorPages,
+    InsertSink,
+    RateLimit,
+    concurrently,
+    get_json,
+    get_pages,
+    http_session,
+    prefetched,
+    yaml_dump,
+)
 
 PAGE_SIZE = 1000
 
+# details of each page of ids are looked up DETAILS_BATCH_SIZE ids per request,
+# POOL_SIZE requests at a time, while the next PREFETCH_PAGES pages of ids load
+DETAILS_BATCH_SIZE = 100
+POOL_SIZE = 8
+PREFETCH_PAGES = 2
+REQUESTS_PER_SECOND = 100
+TOKEN_REFRESH_MARGIN_SECONDS = 300
+
 CROWDSTRIKE_AUTH_TOKEN_URL = 'https://api.crowdstrike.com/oauth2/token'
 CROWDSTRIKE_DEVICES_BY_ID_URL = (
     'https://api.crowdstrike.com/devices/queries/devices-scroll/v1'
@@ -88,7 +108,7 @@ LANDING_TABLE_COLUMNS = [
 
 
 # Perform the authorization call to create access token for subsequent API calls
-def get_token_basic(client_id: str, client_secret: str) -> str:
+def get_credential(client_id: str, client_secret: str) -> dict:
     headers: dict = {"Content-Type": "application/x-www-form-urlencoded;charset=UTF-8"}
     try:
         log.debug(f"Preparing POST: url={CROWDSTRIKE_AUTH_TOKEN_URL}")
@@ -108,12 +128,30 @@ def get_token_basic(client_id: str, client_secret: str) -> str:
         log.debug(f"JSON error occurred: {json_error}")
         log.debug(f"requests response {req}")
         raise (json_error)
-    try:
-        access_token = credential["access_token"]
-    except BaseException:
+    if "access_token" not in credential:
         log.error("error auth request token")
         raise AttributeError("error auth request token")
-    return access_token
+    return credential
+
+
+class TokenAuth(requests.auth.AuthBase):
+    """Bearer auth requesting a new token shortly before the current expires"""
+
+    def __init__(self, client_id: str, client_secret: str):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.lock = threading.Lock()
+        self.token = None
+        self.expires_at = 0.0
+
+    def __call__(self, request):
+        with self.lock:
+            if time.monotonic() > self.expires_at - TOKEN_REFRESH_MARGIN_SECONDS:
+                credential = get_credential(self.client_id, self.client_secret)
+                self.token = credential["access_token"]
+                self.expires_at = time.monotonic() + credential.get("expires_in", 1799)
+        request.headers["Authorization"] = f"Bearer {self.token}"
+        return request
 
 
 # Parse out the offset value from the result.
@@ -130,34 +168,52 @@ def get_offset_from_devices_results(result: dict) -> str:
     return offset
 
 
-# Perform a generic API call
-def get_data(token: str, url: str, params: dict = {}) -> dict:
-    headers: dict = {"Authorization": f"Bearer {token}"}
-    try:
-        log.debug(f"Preparing GET: url={url} with params={params}")
-        req = requests.get(url, params=params, headers=headers)
-        req.raise_for_status()
-    except requests.HTTPError as http_err:
-        log.error(f"Error GET: url={url}")
-        log.error(f"Error GET: url={url}")
-        log.error(f"HTTP error occurred: {http_err}")
-        raise http_err
-    try:
-        json = req.json()
-
-    except Exception as json_error:
-        log.debug(f"JSON error occurred: {json_error}")
-        log.debug(f"requests response {req}")
-        json = {}
-    return json
-
-
-# Helper function to format the /devices endpoint parameters
-def create_url_params_get_devices(url: str, resources: list) -> str:
-    params_get_devices: str = "?"
-    for id in resources:
-        params_get_devices += "&ids=" + id
-    return url + params_get_devices
+def device_row(timestamp, device):
+    return (
+        timestamp,
+        device,
+        device.get('device_id'),
+        device.get('first_seen', None),
+        device.get('system_manufacturer', None),
+        device.get('config_id_base', None),
+        device.get('last_seen', None),
+        device.get('policies', None),
+        device.get('slow_changing_modified_timestamp', None),
+        device.get('minor_version', None),
+        device.get('system_product_name', None),
+        device.get('hostname', None),
+        device.get('mac_address', None),
+        device.get('product_type_desc', None),
+        device.get('platform_name', None),
+        device.get('external_ip', None),
+        device.get('agent_load_flags', None),
+        device.get('group_hash', None),
+        device.get('provision_status', None),
+        device.get('os_version', None),
+        device.get('groups', None),
+        device.get('bios_version', None),
+        device.get('modified_timestamp', None),
+        device.get('local_ip', None),
+        device.get('agent_version', None),
+        device.get('major_version', None),
+        device.get('meta', None),
+        device.get('agent_local_time', None),
+        device.get('bios_manufacturer', None),
+        device.get('platform_id', None),
+        device.get('device_policies', None),
+        device.get('config_id_build', None),
+        device.get('config_id_platform', None),
+        device.get('cid', None),
+        device.get('status', None),
+        device.get('service_pack_minor', None),
+        device.get('product_type', None),
+        device.get('service_pack_major', None),
+        device.get('build_number', None),
+        device.get('pointer_size', None),
+        device.get('site_name', None),
+        device.get('machine_domain', None),
+        device.get('ou', None),
+    )
 
 
 def connect(connection_name, options):
@@ -181,83 +237,51 @@ def ingest(table_name, options):
     client_id = options['client_id']
     client_secret = options['client_secret']
 
-    # Call the authorization endpoint so we can make subsequent calls to the API with an auth token
-    token: str = get_token_basic(client_id, client_secret)
-
-    offset = ""
-    params_get_id_devices: dict = {"limit": PAGE_SIZE, "offset": offset}
+    # requests' auth calls the authorization endpoint for a token as needed
+    session = http_session(
+        auth=TokenAuth(client_id, client_secret), pool_size=POOL_SIZE
+    )
+    rate_limit = RateLimit(REQUESTS_PER_SECOND)
 
-    while 1:
-        dict_id_devices: dict = get_data(
-            token, CROWDSTRIKE_DEVICES_BY_ID_URL, params_get_id_devices
+    def get_devices(ids):
+        rate_limit.wait()
+        dict_devices: dict = get_json(
+            session, CROWDSTRIKE_DEVICE_DETAILS_URL, {"ids": ids}
         )
-        resources: list = dict_id_devices["resources"]
-        params_get_id_devices["offset"] = get_offset_from_devices_results(
-            dict_id_devices
-        )
-
-        if len(resources) == 0:
-            break
+        return dict_devices["resources"]
 
-        device_details_url_and_params: str = create_url_params_get_devices(
-            CROWDSTRIKE_DEVICE_DETAILS_URL, resources
-        )
+    device_ids_pages = get_pages(
+        session,
+        CROWDSTRIKE_DEVICES_BY_ID_URL,
+        {"limit": PAGE_SIZE, "offset": ""},
+        CursorPages(
+            'offset',
+            next_cursor=get_offset_from_devices_results,
+            items=lambda page: page["resources"],
+        ),
+    )
 
-        dict_devices: dict = get_data(token, device_details_url_and_params)
-        devices = dict_devices["resources"]
-
-        db.insert(
-            landing_table,
-            values=[
-                (
-                    timestamp,
-                    device,
-                    device.get('device_id'),
-                    device.get('first_seen', None),
-                    device.get('system_manufacturer', None),
-                    device.get('config_id_base', None),
-                    device.get('last_seen', None),
-                    device.get('policies', None),
-                    device.get('slow_changing_modified_timestamp', None),
-                    device.get('minor_version', None),
-                    device.get('system_product_name', None),
-                    device.get('hostname', None),
-                    device.get('mac_address', None),
-                    device.get('product_type_desc', None),
-                    device.get('platform_name', None),
-                    device.get('external_ip', None),
-                    device.get('agent_load_flags', None),
-                    device.get('group_hash', None),
-                    device.get('provision_status', None),
-                    device.get('os_version', None),
-                    device.get('groups', None),
-                    device.get('bios_version', None),
-                    device.get('modified_timestamp', None),
-                    device.get('local_ip', None),
-                    device.get('agent_version', None),
-                    device.get('major_version', None),
-                    device.get('meta', None),
-                    device.get('agent_local_time', None),
-                    device.get('bios_manufacturer', None),
-                    device.get('platform_id', None),
-                    device.get('device_policies', None),
-                    device.get('config_id_build', None),
-                    device.get('config_id_platform', None),
-                    device.get('cid', None),
-                    device.get('status', None),
-                    device.get('service_pack_minor', None),
-                    device.get('product_type', None),
-                    device.get('service_pack_major', None),
-                    device.get('build_number', None),
-                    device.get('pointer_size', None),
-                    device.get('site_name', None),
-                    device.get('machine_domain', None),
-                    device.get('ou', None),
-                )
-                for device in devices
-            ],
+    sink = InsertSink(
+        lambda table, values: db.insert(
+            table,
+            values=values,
             select=db.derive_insert_select(LANDING_TABLE_COLUMNS),
             columns=db.derive_insert_columns(LANDING_TABLE_COLUMNS),
         )
-        log.info(f'Inserted {len(devices)} rows.')
-        yield len(devices)
+    )
+
+    with sink:
+        for dict_id_devices in prefetched(device_ids_pages, PREFETCH_PAGES):
+            resources: list = dict_id_devices["resources"]
+            if len(resources) == 0:
+                break
+
+            batches = [
+                resources[i : i + DETAILS_BATCH_SIZE]
+                for i in range(0, len(resources), DETAILS_BATCH_SIZE)
+            ]
+            for devices in concurrently(get_devices, batches, POOL_SIZE):
+                for device in devices:
+                    sink.add(landing_table, device_row(timestamp, device))
+
+    yield sink.num_inserted
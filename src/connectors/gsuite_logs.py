@@ -2,13 +2,16 @@
 Collect G Suite API logs using a Service Account
 """
 
+import json
+import threading
+
 from googleapiclient.discovery import build
 from google.oauth2 import service_account
 
 from runners.helpers import db
 from runners.helpers.dbconfig import ROLE as SA_ROLE
 
-from .utils import yaml_dump
+from .utils import InsertSink, RateLimit, concurrently, yaml_dump
 
 CONNECTION_OPTIONS = [
     {
@@ -71,6 +74,21 @@ LOGIN_EVENTS = [
 ]
 SCOPES = ['https://www.googleapis.com/auth/admin.reports.audit.readonly']
 
+# (subject, event) pairs are collected POOL_SIZE at a time, within the Reports
+# API's per-project quota
+POOL_SIZE = 4
+REQUESTS_PER_SECOND = 10
+PAGE_SIZE = 1000
+
+RATE_LIMIT = RateLimit(REQUESTS_PER_SECOND)
+
+_CREDENTIALS: dict = {}
+_CREDENTIALS_LOCK = threading.Lock()
+
+# discovery clients wrap an httplib2.Http, which is not thread-safe, so each
+# thread builds and keeps its own
+_SERVICES = threading.local()
+
 
 def connect(connection_name, options):
     connection_type = options['connection_type']
@@ -88,78 +106,139 @@ def connect(connection_name, options):
     }
 
 
+def credentials_key(service_account_info, subject):
+    return (json.dumps(service_account_info, sort_keys=True), subject)
+
+
+def get_credentials(service_account_info, subject=None):
+    key = credentials_key(service_account_info, subject)
+    with _CREDENTIALS_LOCK:
+        if key not in _CREDENTIALS:
+            creds = service_account.Credentials.from_service_account_info(
+                service_account_info
+            )
+            if subject is not None:
+                creds = creds.with_subject(subject).with_scopes(SCOPES)
+            _CREDENTIALS[key] = creds
+        return _CREDENTIALS[key]
+
+
+def get_service(service_account_info, subject=None):
+    key = credentials_key(service_account_info, subject)
+    services = _SERVICES.__dict__.setdefault('by_credentials', {})
+    if key not in services:
+        services[key] = build(
+            'admin',
+            version='reports_v1',
+            credentials=get_credentials(service_account_info, subject),
+            cache_discovery=False,
+        )
+    return services[key]
+
+
 def get_logs(service_account_info, with_subject=None, event_name='', start_time=None):
-    creds = service_account.Credentials.from_service_account_info(service_account_info)
-    if with_subject is not None:
-        creds = creds.with_subject(with_subject).with_scopes(SCOPES)
+    activities = get_service(service_account_info, with_subject).activities()
+    request = activities.list(
+        userKey='all',
+        applicationName='login',
+        eventName=event_name,
+        startTime=start_time and start_time.isoformat(),
+        maxResults=PAGE_SIZE,
+    )
+    while request is not None:
+        RATE_LIMIT.wait()
+        response = request.execute()
+        yield from response.get('items', [])
+        request = activities.list_next(request, response)
 
-    service = build('admin', version='reports_v1', credentials=creds)
 
-    return (
-        service.activities()
-        .list(
-            userKey='all',
-            applicationName='login',
-            eventName=event_name,
-            startTime=start_time and start_time.isoformat(),
+def get_start_times(landing_table):
+    return {
+        (row['DELEGATING_SUBJECT'], row['EVENT_NAME']): row['EVENT_TIME']
+        for row in db.fetch(
+            f'SELECT delegating_subject, event_name, MAX(event_time) AS event_time '
+            f'FROM {landing_table} '
+            f'GROUP BY delegating_subject, event_name'
         )
-        .execute()
+    }
+
+
+def log_row(subject, item):
+    event = item.get('events', [{}])[0]
+    return (
+        item['id']['time'],
+        item['etag'].strip('"'),
+        subject,
+        event.get('name'),
+        {
+            p['name']: (p.get('value') or p.get('boolValue') or p.get('multiValue'))
+            for p in event.get('parameters', [])
+        },
+        item['id']['customerId'],
+        item['actor'].get('email'),
+        item['actor'].get('profileId'),
+        item.get('ipAddress'),
+        item,
     )
 
 
+LOG_ROW_SELECT = (
+    'CURRENT_TIMESTAMP()',
+    'column1',
+    'column2',
+    'column3',
+    'column4',
+    'PARSE_JSON(column5)',
+    'column6',
+    'column7',
+    'column8',
+    'column9',
+    'PARSE_JSON(column10)',
+)
+
+# pairs' logs are listed newest first, so rows of a pair that fails part way are
+# deleted again, rather than leave a gap before its latest event_time
+DELETE_PAIR_LOGS_SQL = """
+DELETE FROM {landing_table}
+WHERE delegating_subject = %s
+  AND event_name = %s
+  AND event_time > COALESCE(%s, '1970-01-01'::TIMESTAMP_LTZ)
+"""
+
+
 def ingest(table_name, options):
     landing_table = f'data.{table_name}'
     service_user_creds = options['service_user_creds']
-    for subject in options.get('subjects_list') or ['']:
-        for event in LOGIN_EVENTS:
-            items = get_logs(
-                service_user_creds,
-                with_subject=subject,
-                event_name=event,
-                start_time=db.fetch_latest(
-                    landing_table,
-                    where=(
-                        f"delegating_subject='{subject}' AND " f"event_name='{event}'"
-                    ),
-                ),
-            ).get('items', [])
-
-            db.insert(
-                landing_table,
-                values=[
-                    (
-                        item['id']['time'],
-                        item['etag'].strip('"'),
-                        subject,
-                        item.get('events', [{}])[0].get('name'),
-                        {
-                            p['name']: (
-                                p.get('value')
-                                or p.get('boolValue')
-                                or p.get('multiValue')
-                            )
-                            for p in item.get('events', [{}])[0].get('parameters', [])
-                        },
-                        item['id']['customerId'],
-                        item['actor'].get('email'),
-                        item['actor'].get('profileId'),
-                        item.get('ipAddress'),
-                        item,
-                    )
-                    for item in items
-                ],
-                select=(
-                    'CURRENT_TIMESTAMP()',
-                    'column1',
-                    'column2',
-                    'column3',
-                    'column4',
-                    'PARSE_JSON(column5)',
-                    'column6',
-                    'column7',
-                    'column8',
-                    'column9',
-                    'PARSE_JSON(column10)',
-                ),
+    start_times = get_start_times(landing_table)
+
+    def insert_rows(table, rows):
+        return db.insert(table, values=rows, select=LOG_ROW_SELECT)
+
+    def get_pair_logs(pair):
+        """inserts the logs of a (subject, event) pair as their pages arrive"""
+        subject, event = pair
+        start_time = start_times.get(pair)
+        try:
+            with InsertSink(insert_rows) as sink:
+                for item in get_logs(
+                    service_user_creds,
+                    with_subject=subject,
+                    event_name=event,
+                    start_time=start_time,
+                ):
+                    sink.add(landing_table, log_row(subject, item))
+        except Exception:
+            db.execute(
+                DELETE_PAIR_LOGS_SQL.format(landing_table=landing_table),
+                fix_errors=False,
+                params=[subject, event, start_time],
             )
-            yield len(items)
+            raise
+        return sink.num_inserted
+
+    pairs = [
+        (subject, event)
+        for subject in options.get('subjects_list') or ['']
+        for event in LOGIN_EVENTS
+    ]
+    yield from concurrently(get_pair_logs, pairs, POOL_SIZE)
@@ -2,14 +2,15 @@ import asyncio
 import aiohttp
 import json
 from json.decoder import JSONDecodeError
-from random import random
 from dateutil.parser import parse as parse_date
 
-from connectors.utils import updated
+from connectors.utils import AioInsertSink, TokenBucket, updated
 from runners.helpers import db, log
 from runners.utils import groups_of
 
 
+DEFAULT_INSTANCE_URL = 'https://snowflake.jamfcloud.com'
+
 CONNECTION_OPTIONS = [
     {
         'type': 'str',
@@ -19,63 +20,142 @@ CONNECTION_OPTIONS = [
         'placeholder': "bWVvdzpodW50cmVzczIK",
         'secret': True,
         'required': True,
-    }
+    },
+    {
+        'type': 'str',
+        'name': 'instance_url',
+        'title': "Jamf Pro URL",
+        'prompt': "The URL of your Jamf Pro server",
+        'placeholder': "https://yourcompany.jamfcloud.com",
+        'default': DEFAULT_INSTANCE_URL,
+        'required': True,
+    },
 ]
 
 HEADERS: dict = {}
+BASE_URL = f'{DEFAULT_INSTANCE_URL}/JSSResource'
+
+# computer details are fetched by NUM_WORKERS workers sharing a token bucket
+# of REQUEST_SPEED_PER_SECOND, and inserted INSERT_BATCH_SIZE at a time
 REQUEST_SPEED_PER_SECOND = 10
+NUM_WORKERS = 10
+MAX_RETRIES = 3
+INSERT_BATCH_SIZE = 100
+
+# unchanged computers' latest snapshots are copied forward, so that every run
+# still records every computer listed
+COPY_SNAPSHOTS_BATCH_SIZE = 1000
+COPY_SNAPSHOTS_SQL = """
+INSERT INTO {table_name}
+SELECT * REPLACE ('{recorded_at}'::TIMESTAMP_LTZ AS recorded_at)
+FROM {table_name}
+WHERE computer_id IN ({computer_ids})
+QUALIFY ROW_NUMBER() OVER (PARTITION BY computer_id ORDER BY recorded_at DESC) = 1
+"""
+
+
+async def fetch(session, bucket, url) -> dict:
+    for attempt in range(MAX_RETRIES + 1):
+        await bucket.acquire()
+        async with session.get(f'{BASE_URL}{url}', headers=HEADERS) as response:
+            txt = await response.text()
+            if response.status in (429, 503) and attempt < MAX_RETRIES:
+                log.info(f'GET {url} -> status({response.status}), backing off')
+                bucket.throttled()
+                continue
+            bucket.succeeded()
+
+            date_header = response.headers.get('Date')
+            if date_header is None:
+                log.info(f'GET {url} -> status({response.status}) text({txt})')
+                return {}
+
+            result = {'recorded_at': parse_date(date_header)}
+            try:
+                return updated(result, json.loads(txt))
+            except JSONDecodeError:
+                log.info(f'GET {url} -> status({response.status}) text({txt})')
+                return result
+    return {}
+
+
+def copy_snapshots(table_name, computer_ids, recorded_at):
+    for ids in groups_of(COPY_SNAPSHOTS_BATCH_SIZE, computer_ids):
+        db.execute(
+            COPY_SNAPSHOTS_SQL.format(
+                table_name=table_name,
+                recorded_at=recorded_at.isoformat(),
+                computer_ids=', '.join(str(int(cid)) for cid in ids),
+            ),
+            fix_errors=False,
+        )
 
 
-async def fetch(session, url, wait=0) -> dict:
-    if wait:
-        await asyncio.sleep(wait)
-    async with session.get(
-        f'https://snowflake.jamfcloud.com/JSSResource{url}', headers=HEADERS
-    ) as response:
-        txt = await response.text()
-        date_header = response.headers.get('Date')
-        if date_header is None:
-            log.info(f'GET {url} -> status({response.status}) text({txt})')
-            return {}
+def load_report_dates(table_name):
+    """report dates of the computers as of their latest snapshots in table_name"""
+    return {
+        int(row['COMPUTER_ID']): int(row['REPORT_DATE_EPOCH'])
+        for row in db.fetch(
+            f'SELECT computer_id, '
+            f'  MAX(general:report_date_epoch::NUMBER) AS report_date_epoch '
+            f'FROM {table_name} '
+            f'GROUP BY computer_id'
+        )
+        if row['REPORT_DATE_EPOCH'] is not None
+    }
 
-        result = {'recorded_at': parse_date(date_header)}
-        try:
-            return updated(result, json.loads(txt))
-        except JSONDecodeError:
-            log.info(f'GET {url} -> status({response.status}) text({txt})')
-            return result
 
+async def main(table_name):
+    bucket = TokenBucket(REQUEST_SPEED_PER_SECOND, REQUEST_SPEED_PER_SECOND)
+    report_dates = load_report_dates(table_name)
 
-def fetch_computer(s, cid, i=0):
-    return fetch(s, f'/computers/id/{cid}', wait=i / REQUEST_SPEED_PER_SECOND)
+    async with aiohttp.ClientSession() as session:
+        listing = await fetch(session, bucket, '/computers/subset/basic')
+        computers = listing.get('computers', [])
+
+        # only computers which reported since their last snapshot have changed
+        cids: asyncio.Queue = asyncio.Queue()
+        unchanged_cids = []
+        for c in computers:
+            last_report_date = report_dates.get(c['id'])
+            if (
+                last_report_date is None
+                or c.get('report_date_epoch') != last_report_date
+            ):
+                cids.put_nowait(c['id'])
+            else:
+                unchanged_cids.append(c['id'])
+
+        log.info(
+            f'loading {cids.qsize()} of {len(computers)} computer details, '
+            f'copying the rest forward from their unchanged last snapshots'
+        )
 
+        async with AioInsertSink(max_rows=INSERT_BATCH_SIZE) as sink:
 
-async def main(table_name):
-    async with aiohttp.ClientSession() as session:
-        cids = [
-            c['id'] for c in (await fetch(session, '/computers')).get('computers', [])
-        ]
+            async def worker():
+                while not cids.empty():
+                    cid = cids.get_nowait()
+                    c = await fetch(session, bucket, f'/computers/id/{cid}')
+                    await sink.add(
+                        table_name,
+                        updated(
+                            c.get('computer'),
+                            computer_id=cid,
+                            recorded_at=c.get('recorded_at'),
+                        ),
+                    )
 
-        log.info(f'loading {len(cids)} computer details')
-        computers = await asyncio.gather(
-            *[fetch_computer(session, cid, i) for i, cid in enumerate(cids)]
-        )
+            await asyncio.gather(*[worker() for _ in range(NUM_WORKERS)])
 
-        log.info(f'inserting {len(computers)} computers into {table_name}')
-        rows = [
-            updated(
-                c.get('computer'), computer_id=cid, recorded_at=c.get('recorded_at')
-            )
-            for cid, c in zip(cids, computers)
-        ]
-        for g in groups_of(100, rows):
-            db.insert(table_name, g)
-        return len(rows)
+        copy_snapshots(table_name, unchanged_cids, listing.get('recorded_at'))
+        return sink.num_inserted + len(unchanged_cids)
 
 
 def ingest(table_name, options):
-    global HEADERS
+    global HEADERS, BASE_URL
     creds = options.get('credentials', '')
+    instance_url = options.get('instance_url') or DEFAULT_INSTANCE_URL
     HEADERS = {'Authorization': f'Basic {creds}', 'Accept': 'application/json'}
+    BASE_URL = f'{instance_url.rstrip("/")}/JSSResource'
     return asyncio.get_event_loop().run_until_complete(main(f'data.{table_name}'))
-
@@ -9,12 +9,22 @@ from runners.helpers.dbconfig import ROLE as SA_ROLE
 from datetime import datetime
 
 import requests
-from urllib.error import HTTPError
-from .utils import yaml_dump
+from .utils import (
+    InsertSink,
+    RateLimit,
+    concurrently,
+    get_json,
+    http_session,
+    yaml_dump,
+)
 
 
 PAGE_SIZE = 5
 
+# Meraki allows 5 calls per second per organization, 429ing beyond that
+ORG_REQUESTS_PER_SECOND = 5
+POOL_SIZE = 8
+
 CONNECTION_OPTIONS = [
     {
         'name': 'api_token',
@@ -70,24 +80,6 @@ LANDING_TABLE_COLUMNS_DEVICE = [
 ]
 
 
-def get_data(url: str, token: str, params: dict = {}) -> dict:
-    headers: dict = {
-        "Content-Type": "application/json",
-        "Accept": "application/json",
-        "X-Cisco-Meraki-API-Key": f"{token}",
-    }
-    try:
-        log.debug(f"Preparing GET: url={url} with params={params}")
-        req = requests.get(url, params=params, headers=headers)
-        req.raise_for_status()
-    except HTTPError as http_err:
-        log.error(f"Error GET: url={url}")
-        log.error(f"HTTP error occurred: {http_err}")
-        raise
-    log.debug(req.status_code)
-    return req.json()
-
-
 def connect(connection_name, options):
     landing_table_client = f'data.meraki_devices_{connection_name}_client_connection'
     landing_table_device = f'data.meraki_devices_{connection_name}_device_connection'
@@ -106,15 +98,102 @@ def connect(connection_name, options):
     return {'newStage': 'finalized', 'newMessage': "Meraki ingestion tables created!"}
 
 
-def ingest(table_name, options):
-    ingest_type = 'client' if table_name.endswith('_CLIENT_CONNECTION') else 'device'
-    landing_table = f'data.{table_name}'
+def device_row(timestamp, device):
+    return (
+        timestamp,
+        device,
+        device.get('serial'),
+        device.get('address'),
+        device.get('name'),
+        device.get('networkId'),
+        device.get('model'),
+        device.get('mac'),
+        device.get('lanIp'),
+        device.get('wan1Ip'),
+        device.get('wan2Ip'),
+        device.get('tags'),
+        device.get('lng'),
+        device.get('lat'),
+    )
+
+
+def client_row(timestamp, client, serial_number):
+    return (
+        timestamp,
+        client,
+        client.get('id'),
+        client.get('mac'),
+        client.get('description'),
+        client.get('mdnsName'),
+        client.get('dhcpHostname'),
+        client.get('ip'),
+        client.get('switchport'),
+        # vlan sometimes set to ''
+        client.get('vlan') or None,
+        client.get('usage', {}).get('sent') or None,
+        client.get('usage', {}).get('recv') or None,
+        serial_number,
+    )
+
+
+def get_org_rows(session, organization_id, ingest_type, whitelist, timestamp):
+    rate_limit = RateLimit(ORG_REQUESTS_PER_SECOND)
+
+    def get(url):
+        rate_limit.wait()
+        return get_json(session, url)
+
+    def get_or_skip(url, network):
+        try:
+            return get(url)
+        except requests.exceptions.HTTPError as e:
+            log.error(f"{network} not accessible, ")
+            log.error(e)
+            return None
+
+    networks = get(
+        f"https://api.meraki.com/api/v0/organizations/{organization_id}/networks"
+    )
+    network_ids = {network.get('id') for network in networks}
+
+    if whitelist:
+        network_ids = network_ids.intersection(whitelist)
+
+    network_ids = list(network_ids)
+    network_devices = concurrently(
+        lambda network: get_or_skip(
+            f"https://api.meraki.com/api/v0/networks/{network}/devices", network
+        ),
+        network_ids,
+        POOL_SIZE,
+    )
+    devices = [
+        (network, device)
+        for network, devices in zip(network_ids, network_devices)
+        for device in devices or []
+    ]
+
+    if ingest_type == 'device':
+        for network, device in devices:
+            yield device_row(timestamp, device)
+        return
+
+    device_clients = concurrently(
+        lambda network_device: get_or_skip(
+            f"https://api.meraki.com/api/v0/devices/{network_device[1]['serial']}/clients",
+            network_device[0],
+        ),
+        devices,
+        POOL_SIZE,
+    )
+    for (network, device), clients in zip(devices, device_clients):
+        serial_number = device['serial']
+        for client in clients or []:
+            yield client_row(timestamp, client, serial_number)
 
-    timestamp = datetime.utcnow()
-    api_token = options['api_token']
-    whitelist = set(options['network_id_whitelist'])
 
-    organizations = get_data(f"https://api.meraki.com/api/v0/organizations", api_token)
+def get_rows(session, ingest_type, whitelist, timestamp):
+    organizations = get_json(session, f"https://api.meraki.com/api/v0/organizations")
 
     for organization in organizations:
         organization_id = organization.get('id')
@@ -122,92 +201,45 @@ def ingest(table_name, options):
         if not organization_id:
             continue
 
-        networks = get_data(
-            f"https://api.meraki.com/api/v0/organizations/{organization_id}/networks",
-            api_token,
+        yield from get_org_rows(
+            session, organization_id, ingest_type, whitelist, timestamp
         )
-        network_ids = {network.get('id') for network in networks}
-
-        if whitelist:
-            network_ids = network_ids.intersection(whitelist)
-
-        for network in network_ids:
-            log.debug(f'Processing Meraki network {network}')
-            try:
-                devices = get_data(
-                    f"https://api.meraki.com/api/v0/networks/{network}/devices",
-                    api_token,
-                )
-            except requests.exceptions.HTTPError as e:
-                log.error(f"{network} not accessible, ")
-                log.error(e)
-                continue
-
-            if ingest_type == 'device':
-                db.insert(
-                    landing_table,
-                    values=[
-                        (
-                            timestamp,
-                            device,
-                            device.get('serial'),
-                            device.get('address'),
-                            device.get('name'),
-                            device.get('networkId'),
-                            device.get('model'),
-                            device.get('mac'),
-                            device.get('lanIp'),
-                            device.get('wan1Ip'),
-                            device.get('wan2Ip'),
-                            device.get('tags'),
-                            device.get('lng'),
-                            device.get('lat'),
-                        )
-                        for device in devices
-                    ],
-                    select=db.derive_insert_select(LANDING_TABLE_COLUMNS_DEVICE),
-                    columns=db.derive_insert_columns(LANDING_TABLE_COLUMNS_DEVICE),
-                )
-                log.info(f'Inserted {len(devices)} rows ({landing_table}).')
-                yield len(devices)
-
-            else:
-                for device in devices:
-                    serial_number = device['serial']
-
-                    try:
-                        clients = get_data(
-                            f"https://api.meraki.com/api/v0/devices/{serial_number}/clients",
-                            api_token,
-                        )
-                    except requests.exceptions.HTTPError as e:
-                        log.error(f"{network} not accessible, ")
-                        log.error(e)
-                        continue
-
-                    db.insert(
-                        landing_table,
-                        values=[
-                            (
-                                timestamp,
-                                client,
-                                client.get('id'),
-                                client.get('mac'),
-                                client.get('description'),
-                                client.get('mdnsName'),
-                                client.get('dhcpHostname'),
-                                client.get('ip'),
-                                client.get('switchport'),
-                                # vlan sometimes set to ''
-                                client.get('vlan') or None,
-                                client.get('usage', {}).get('sent') or None,
-                                client.get('usage', {}).get('recv') or None,
-                                serial_number,
-                            )
-                            for client in clients
-                        ],
-                        select=db.derive_insert_select(LANDING_TABLE_COLUMNS_CLIENT),
-                        columns=db.derive_insert_columns(LANDING_TABLE_COLUMNS_CLIENT),
-                    )
-                    log.info(f'Inserted {len(clients)} rows ({landing_table}).')
-                    yield len(clients)
+
+
+def ingest(table_name, options):
+    ingest_type = 'client' if table_name.endswith('_CLIENT_CONNECTION') else 'device'
+    landing_table = f'data.{table_name}'
+
+    timestamp = datetime.utcnow()
+    api_token = options['api_token']
+    whitelist = set(options['network_id_whitelist'])
+
+    session = http_session(
+        pool_size=POOL_SIZE,
+        headers={
+            "Content-Type": "application/json",
+            "Accept": "application/json",
+            "X-Cisco-Meraki-API-Key": f"{api_token}",
+        },
+    )
+
+    cols = (
+        LANDING_TABLE_COLUMNS_DEVICE
+        if ingest_type == 'device'
+        else LANDING_TABLE_COLUMNS_CLIENT
+    )
+    sink = InsertSink(
+        lambda table, values: db.insert(
+            table,
+            values=values,
+            select=db.derive_insert_select(cols),
+            columns=db.derive_insert_columns(cols),
+        )
+    )
+
+    with sink:
+        for row in get_rows(session, ingest_type, whitelist, timestamp):
+            sink.add(landing_table, row)
+
+    log.info(f'Inserted {sink.num_inserted} rows ({landing_table}).')
+    yield sink.num_inserted
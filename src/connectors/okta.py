@@ -4,9 +4,10 @@ Collect Okta activity logs, users, and groups using an API Token
 
 from runners.helpers import db, log
 from runners.helpers.dbconfig import ROLE as SA_ROLE
-from .utils import yaml_dump
+from .utils import LinkPages, RateLimit, get_pages, http_session, prefetched, yaml_dump
 
 import datetime
+from multiprocessing.pool import ThreadPool
 import requests
 
 CONNECTION_OPTIONS = [
@@ -44,6 +45,18 @@ LANDING_GROUP_TABLE_COLUMNS = [
     ('event_time', 'TIMESTAMP_LTZ DEFAULT CURRENT_TIMESTAMP'),
 ]
 
+# next links of the System Log, saved once the rows before them are inserted
+LOG_CURSORS_TABLE = 'data.okta_system_log_cursors'
+LOG_CURSORS_TABLE_COLUMNS = [
+    ('recorded_at', 'TIMESTAMP_LTZ'),
+    ('landing_table', 'STRING'),
+    ('next_url', 'STRING'),
+]
+
+LOG_PAGE_SIZE = 1000
+LOG_PREFETCH_PAGES = 4
+LOG_BATCH_SIZE = 10000
+
 
 def connect(connection_name, options):
     table_name = 'okta' + (
@@ -76,20 +89,42 @@ def connect(connection_name, options):
         rw_role=SA_ROLE,
     )
 
+    create_log_cursors_table()
+
     return {
         'newStage': 'finalized',
         'newMessage': "Okta ingestion table, user table, group table created!",
     }
 
 
-def ingest_users(url, headers, landing_table, now):
-    while 1:
-        response = requests.get(url=url, headers=headers)
-        if response.status_code != 200:
-            log.error('OKTA REQUEST FAILED: ', response.text)
-            return
+POOL_SIZE = 10
+
+# below Okta's default per-minute org rate limits, leaving room for its other
+# clients. 429s that get through are retried by the session.
+REQUESTS_PER_SECOND = 5
+LOG_REQUESTS_PER_SECOND = 1
+
 
-        result = response.json()
+def get_group_users(session, pagination, group):
+    """the group's users, or None with an error recorded on the group"""
+    try:
+        return [
+            user
+            for page in get_pages(
+                session, group['_links']['users']['href'], pagination=pagination
+            )
+            for user in page
+        ]
+    except requests.HTTPError as e:
+        status = e.response.status_code if e.response is not None else None
+        log.error(f"failed to list users of group {group.get('id')}: {status}")
+        group['users_error'] = {'status_code': status, 'message': str(e)}
+        return None
+
+
+def ingest_users(session, url, landing_table, now):
+    pagination = LinkPages(RateLimit(REQUESTS_PER_SECOND))
+    for result in get_pages(session, url, pagination=pagination):
         if result == []:
             break
 
@@ -100,16 +135,119 @@ def ingest_users(url, headers, landing_table, now):
         log.info(f'Inserted {len(result)} rows.')
         yield len(result)
 
-        url = ''
-        links = requests.utils.parse_header_links(response.headers['Link'])
-        for link in links:
-            if link['rel'] == 'next':
-                url = link['url']
 
-        if len(url) == 0:
+def ingest_groups(session, url, landing_table, now):
+    members_pagination = LinkPages(RateLimit(REQUESTS_PER_SECOND))
+    pagination = LinkPages(RateLimit(REQUESTS_PER_SECOND))
+    with ThreadPool(POOL_SIZE) as pool:
+        for result in get_pages(session, url, pagination=pagination):
+            if result == []:
+                break
+
+            group_users = pool.map(
+                lambda group: get_group_users(session, members_pagination, group),
+                result,
+            )
+            for row, users in zip(result, group_users):
+                row['users'] = users
+
+            db.insert(
+                landing_table, [{'raw': row, 'event_time': now} for row in result],
+            )
+
+            log.info(f'Inserted {len(result)} rows.')
+            yield len(result)
+
+
+def create_log_cursors_table():
+    db.create_table(
+        name=LOG_CURSORS_TABLE,
+        cols=LOG_CURSORS_TABLE_COLUMNS,
+        ifnotexists=True,
+        rw_role=SA_ROLE,
+    )
+
+
+def load_log_cursor(landing_table):
+    row = next(
+        db.fetch(
+            f'SELECT next_url FROM {LOG_CURSORS_TABLE}'
+            f" WHERE landing_table='{landing_table}'"
+            f' ORDER BY recorded_at DESC LIMIT 1'
+        ),
+        None,
+    )
+    return row['NEXT_URL'] if row else None
+
+
+def get_log_pages(session, url, params=None):
+    """yields (rows, next url) of log pages, up to and including an empty one"""
+    pagination = LinkPages(RateLimit(LOG_REQUESTS_PER_SECOND))
+    for result, next_url in pagination.linked_pages(session, url, params):
+        yield result, next_url
+        if result == []:
             break
 
 
+def ingest_logs(session, url, landing_table):
+    create_log_cursors_table()
+    cursor = load_log_cursor(landing_table)
+    if cursor:
+        pages = get_log_pages(session, cursor)
+    else:
+        ts = db.fetch_latest(landing_table, 'event_time')
+        if ts is None:
+            log.error(
+                "Unable to find a timestamp of most recent Okta log, "
+                "defaulting to one hour ago"
+            )
+            ts = datetime.datetime.now() - datetime.timedelta(hours=1)
+
+        params = {
+            'since': ts.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
+            'limit': LOG_PAGE_SIZE,
+            'sortOrder': 'ASCENDING',
+        }
+        pages = get_log_pages(session, url, params)
+
+    # pages are fetched ahead while rows are inserted in batches, each followed
+    # by the cursor to resume after them
+    rows = []
+    saved_cursor = cursor
+
+    def flush():
+        nonlocal rows, saved_cursor
+        if rows:
+            db.insert(
+                landing_table,
+                values=[(row, row['published']) for row in rows],
+                select='PARSE_JSON(column1), column2',
+            )
+            log.info(f'Inserted {len(rows)} rows.')
+        if cursor != saved_cursor:
+            db.insert(
+                LOG_CURSORS_TABLE,
+                [
+                    {
+                        'recorded_at': datetime.datetime.utcnow(),
+                        'landing_table': landing_table,
+                        'next_url': cursor,
+                    }
+                ],
+            )
+            saved_cursor = cursor
+        num_inserted, rows = len(rows), []
+        return num_inserted
+
+    for result, next_url in prefetched(pages, LOG_PREFETCH_PAGES):
+        rows += result
+        cursor = next_url or cursor
+        if len(rows) >= LOG_BATCH_SIZE:
+            yield flush()
+
+    yield flush()
+
+
 def ingest(table_name, options):
     ingest_type = (
         'users'
@@ -140,75 +278,16 @@ def ingest(table_name, options):
 
     now = datetime.datetime.utcnow()
 
-    if ingest_type == 'groups':
-        response = requests.get(url=ingest_urls[ingest_type], headers=headers)
-
-        result = response.json()
-
-        for row in result:
-            try:
-                row['users'] = requests.get(
-                    url=row['_links']['users']['href'], headers=headers
-                ).json()
-            except TypeError:
-                log.info(row)
-                raise
+    session = http_session(headers, pool_size=POOL_SIZE, retries=8)
 
-        db.insert(
-            landing_table, [{'raw': row, 'event_time': now} for row in result],
-        )
-
-        log.info(f'Inserted {len(result)} rows.')
-        yield len(result)
+    if ingest_type == 'groups':
+        yield from ingest_groups(session, ingest_urls['groups'], landing_table, now)
 
     elif ingest_type == 'users':
-        yield from ingest_users(ingest_urls['users'], headers, landing_table, now)
+        yield from ingest_users(session, ingest_urls['users'], landing_table, now)
         yield from ingest_users(
-            ingest_urls['deprovisioned_users'], headers, landing_table, now
+            session, ingest_urls['deprovisioned_users'], landing_table, now
         )
 
     else:
-        ts = db.fetch_latest(landing_table, 'event_time')
-        if ts is None:
-            log.error(
-                "Unable to find a timestamp of most recent Okta log, "
-                "defaulting to one hour ago"
-            )
-            ts = datetime.datetime.now() - datetime.timedelta(hours=1)
-
-        params = {
-            'since': ts.strftime("%Y-%m-%dT%H:%M:%S.000Z"),
-            'limit': 500,
-            'sortOrder': 'ASCENDING',
-        }
-
-        i = 0
-        url = ingest_urls[ingest_type]
-        while 1:
-            response = requests.get(url=url, headers=headers, params=params)
-            if response.status_code != 200:
-                log.error('OKTA REQUEST FAILED: ', response.text)
-                return
-
-            result = response.json()
-            if result == []:
-                break
-
-            db.insert(
-                landing_table,
-                values=[(row, row['published']) for row in result],
-                select='PARSE_JSON(column1), column2',
-            )
-
-            log.info(f'Inserted {len(result)} rows from page {i}.')
-            i += 1
-            yield len(result)
-
-            url = ''
-            links = requests.utils.parse_header_links(response.headers['Link'])
-            for link in links:
-                if link['rel'] == 'next':
-                    url = link['url']
-
-            if len(url) == 0:
-                break
+        yield from ingest_logs(session, ingest_urls[ingest_type], landing_table)
@@ -3,17 +3,20 @@ Retrieve hourly Salesforce event log files from the API
 """
 
 import csv
+from datetime import datetime, timedelta, timezone
+import gzip
 import io
 import json
 import shutil
 import os
 import tempfile
+import threading
 
 from simple_salesforce import Salesforce
 
 from runners.helpers import db, log
 from runners.helpers.dbconfig import ROLE as SA_ROLE
-from connectors.utils import yaml_dump
+from connectors.utils import concurrently, yaml_dump
 
 CONNECTION_OPTIONS = [
     {
@@ -57,6 +60,27 @@ CONNECTION_OPTIONS = [
 
 LANDING_TABLE_COLUMNS = [('raw', 'VARIANT')]
 
+# one row per event log file loaded into a landing table
+LOG_FILES_TABLE = 'data.salesforce_event_log_files'
+LOG_FILES_TABLE_COLUMNS = [
+    ('recorded_at', 'TIMESTAMP_LTZ'),
+    ('table_name', 'STRING(500)'),
+    ('file_id', 'STRING(100)'),
+    ('event_type', 'STRING(100)'),
+    ('log_date', 'TIMESTAMP_LTZ'),
+    ('rows', 'NUMBER'),
+]
+
+# files are downloaded POOL_SIZE at a time, and looked for again up to
+# RESUME_LOOKBACK before the latest loaded, as Salesforce can publish them late
+POOL_SIZE = 4
+RESUME_LOOKBACK = timedelta(days=1)
+
+# at most MAX_DOWNLOADED_FILES are on disk waiting to be loaded, and none are
+# downloaded with less than MIN_FREE_DISK_BYTES free
+MAX_DOWNLOADED_FILES = 2 * POOL_SIZE
+MIN_FREE_DISK_BYTES = 2 ** 30
+
 
 def connect(connection_name, options):
     table_name = f'salesforce_events_{connection_name}'
@@ -79,6 +103,57 @@ def connect(connection_name, options):
     }
 
 
+def create_log_files_table():
+    db.create_table(LOG_FILES_TABLE, cols=LOG_FILES_TABLE_COLUMNS, ifnotexists=True)
+    db.execute(f'GRANT INSERT, SELECT ON {LOG_FILES_TABLE} TO ROLE {SA_ROLE}')
+
+
+def record_log_file(table_name, record, rows):
+    db.insert(
+        LOG_FILES_TABLE,
+        [
+            {
+                'recorded_at': datetime.now(timezone.utc),
+                'table_name': table_name,
+                'file_id': record['Id'],
+                'event_type': record['EventType'],
+                'log_date': record['LogDate'],
+                'rows': rows,
+            }
+        ],
+    )
+
+
+def download_log_file(sf, record, temp_dir):
+    """streams the CSV log file of record into a gzipped NDJSON file, one event
+    per line, returning its path and number of events
+    """
+    url = record['attributes']['url']
+    id = record['Id']
+    log.info(f'Downloading event log file {id} from {url}.')
+
+    # The URL provided is relative, but includes part of the base URL which we have to trim out before combining
+    # E.g. it could look like /services/data/v38.0/sobjects/EventLogFile/0AT0o00000NSIv5GAB
+    # where the base URL will look like: https://ap8.salesforce.com/services/data/v38.0/
+    url_relative = 'sobjects/' + url.split('sobjects/')[1] + '/LogFile'
+    result = sf._call_salesforce(
+        'GET', sf.base_url + url_relative, name=url_relative, stream=True
+    )
+    result.raw.decode_content = True
+
+    rows = 0
+    file_path = os.path.join(temp_dir, id + '.json.gz')
+    with result, gzip.open(file_path, 'wt') as f:
+        # newline='' keeps newlines inside quoted fields for the csv module
+        for row in csv.DictReader(
+            io.TextIOWrapper(result.raw, encoding='utf-8', newline='')
+        ):
+            f.write(json.dumps(row) + '\n')
+            rows += 1
+
+    return file_path, rows
+
+
 def ingest(table_name, options):
     landing_table = f'data.{table_name}'
     username = options['username']
@@ -87,9 +162,31 @@ def ingest(table_name, options):
     environment_raw = options['environment']
     environment = 'test' if environment_raw == 'test' else None
 
-    # We will fetch EventLogFiles where the LogDate is greater than the maximum
-    # timestamp seen in all previous EventLogFiles
-    start_time = db.fetch_latest(landing_table, col='raw:TIMESTAMP_DERIVED')
+    create_log_files_table()
+
+    # We will fetch EventLogFiles from shortly before the latest loaded, skipping
+    # those already loaded, or where the LogDate is greater than the maximum
+    # timestamp seen in all previous EventLogFiles for tables loaded before files
+    # were recorded
+    latest_log_date = next(
+        db.fetch(
+            f"SELECT MAX(log_date) AS log_date FROM {LOG_FILES_TABLE} "
+            f"WHERE table_name='{table_name}'"
+        )
+    )['LOG_DATE']
+    if latest_log_date is None:
+        start_time = db.fetch_latest(landing_table, col='raw:TIMESTAMP_DERIVED')
+        loaded_ids = set()
+    else:
+        start_date = latest_log_date - RESUME_LOOKBACK
+        start_time = start_date.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+        loaded_ids = {
+            row['FILE_ID']
+            for row in db.fetch(
+                f"SELECT file_id FROM {LOG_FILES_TABLE} "
+                f"WHERE table_name='{table_name}' AND log_date > '{start_time}'"
+            )
+        }
     if start_time is None:
         start_time = '1900-01-01T00:00:00.000Z'
 
@@ -105,60 +202,58 @@ def ingest(table_name, options):
         f'SELECT id, eventtype, logdate '
         f'FROM eventlogfile '
         f'WHERE interval=\'Hourly\' '
-        f'  AND logdate > {start_time}'
+        f'  AND logdate > {start_time} '
+        f'ORDER BY logdate'
     )
     log.info(f'Querying event logs: {event_log_soql_query}')
     log_files = sf.query_all(event_log_soql_query)
+    records = [r for r in log_files['records'] if r['Id'] not in loaded_ids]
 
     # Create a temp directory only accessible by the current user, which we will delete after Snowflake upload
     temp_dir = tempfile.mkdtemp('_sfevents')
 
     # Salesforce will provide a bunch of files, an hourly extract of each of the different event types in CSV format
     # There are around 50 different event types and they all have different fields. Rather than a table per event type,
-    # we'll convert them to JSON and do schema-on-read.
-    # We'll load from the table stage which has the 'STRIP_OUTER_ARRAY' option, so there will be one row per event.
-    total_files = log_files['totalSize']
-    log.info(f'Found {total_files} event files to load.')
-    if total_files > 0:
-        for record in log_files['records']:
-            url = record['attributes']['url']
-            id = record['Id']
-            log.info(f'Downloading event log file {id} from {url}.')
-
-            # The URL provided is relative, but includes part of the base URL which we have to trim out before combining
-            # E.g. it could look like /services/data/v38.0/sobjects/EventLogFile/0AT0o00000NSIv5GAB
-            # where the base URL will look like: https://ap8.salesforce.com/services/data/v38.0/
-            url_relative = 'sobjects/' + url.split('sobjects/')[1] + '/LogFile'
-            result = sf._call_salesforce(
-                'GET', sf.base_url + url_relative, name=url_relative
-            )
-
-            # TODO: Investigate streaming the result and converting to JSON in chunks.
+    # we'll convert them to JSON and do schema-on-read, one event per line.
+    # Each file is uploaded, copied and recorded as soon as it is downloaded, while the next ones download, so that
+    # a failed run resumes after the last file loaded.
+    log.info(f'Found {len(records)} event files to load.')
 
-            # Current method has high memory requirements for large files, but unlikely to be
-            # multi-GB hourly unless it's a really busy Salesforce org.
-            reader = csv.DictReader(io.StringIO(result.text))
-            file_path = os.path.join(temp_dir, id + '.json')
-            with open(file_path, 'w') as f:
-                # This will create a single line JSON file containing an array of objects
-                json.dump(list(reader), f)
+    # downloads take a slot, in order, which is freed once the file is loaded
+    slots = threading.Semaphore(MAX_DOWNLOADED_FILES)
+    stopped = threading.Event()
 
-            if shutil.disk_usage("/").free < 2**30:
+    def claimed(records):
+        for record in records:
+            while not slots.acquire(timeout=0.1):
+                if stopped.is_set():
+                    return
+            if shutil.disk_usage(temp_dir).free < MIN_FREE_DISK_BYTES:
                 # running out of disk space, next run will catch up
-                break
+                log.info('Stopping downloads, low on disk space.')
+                return
+            yield record
 
-
-        # Copy all the staged .json files into the landing table
-        log.info(f'Uploading all files to Snowflake stage: {table_name}.')
-        db.copy_file_to_table_stage(table_name, os.path.join(temp_dir, '*.json'))
-        log.info(f'Upload successful, deleting all local files.')
+    total_files = 0
+    downloads = concurrently(
+        lambda r: (r, download_log_file(sf, r, temp_dir)), claimed(records), POOL_SIZE
+    )
+    try:
+        for record, (file_path, rows) in downloads:
+            # The table is configured to purge upon load from its stage, so we don't need to clean up
+            db.copy_file_to_table_stage(table_name, file_path)
+            db.load_from_table_stage(table_name, files=[os.path.basename(file_path)])
+            os.remove(file_path)
+            slots.release()
+            record_log_file(table_name, record, rows)
+            log.info(f'Loaded {rows} events from file {record["Id"]}.')
+            total_files += 1
+    finally:
+        stopped.set()
+        downloads.close()
         shutil.rmtree(temp_dir)
 
-        # The table is configured to purge upon load from its stage, so we don't need to clean up
-        log.info(f'Copying events into Snowflake table from staged files.')
-        db.load_from_table_stage(table_name)
-        log.info(f'Loaded {total_files} event files.')
-    else:
+    if total_files == 0:
         log.info(f'Skipping load as there are no new event files.')
 
     return total_files
@@ -4,12 +4,22 @@ Collect Tenable.io Data using a Service User’s API Key
 
 from datetime import datetime, timezone, timedelta
 import requests
+import time
 from tenable.io import TenableIO
 
 from runners.helpers import db, log
 from runners.helpers.dbconfig import ROLE as SA_ROLE
 
-from .utils import yaml_dump
+from .utils import (
+    InsertSink,
+    OffsetPages,
+    concurrently,
+    get_json,
+    get_pages,
+    http_get,
+    http_session,
+    yaml_dump,
+)
 
 CONNECTION_OPTIONS = [
     {
@@ -67,36 +77,194 @@ AGENT_LANDING_TABLE = [('raw', 'VARIANT'), ('export_at', 'TIMESTAMP_LTZ')]
 
 VULN_LANDING_TABLE = [('raw', 'VARIANT'), ('export_at', 'TIMESTAMP_LTZ')]
 
+# one row per export started, per chunk of it loaded, and per renewal of the
+# lease of the run loading it, which other runs leave the export to
+VULN_EXPORTS_TABLE = 'data.tenable_io_vuln_exports'
+VULN_EXPORTS_TABLE_COLUMNS = [
+    ('recorded_at', 'TIMESTAMP_LTZ'),
+    ('table_name', 'STRING(500)'),
+    ('export_uuid', 'STRING(100)'),
+    ('started_at', 'TIMESTAMP_LTZ'),
+    ('chunk_id', 'NUMBER'),
+    ('rows', 'NUMBER'),
+    ('leased_until', 'TIMESTAMP_LTZ'),
+]
+VULN_EXPORT_CHUNK_ASSETS = 100
+VULN_EXPORT_POOL_SIZE = 4
+VULN_EXPORT_POLL_SECONDS = 30
+VULN_EXPORT_LEASE = timedelta(minutes=30)
+
+# agents are listed SCANNER_POOL_SIZE scanners at a time
+AGENTS_PAGE_SIZE = 1000
+SCANNER_POOL_SIZE = 4
+
 TIO = None  # connection created in `ingest` below
 GET = None
 
 
-def ingest_vulns(table_name):
-    last_export_time = next(
-        db.fetch(f'SELECT MAX(export_at) AS time FROM data.{table_name}')
-    )['TIME']
-    now = datetime.now(timezone.utc)
+def create_vuln_exports_table():
+    db.create_table(
+        VULN_EXPORTS_TABLE, cols=VULN_EXPORTS_TABLE_COLUMNS, ifnotexists=True
+    )
+    db.execute(f'GRANT INSERT, SELECT ON {VULN_EXPORTS_TABLE} TO ROLE {SA_ROLE}')
 
-    if (
-        last_export_time is None
-        or (now - last_export_time) > timedelta(days=1)
-    ):
-        log.debug('TIO export vulns')
 
-        # insert empty row...
-        db.insert(f'data.{table_name}', [{'export_at': now}])
+def record_vuln_export(table_name, export_uuid, started_at, chunk_id=None, rows=None):
+    """records progress, renewing this run's lease on the export"""
+    recorded_at = datetime.now(timezone.utc)
+    leased_until = recorded_at + VULN_EXPORT_LEASE
+    db.insert(
+        VULN_EXPORTS_TABLE,
+        [
+            {
+                'recorded_at': recorded_at,
+                'table_name': table_name,
+                'export_uuid': export_uuid,
+                'started_at': started_at,
+                'chunk_id': chunk_id,
+                'rows': rows,
+                'leased_until': leased_until,
+            }
+        ],
+    )
+    return leased_until
 
-        # ...because this line takes awhile
-        vulns = TIO.exports.vulns()
 
-        rows = [{'raw': v, 'export_at': now} for v in vulns]
-        db.insert(f'data.{table_name}', rows)
-        return len(rows)
+def load_vuln_chunk(session, table_name, export_uuid, export_at, chunk_id):
+    vulns = get_json(
+        session,
+        f'https://cloud.tenable.com/vulns/export/{export_uuid}/chunks/{chunk_id}',
+    )
+    with InsertSink() as sink:
+        for v in vulns:
+            sink.add(f'data.{table_name}', {'raw': v, 'export_at': export_at})
+    record_vuln_export(table_name, export_uuid, export_at, chunk_id, len(vulns))
+    return len(vulns)
 
+
+def ingest_vulns(table_name, session):
+    create_vuln_exports_table()
+    now = datetime.now(timezone.utc)
+
+    # the latest export of this table, with its chunks loaded so far
+    export = next(
+        db.fetch(
+            f"""
+            SELECT export_uuid, started_at, MAX(leased_until) AS leased_until
+            FROM {VULN_EXPORTS_TABLE}
+            WHERE table_name='{table_name}'
+            GROUP BY export_uuid, started_at
+            ORDER BY started_at DESC
+            LIMIT 1
+            """
+        ),
+        None,
+    )
+    if export is None:
+        # connections exporting before progress was recorded
+        last_export_time = next(
+            db.fetch(f'SELECT MAX(export_at) AS time FROM data.{table_name}')
+        )['TIME']
     else:
+        last_export_time = export['STARTED_AT']
+        loaded_chunks = {
+            row['CHUNK_ID']
+            for row in db.fetch(
+                f"""
+                SELECT chunk_id
+                FROM {VULN_EXPORTS_TABLE}
+                WHERE export_uuid='{export['EXPORT_UUID']}' AND chunk_id IS NOT NULL
+                """
+            )
+        }
+        try:
+            status = http_get(
+                session,
+                f"https://cloud.tenable.com/vulns/export/{export['EXPORT_UUID']}/status",
+            ).json()
+        except requests.HTTPError as e:
+            # expired exports are no longer found, other errors are retried
+            # by the next run
+            if e.response is None or e.response.status_code != 404:
+                raise
+            status = {'status': 'ERROR'}
+
+        leased_until = export['LEASED_UNTIL']
+        if leased_until is not None and leased_until > now:
+            log.info(f"Tenable vulns export {export['EXPORT_UUID']} is leased")
+            return 0
+
+        if status['status'] in ('ERROR', 'CANCELLED'):
+            log.info(f"Tenable vulns export {export['EXPORT_UUID']} failed, restarting")
+            last_export_time = None
+
+        elif status['status'] != 'FINISHED' or (
+            set(status['chunks_available']) - loaded_chunks
+        ):
+            log.info(f"resuming Tenable vulns export {export['EXPORT_UUID']}")
+            return load_vuln_export(
+                session,
+                table_name,
+                export['EXPORT_UUID'],
+                last_export_time,
+                loaded_chunks,
+            )
+
+    if last_export_time is not None and (now - last_export_time) <= timedelta(days=1):
         log.info('Not time to import Tenable vulnerabilities yet')
         return 0
 
+    log.debug('TIO export vulns')
+    response = session.post(
+        'https://cloud.tenable.com/vulns/export',
+        json={'num_assets': VULN_EXPORT_CHUNK_ASSETS},
+    )
+    response.raise_for_status()
+    export_uuid = response.json()['export_uuid']
+
+    # recorded before loading, so runs during the export resume it
+    record_vuln_export(table_name, export_uuid, now)
+    return load_vuln_export(session, table_name, export_uuid, now, set())
+
+
+def load_vuln_export(session, table_name, export_uuid, export_at, loaded_chunks):
+    """loads chunks in parallel as the export makes them available"""
+    num_rows = 0
+    leased_until = None
+    while True:
+        if leased_until is None or (
+            datetime.now(timezone.utc) > leased_until - VULN_EXPORT_LEASE / 2
+        ):
+            leased_until = record_vuln_export(table_name, export_uuid, export_at)
+
+        status = http_get(
+            session, f'https://cloud.tenable.com/vulns/export/{export_uuid}/status'
+        ).json()
+        if status['status'] in ('ERROR', 'CANCELLED'):
+            log.error(f'Tenable vulns export {export_uuid}', status['status'])
+            return num_rows
+
+        new_chunks = sorted(set(status['chunks_available']) - loaded_chunks)
+        for chunk_id, rows in zip(
+            new_chunks,
+            concurrently(
+                lambda chunk_id: load_vuln_chunk(
+                    session, table_name, export_uuid, export_at, chunk_id
+                ),
+                new_chunks,
+                VULN_EXPORT_POOL_SIZE,
+            ),
+        ):
+            loaded_chunks.add(chunk_id)
+            num_rows += rows
+
+        if status['status'] == 'FINISHED' and not new_chunks:
+            log.info(f'loaded {len(loaded_chunks)} chunks, {num_rows} vulns')
+            return num_rows
+
+        if not new_chunks:
+            time.sleep(VULN_EXPORT_POLL_SECONDS)
+
 
 def ingest_users(table_name):
     users = TIO.users.list()
@@ -150,10 +318,18 @@ def ingest_users(table_name):
 def get_agent_data():
     scanners = list(GET('scanners'))
     log.debug(f'got {len(scanners)} scanners')
-    for s in scanners:
+
+    def get_scanner_agents(s):
         sid = s['id']
-        agents = list(GET(f'scanners/{sid}/agents', 'agents', 5000))
+        try:
+            agents = list(GET(f'scanners/{sid}/agents', 'agents', AGENTS_PAGE_SIZE))
+        except requests.HTTPError as e:
+            log.info(f'skipping scanner {sid}: {e}')
+            return []
         log.debug(f'scanner {sid} has {len(agents)} agents')
+        return agents
+
+    for agents in concurrently(get_scanner_agents, scanners, SCANNER_POOL_SIZE):
         yield from agents
 
 
@@ -167,9 +343,14 @@ def ingest_agents(table_name, options):
         last_export_time is None
         or (timestamp - last_export_time).total_seconds() > 86400
     ):
-        all_agents = sorted(get_agent_data(), key=lambda a: a.get('last_connect', 0))
-        unique_agents = {a['uuid']: a for a in all_agents}.values()
-        rows = [{'raw': ua, 'export_at': timestamp} for ua in unique_agents]
+        # keeps the most recently connected agent of each uuid
+        unique_agents: dict = {}
+        for a in get_agent_data():
+            seen = unique_agents.get(a['uuid'])
+            if seen is None or a.get('last_connect', 0) >= seen.get('last_connect', 0):
+                unique_agents[a['uuid']] = a
+
+        rows = [{'raw': ua, 'export_at': timestamp} for ua in unique_agents.values()]
         log.debug(f'inserting {len(unique_agents)} unique (by uuid) agents')
         db.insert(f'data.{table_name}', rows)
         return len(rows)
@@ -205,35 +386,27 @@ def ingest(table_name, options):
 
     TIO = TenableIO(token, secret)
 
-    def GET(resource, key=None, limit=100, offset=0):
+    session = http_session(
+        headers={"X-ApiKeys": f"accessKey={token}; secretKey={secret}"},
+        pool_size=16,
+    )
+
+    def GET(resource, key=None, limit=100):
         if key is None:
             key = resource
-        log.debug(f'GET {resource} limit={limit} offset={offset}')
-        response = requests.get(
-            url=f'https://cloud.tenable.com/{resource}',
-            params={'limit': limit, 'offset': offset},
-            headers={"X-ApiKeys": f"accessKey={token}; secretKey={secret}"},
+        pagination = OffsetPages(
+            limit, total=lambda result: result.get('pagination', {}).get('total', 0)
         )
-        if response.status_code != 200:
-            log.info(f'response status {response.status_code}: {response.text}')
-            return
-
-        result = response.json()
-        elements = result.get(key)
-
-        if elements is None:
-            log.error(f'no {key} in :', result)
-            return
-
-        yield from elements
+        for result in get_pages(
+            session, f'https://cloud.tenable.com/{resource}', pagination=pagination
+        ):
+            elements = result.get(key)
 
-        pages = result.get('pagination', {})
-        total = pages.get('total', 0)
-        limit = pages.get('limit', 0)
-        offset = pages.get('offset', 0)
+            if elements is None:
+                log.error(f'no {key} in :', result)
+                return
 
-        if total > limit + offset:
-            yield from GET(resource, key, limit, offset + limit)
+            yield from elements
 
     if table_name.endswith('_USER_CONNECTION'):
         return ingest_users(table_name)
@@ -242,4 +415,4 @@ def ingest(table_name, options):
         return ingest_agents(table_name, options)
 
     elif table_name.endswith('_VULN_CONNECTION'):
-        return ingest_vulns(table_name)
+        return ingest_vulns(table_name, session)
@@ -1,10 +1,20 @@
+import asyncio
 from collections import namedtuple
 from datetime import datetime
+import pytest
 
 from botocore.exceptions import BotoCoreError
 
-from connectors.aws_collect import process_aws_response, DBEntry, CollectTask
-
+from connectors import aws_collect
+from connectors.aws_collect import (
+    process_aws_response,
+    DBEntry,
+    CollectTask,
+    SnapshotDiff,
+    collect_tasks,
+    entity_hash,
+)
+from connectors.utils import AioInsertSink
 
 Sample = namedtuple('Sample', ['task', 'response', 'entities', 'subrequests'])
 
@@ -214,3 +224,74 @@ def test_process_aws_response():
                 child_requests.append(r)
         assert sample.entities == db_entries
         assert sample.subrequests == child_requests
+
+
+def test_snapshot_diff():
+    unchanged = {'account_id': '1', 'user_name': 'a'}
+    changed = {'account_id': '1', 'user_name': 'b', 'tags': ['x']}
+    deleted = {'account_id': '1', 'user_name': 'c'}
+    unreadable = {'account_id': '2', 'user_name': 'd'}
+    failed = {'account_id': '3', 'user_name': 'e'}
+    uncollected = {'account_id': '1', 'role_name': 'f'}
+    diff = SnapshotDiff(
+        {
+            ('iam_list_users', '1'): {
+                entity_hash(e) for e in [unchanged, changed, deleted]
+            },
+            ('iam_list_users', '2'): {entity_hash(unreadable)},
+            ('iam_list_users', '3'): {entity_hash(failed)},
+            ('iam_list_roles', '1'): {entity_hash(uncollected)},
+        }
+    )
+
+    assert not diff.is_changed(
+        'iam.list_users', dict(unchanged, recorded_at=datetime.now())
+    )
+    landed = dict(changed, tags=['y'])
+    assert diff.is_changed('iam.list_users', landed)
+    assert not diff.is_changed('iam.list_users', dict(changed, tags=['y']))
+    # not inserted, so not recorded and landed again next run
+    assert diff.is_changed('iam.list_users', {'account_id': '1', 'user_name': 'g'})
+    diff.inserted('iam.list_users', [landed])
+    diff.task_done(CollectTask('1', 'iam.list_users', {}))
+    assert diff.is_changed(
+        'iam.list_users', {'account_id': '2', 'error': {'message': 'AccessDenied'}}
+    )
+    diff.task_done(CollectTask('2', 'iam.list_users', {}))
+    diff.task_done(CollectTask('3', 'iam.list_users', {}), failed=True)
+
+    changes = sorted(
+        (r['table_name'], r['account_id'], r['change'], r['entity_hash'])
+        for r in diff.hash_rows()
+    )
+    assert changes == sorted(
+        [
+            ('iam_list_users', '1', 'present', entity_hash(unchanged)),
+            ('iam_list_users', '1', 'new', entity_hash(dict(changed, tags=['y']))),
+            ('iam_list_users', '1', 'deleted', entity_hash(changed)),
+            ('iam_list_users', '1', 'deleted', entity_hash(deleted)),
+            ('iam_list_users', '2', 'present', entity_hash(unreadable)),
+            ('iam_list_users', '3', 'present', entity_hash(failed)),
+        ]
+    )
+
+
+def test_collect_tasks_raises_failed_inserts(monkeypatch):
+    async def process_task(task, add_task):
+        for i in range(3):
+            yield task.method, {'account_id': task.account_id, 'i': i}
+
+    def insert(table, rows):
+        raise RuntimeError('insert failed')
+
+    monkeypatch.setattr(aws_collect, 'process_task', process_task)
+
+    async def collect():
+        tasks: asyncio.Queue = asyncio.Queue()
+        for account_id in range(10):
+            tasks.put_nowait(CollectTask(str(account_id), 'iam.list_users', {}))
+        async with AioInsertSink(insert, max_rows=2) as sink:
+            await collect_tasks(tasks, sink)
+
+    with pytest.raises(RuntimeError, match='insert failed'):
+        asyncio.get_event_loop().run_until_complete(collect())
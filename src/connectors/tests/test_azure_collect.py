@@ -0,0 +1,185 @@
+import asyncio
+from collections import defaultdict
+import json
+import time
+
+import pytest
+import xmltodict
+
+from connectors import azure_collect
+from connectors.azure_collect import (
+    RESPONSE_PLANS,
+    decode_values,
+    projection,
+    request,
+    response_values,
+)
+
+
+def test_response_values():
+    assert response_values(['value'], {'value': [{'a': 1}]}) == [{'a': 1}]
+    assert response_values(['value'], {'value': []}) == [{}]
+    assert response_values(['value'], {'error': {'code': 'X'}}) == [
+        {'error': {'code': 'X'}}
+    ]
+
+    xml = '''<?xml version="1.0" encoding="utf-8"?>
+<EnumerationResults><Containers>
+  <Container><Name>a</Name></Container>
+  <Container><Name>b</Name></Container>
+</Containers><NextMarker /></EnumerationResults>'''
+    path, _ = RESPONSE_PLANS['storage_accounts_containers']
+    assert response_values(path, xmltodict.parse(xml, dict_constructor=dict)) == [
+        {'Name': 'a'},
+        {'Name': 'b'},
+    ]
+
+
+def test_projection():
+    project = projection({'id': 'id', 'error': 'error', '*': 'raw'})
+    value = {'id': 'x', 'other': 1}
+    assert project(value) == {'id': 'x', 'error': None, 'raw': value}
+
+    project = projection({'id': 'id', 'error': 'error'})
+    assert project({'id': 'x'}) == {'id': 'x', 'error': None}
+    with pytest.raises(KeyError):
+        project({'id': 'x', 'other': 1})
+
+
+def test_decode_values():
+    def decode(body, value_path=['value']):
+        return decode_values(body.encode(), value_path, lambda v: v, 200)
+
+    page = {
+        '@odata.context': 'x',
+        'value': [{'id': 'é', 'n': 12345, 'a': [1, {'b': None}]}, {'id': '"}'}],
+        'nextLink': 'https://next',
+    }
+    for body in [json.dumps(page), '{"value": []}', '{"id": "single"}', '{}']:
+        expected = json.loads(body)
+        assert decode(body) == (expected, response_values(['value'], expected))
+
+    result, values = decode('<html>oops</html>')
+    assert values == [
+        {
+            'error': {
+                'type': 'JSONDecodeError',
+                'status_code': 200,
+                'response_text': '<html>oops</html>',
+            }
+        }
+    ]
+
+    xml = '<?xml version="1.0"?><A><B><C>1</C><C>2</C></B></A>'
+    assert decode(xml, ['A', 'B', 'C'])[1] == ['1', '2']
+
+
+def test_decode_large_values():
+    values = [
+        {'id': f'/subscriptions/s/vm{i}', 'properties': {'n': i}} for i in range(50000)
+    ]
+    for value_path, page in [
+        (['value'], {'value': values}),
+        (['properties', 'items'], {'properties': {'items': values}}),
+    ]:
+        body = json.dumps(page).encode()
+        assert len(body) > 2 * 1024 * 1024
+
+        start = time.monotonic()
+        result, decoded = decode_values(body, value_path, lambda v: v, 200)
+        assert time.monotonic() - start < 2
+        assert decoded == values
+
+
+def test_ingest_pages_and_failed_calls(monkeypatch):
+    subscriptions = [[{'subscription_id': f's{p}{i}'} for i in range(3)] for p in '12']
+
+    async def GET(session, concurrency, kind, params, cred, depth):
+        if kind == 'subscriptions':
+            for page in subscriptions:
+                yield page
+        elif params['subscriptionId'] == 's11':
+            raise KeyError('properties')
+        else:
+            for n in range(2):
+                yield [{'id': f'{params["subscriptionId"]}/vm{n}'}]
+
+    inserted = defaultdict(list)
+
+    def insert(table, rows, dryrun):
+        inserted['vms' if table.endswith('virtual_machines') else 'subs'] += rows
+        return {'number of rows inserted': len(rows)}
+
+    monkeypatch.setattr(azure_collect, 'GET', GET)
+    monkeypatch.setattr(azure_collect, 'MAX_QUEUED_CALLS', 1)
+    monkeypatch.setattr(azure_collect.db, 'insert', insert)
+
+    num_inserted = azure_collect.ingest(
+        'azure_collect',
+        {
+            'name': 'default',
+            'apis': 'subscriptions.virtual_machines',
+            'credentials': [{'tenant': 't', 'client': 'c', 'secret': 's'}],
+        },
+    )
+
+    assert len(inserted['subs']) == 6
+    vms = inserted['vms']
+    assert num_inserted == len(vms) + 6 == 5 * 2 + 1 + 6
+    (failed,) = [v for v in vms if v.get('error')]
+    assert failed['error']['type'] == 'KeyError'
+    assert failed['subscription_id'] == 's11'
+
+
+class FakeResponse:
+    def __init__(self, status, headers):
+        self.status = status
+        self.headers = headers
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+
+def test_retry_after_holds_back_subscription():
+    sent = []
+
+    class Session:
+        def get(self, url, headers):
+            sent.append((url, time.monotonic()))
+            if url == 'https://h/vms' and len(sent) == 1:
+                return FakeResponse(429, {'Retry-After': '0.2'})
+            return FakeResponse(200, {})
+
+    async def decode(response):
+        return response.status
+
+    async def both():
+        concurrency = asyncio.Semaphore(10)
+        vms = asyncio.ensure_future(
+            request(
+                Session(),
+                concurrency,
+                ('virtual_machines', 's1'),
+                'https://h/vms',
+                {},
+                decode,
+            )
+        )
+        await asyncio.sleep(0.05)
+        disks = await request(
+            Session(), concurrency, ('disks', 's1'), 'https://h/disks', {}, decode
+        )
+        return await vms, disks
+
+    start = time.monotonic()
+    (vms, _, _), (disks, _, _) = asyncio.get_event_loop().run_until_complete(both())
+    assert vms == disks == 200
+    assert sorted(url for url, _ in sent) == [
+        'https://h/disks',
+        'https://h/vms',
+        'https://h/vms',
+    ]
+    assert all(t - start >= 0.19 for _, t in sent[1:])
@@ -0,0 +1,18 @@
+from types import SimpleNamespace
+
+from connectors import crowdstrike_devices
+from connectors.crowdstrike_devices import TokenAuth
+
+
+def test_token_auth_refreshes_before_expiry(monkeypatch):
+    credentials = [
+        {'access_token': 'a', 'expires_in': 100},
+        {'access_token': 'b', 'expires_in': 1799},
+    ]
+    monkeypatch.setattr(
+        crowdstrike_devices, 'get_credential', lambda id, secret: credentials.pop(0)
+    )
+
+    auth = TokenAuth('id', 'secret')
+    tokens = [auth(SimpleNamespace(headers={})).headers['Authorization'] for i in '123']
+    assert tokens == ['Bearer a', 'Bearer b', 'Bearer b']
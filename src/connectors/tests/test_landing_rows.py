@@ -0,0 +1,45 @@
+from datetime import datetime
+
+import pytest
+
+from connectors import (
+    airwatch_devices,
+    assetpanda,
+    cisco_umbrella,
+    crowdstrike_devices,
+    meraki_devices,
+)
+from runners.helpers import db
+
+NOW = datetime.utcnow()
+
+
+@pytest.mark.parametrize(
+    'row, columns',
+    [
+        (
+            airwatch_devices.device_row(NOW, {}),
+            airwatch_devices.LANDING_TABLE_COLUMNS_DEVICE,
+        ),
+        (
+            airwatch_devices.custom_attributes_row(NOW, {}),
+            airwatch_devices.LANDING_TABLE_COLUMNS_CUSTOM_ATTRIBUTES,
+        ),
+        (assetpanda.asset_row({}, NOW), assetpanda.LANDING_TABLE_COLUMNS),
+        (cisco_umbrella.device_row(NOW, {}), cisco_umbrella.LANDING_TABLE_COLUMNS),
+        (
+            crowdstrike_devices.device_row(NOW, {}),
+            crowdstrike_devices.LANDING_TABLE_COLUMNS,
+        ),
+        (
+            meraki_devices.device_row(NOW, {}),
+            meraki_devices.LANDING_TABLE_COLUMNS_DEVICE,
+        ),
+        (
+            meraki_devices.client_row(NOW, {}, 'Q2XX'),
+            meraki_devices.LANDING_TABLE_COLUMNS_CLIENT,
+        ),
+    ],
+)
+def test_rows_fit_landing_table(row, columns):
+    assert len(row) == len(list(db.derive_insert_columns(columns)))
@@ -0,0 +1,96 @@
+import requests
+
+from connectors import okta
+from connectors.utils import LinkPages
+
+
+class Response:
+    def __init__(self, status_code, body, next_url=None):
+        self.status_code = status_code
+        self.body = body
+        self.links = {'next': {'url': next_url}} if next_url else {}
+        self.text = str(body)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} Error', response=self)
+
+    def json(self):
+        return self.body
+
+
+class Session:
+    def __init__(self, responses):
+        self.responses = responses
+        self.requests = []
+
+    def get(self, url, params=None):
+        self.requests.append((url, params))
+        return self.responses.pop(0)
+
+
+class CountingRateLimit:
+    def __init__(self):
+        self.waits = 0
+
+    def wait(self):
+        self.waits += 1
+
+
+def test_get_group_users_follows_links_and_records_errors():
+    group = {'id': 'g', '_links': {'users': {'href': 'https://o/g/users'}}}
+    rate_limit = CountingRateLimit()
+    session = Session(
+        [
+            Response(200, [1, 2], next_url='https://o/g/users?after=2'),
+            Response(200, [3]),
+        ]
+    )
+    assert okta.get_group_users(session, LinkPages(rate_limit), group) == [1, 2, 3]
+    assert session.requests == [
+        ('https://o/g/users', {}),
+        ('https://o/g/users?after=2', None),
+    ]
+    assert rate_limit.waits == 2
+    assert 'users_error' not in group
+
+    session = Session(
+        [Response(200, [1], 'https://o/g/users?after=1'), Response(403, {})]
+    )
+    assert okta.get_group_users(session, LinkPages(), group) is None
+    assert group['users_error']['status_code'] == 403
+
+
+def test_ingest_logs_batches_and_saves_cursor(monkeypatch):
+    inserts = []
+    monkeypatch.setattr(okta, 'LOG_BATCH_SIZE', 3)
+    monkeypatch.setattr(okta, 'create_log_cursors_table', lambda: None)
+    monkeypatch.setattr(okta, 'load_log_cursor', lambda table: 'https://o/logs?after=0')
+    monkeypatch.setattr(
+        okta.db,
+        'insert',
+        lambda table, values, **kwargs: inserts.append((table, values)),
+    )
+
+    def row(i):
+        return {'uuid': i, 'published': f'2020-01-01T00:00:0{i}Z'}
+
+    session = Session(
+        [
+            Response(200, [row(1), row(2)], 'https://o/logs?after=2'),
+            Response(200, [row(3), row(4)], 'https://o/logs?after=4'),
+            Response(200, [row(5)], 'https://o/logs?after=5'),
+            Response(200, [], 'https://o/logs?after=5'),
+        ]
+    )
+
+    assert list(okta.ingest_logs(session, 'https://o/logs', 'data.okta')) == [4, 1]
+    assert session.requests[0] == ('https://o/logs?after=0', None)
+    assert [(t, len(v)) for t, v in inserts] == [
+        ('data.okta', 4),
+        (okta.LOG_CURSORS_TABLE, 1),
+        ('data.okta', 1),
+        (okta.LOG_CURSORS_TABLE, 1),
+    ]
+    assert inserts[1][1][0]['next_url'] == 'https://o/logs?after=4'
+    assert inserts[3][1][0]['next_url'] == 'https://o/logs?after=5'
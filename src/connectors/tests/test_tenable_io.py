@@ -0,0 +1,148 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+import requests
+
+from connectors import tenable_io
+
+
+class Response:
+    def __init__(self, body, status_code=200):
+        self.body = body
+        self.status_code = status_code
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(response=self)
+
+    def json(self):
+        return self.body
+
+
+class Session:
+    def __init__(self, statuses):
+        self.statuses = statuses
+
+    def get(self, url, params=None):
+        status = self.statuses.pop(0)
+        return status if type(status) is Response else Response(status)
+
+
+def test_load_vuln_export_resumes_and_polls(monkeypatch):
+    loaded = []
+
+    def load_chunk(session, table_name, export_uuid, export_at, chunk_id):
+        loaded.append(chunk_id)
+        return 10
+
+    monkeypatch.setattr(tenable_io, 'load_vuln_chunk', load_chunk)
+    monkeypatch.setattr(tenable_io, 'VULN_EXPORT_POLL_SECONDS', 0)
+    monkeypatch.setattr(
+        tenable_io,
+        'record_vuln_export',
+        lambda *args: datetime.now(timezone.utc) + timedelta(minutes=30),
+    )
+
+    session = Session(
+        [
+            {'status': 'PROCESSING', 'chunks_available': [1, 2]},
+            {'status': 'PROCESSING', 'chunks_available': [1, 2]},
+            {'status': 'FINISHED', 'chunks_available': [1, 2, 3, 4]},
+            {'status': 'FINISHED', 'chunks_available': [1, 2, 3, 4]},
+        ]
+    )
+    num_rows = tenable_io.load_vuln_export(session, 't', 'uuid', None, {1})
+    assert sorted(loaded) == [2, 3, 4]
+    assert num_rows == 30
+    assert session.statuses == []
+
+
+def test_ingest_vulns_leaves_leased_exports_and_restarts_failed_ones(monkeypatch):
+    now = datetime.now(timezone.utc)
+    export = {
+        'EXPORT_UUID': 'uuid',
+        'STARTED_AT': now - timedelta(hours=1),
+        'LEASED_UNTIL': now + timedelta(minutes=10),
+    }
+    monkeypatch.setattr(tenable_io, 'create_vuln_exports_table', lambda: None)
+    monkeypatch.setattr(
+        tenable_io.db,
+        'fetch',
+        lambda query: iter([export] if 'GROUP BY' in query else [{'CHUNK_ID': 1}]),
+    )
+    monkeypatch.setattr(
+        tenable_io, 'load_vuln_export', lambda *args: pytest.fail('loaded')
+    )
+
+    session = Session([{'status': 'PROCESSING', 'chunks_available': [1, 2]}])
+    assert tenable_io.ingest_vulns('t', session) == 0
+
+    started = []
+    monkeypatch.setattr(
+        tenable_io,
+        'record_vuln_export',
+        lambda table_name, export_uuid, started_at: started.append(export_uuid),
+    )
+    monkeypatch.setattr(
+        tenable_io,
+        'load_vuln_export',
+        lambda session, table_name, export_uuid, export_at, loaded: 5,
+    )
+    # failed exports are left to the run leasing them
+    session = Session([{'status': 'ERROR'}])
+    assert tenable_io.ingest_vulns('t', session) == 0
+
+    export['LEASED_UNTIL'] = now - timedelta(minutes=1)
+    for status in [{'status': 'ERROR'}, Response({}, 404)]:
+        session = Session([status])
+        session.post = lambda url, json: Response({'export_uuid': 'uuid2'})
+        assert tenable_io.ingest_vulns('t', session) == 5
+    assert started == ['uuid2', 'uuid2']
+
+    # other errors don't restart finished exports ahead of time
+    session = Session([Response({}, 503)])
+    session.post = lambda url, json: pytest.fail('restarted')
+    with pytest.raises(requests.HTTPError):
+        tenable_io.ingest_vulns('t', session)
+
+
+def test_ingest_agents_keeps_latest_connect_per_uuid(monkeypatch):
+    inserts = []
+    monkeypatch.setattr(tenable_io.db, 'fetch', lambda query: iter([{'TIME': None}]))
+    monkeypatch.setattr(
+        tenable_io.db, 'insert', lambda table, values: inserts.append(values)
+    )
+    monkeypatch.setattr(
+        tenable_io,
+        'get_agent_data',
+        lambda: iter(
+            [
+                {'uuid': 'a', 'last_connect': 2, 'scanner': 1},
+                {'uuid': 'b', 'last_connect': 1, 'scanner': 1},
+                {'uuid': 'a', 'last_connect': 1, 'scanner': 2},
+                {'uuid': 'b', 'last_connect': 3, 'scanner': 2},
+            ]
+        ),
+    )
+
+    assert tenable_io.ingest_agents('tenable_io_agents', {}) == 2
+    assert sorted((r['raw']['uuid'], r['raw']['scanner']) for r in inserts[0]) == [
+        ('a', 1),
+        ('b', 2),
+    ]
+
+
+def test_get_agent_data_skips_failing_scanners(monkeypatch):
+    def GET(resource, key=None, limit=100):
+        if resource == 'scanners':
+            yield from [{'id': 1}, {'id': 2}, {'id': 3}]
+        elif resource == 'scanners/2/agents':
+            raise requests.HTTPError('403 Client Error')
+        else:
+            yield {'uuid': resource}
+
+    monkeypatch.setattr(tenable_io, 'GET', GET)
+    assert sorted(a['uuid'] for a in tenable_io.get_agent_data()) == [
+        'scanners/1/agents',
+        'scanners/3/agents',
+    ]
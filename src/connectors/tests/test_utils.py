@@ -0,0 +1,304 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import json
+import pytest
+import time
+
+from connectors import utils
+from connectors.utils import (
+    TokenBucket,
+    KeyedTokenBuckets,
+    CircuitBreaker,
+    InsertSink,
+    AioInsertSink,
+)
+
+
+def test_token_bucket_paces_after_burst():
+    bucket = TokenBucket(rate=100, capacity=5)
+
+    async def take(n):
+        for _ in range(n):
+            await bucket.acquire()
+
+    start = time.monotonic()
+    asyncio.get_event_loop().run_until_complete(take(15))
+    # 5 from the burst, then 10 more at 100/s
+    assert 0.08 < time.monotonic() - start < 0.5
+
+
+def test_token_bucket_aimd():
+    bucket = TokenBucket(rate=10, capacity=10, increase=1)
+    bucket.throttled()
+    assert bucket.rate == 5
+    assert bucket.tokens == 0
+    bucket.succeeded()
+    assert bucket.rate == 6
+    for _ in range(10):
+        bucket.succeeded()
+    assert bucket.rate == 10
+    for _ in range(10):
+        bucket.throttled()
+    assert bucket.rate == bucket.min_rate == 0.5
+
+
+def test_token_bucket_defer():
+    bucket = TokenBucket(rate=100, capacity=5)
+    bucket.defer(0.1)
+
+    start = time.monotonic()
+    asyncio.get_event_loop().run_until_complete(bucket.acquire())
+    assert 0.1 < time.monotonic() - start < 0.3
+
+
+def test_circuit_breaker():
+    breaker = CircuitBreaker(max_failures=2, timeout=0.05)
+    breaker.failed()
+    assert not breaker.is_open
+    breaker.failed()
+    assert breaker.is_open
+    assert breaker.timeout == 0.1
+
+    start = time.monotonic()
+    asyncio.get_event_loop().run_until_complete(breaker.wait())
+    assert 0.04 < time.monotonic() - start < 0.3
+
+    # half-open: a single failure re-opens it
+    breaker.failed()
+    assert breaker.is_open
+    breaker.succeeded()
+    assert breaker.timeout == 0.05
+    breaker.open_until = 0
+    breaker.failed()
+    assert not breaker.is_open
+
+
+def test_keyed_token_buckets():
+    buckets = KeyedTokenBuckets(
+        default=(1, 2), limits={'ec2': (20, 100)}, key_prefix=lambda k: k[2]
+    )
+    assert buckets[('1', 'us-east-1', 'ec2')].capacity == 100
+    assert buckets[('1', None, 'iam')].capacity == 2
+    assert buckets[('1', None, 'iam')] is buckets[('1', None, 'iam')]
+    assert buckets[('2', None, 'iam')] is not buckets[('1', None, 'iam')]
+
+
+def test_aio_sts_assume_role_single_flight(monkeypatch):
+    assumed = []
+
+    async def assume_role(session, role_arn, external_id=None):
+        assumed.append(role_arn)
+        await asyncio.sleep(0.01)
+        return (datetime.now(timezone.utc) + timedelta(hours=1), object())
+
+    monkeypatch.setattr(utils, 'aio_assume_role', assume_role)
+    monkeypatch.setattr(utils, '_AIO_STS_SESSIONS', {})
+
+    sessions = asyncio.get_event_loop().run_until_complete(
+        asyncio.gather(
+            *[utils.aio_sts_assume_role('src', f'dest{i % 2}') for i in range(10)]
+        )
+    )
+
+    assert sorted(assumed) == ['dest0', 'dest1', 'src']
+    assert len(set(map(id, sessions))) == 2
+
+
+def test_insert_sink_flushes_by_rows_and_bytes():
+    inserts = []
+    with InsertSink(lambda t, rows: inserts.append((t, len(rows))), 3, 100) as sink:
+        for i in range(7):
+            sink.add('a', {'i': i})
+        sink.add('b', {'x': 'x' * 200})
+        sink.add('b', {'x': 'y'})
+    assert inserts == [('a', 3), ('a', 3), ('b', 1), ('a', 1), ('b', 1)]
+    assert sink.num_inserted == 9
+
+
+def test_aio_insert_sink_limits_pending_inserts():
+    pending = []
+
+    def insert(table, rows):
+        pending.append(table)
+        assert len(pending) <= 2
+        time.sleep(0.01)
+        pending.remove(table)
+
+    async def produce():
+        async with AioInsertSink(insert, max_rows=2, max_pending=2) as sink:
+            for i in range(20):
+                await sink.add(str(i % 3), {'i': i})
+        return sink.num_inserted
+
+    assert asyncio.get_event_loop().run_until_complete(produce()) == 20
+
+
+def test_aio_insert_sink_raises_failed_inserts():
+    def insert(table, rows):
+        if rows[0]['i'] == 0:
+            raise ValueError('bad rows')
+
+    async def produce():
+        sink = AioInsertSink(insert, max_rows=1)
+        await sink.add('a', {'i': 0})
+        await asyncio.sleep(0.05)
+        with pytest.raises(ValueError):
+            await sink.add('a', {'i': 1})
+        await sink.add('a', {'i': 2})
+        await sink.close()
+        return sink.num_inserted
+
+    assert asyncio.get_event_loop().run_until_complete(produce()) == 1
+
+
+def test_azure_access_token_cache(monkeypatch, tmp_path):
+    fetched = []
+
+    def fetch(cloud, client_id, tenant, secret, resource):
+        fetched.append(resource)
+        time.sleep(0.01)
+        return {
+            'access_token': f'token{len(fetched)}',
+            'expires_on': time.time() + 3600,
+        }
+
+    monkeypatch.setattr(utils, 'fetch_azure_token', fetch)
+    monkeypatch.setattr(utils, 'AZURE_TOKEN_CACHE_DIR', str(tmp_path))
+    tmp_path.chmod(0o700)
+    monkeypatch.setattr(utils, '_AZURE_TOKENS', {})
+
+    args = ('azure', 'client', 'tenant', 'secret', 'https://graph.microsoft.com')
+    with ThreadPoolExecutor(8) as pool:
+        tokens = list(pool.map(lambda _: utils.azure_access_token(*args), range(8)))
+    assert tokens == ['token1'] * 8
+    assert len(fetched) == 1
+
+    # a fresh process reads the token from its file
+    monkeypatch.setattr(utils, '_AZURE_TOKENS', {})
+    assert utils.azure_access_token(*args) == 'token1'
+    assert len(fetched) == 1
+    for cache_file in tmp_path.iterdir():
+        assert cache_file.stat().st_mode & 0o777 == 0o600
+    (token_file,) = [p for p in tmp_path.iterdir() if not p.name.endswith('.lock')]
+
+    # and refreshes it once it is about to expire
+    token_file.write_text(
+        json.dumps({'access_token': 'old', 'expires_on': time.time()})
+    )
+    monkeypatch.setattr(utils, '_AZURE_TOKENS', {})
+    assert utils.azure_access_token(*args) == 'token2'
+
+    # a cache directory others can read is refused
+    tmp_path.chmod(0o755)
+    monkeypatch.setattr(utils, '_AZURE_TOKENS', {})
+    with pytest.raises(PermissionError):
+        utils.azure_access_token(*args)
+
+
+def test_prefetched():
+    produced = []
+
+    def items():
+        for i in range(10):
+            produced.append(i)
+            yield i
+
+    it = utils.prefetched(items(), depth=2)
+    assert next(it) == 0
+    time.sleep(0.05)
+    # 1 and 2 are queued, 3 waits for room
+    assert produced == [0, 1, 2, 3]
+    assert list(it) == list(range(1, 10))
+
+    def failing():
+        yield 1
+        raise ValueError('x')
+
+    it = utils.prefetched(failing())
+    assert next(it) == 1
+    with pytest.raises(ValueError):
+        next(it)
+
+
+class FakeResponse:
+    def __init__(self, body, next_url=None):
+        self.body = body
+        self.links = {'next': {'url': next_url}} if next_url else {}
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.body
+
+
+class FakeSession:
+    def __init__(self, respond):
+        self.respond = respond
+        self.requests = []
+
+    def get(self, url, params=None):
+        self.requests.append((url, params))
+        return FakeResponse(*self.respond(url, params or {}))
+
+
+def test_offset_pages_with_total():
+    items = list(range(23))
+    session = FakeSession(
+        lambda url, p: (
+            {'total': 23, 'items': items[p['offset'] : p['offset'] + p['limit']]},
+        )
+    )
+    pages = utils.get_pages(
+        session,
+        'https://x',
+        {'q': 1},
+        utils.OffsetPages(10, total=lambda page: page['total']),
+    )
+    assert [i for page in pages for i in page['items']] == items
+    assert sorted(p['offset'] for _, p in session.requests) == [0, 10, 20]
+    assert all(p['q'] == 1 and p['limit'] == 10 for _, p in session.requests)
+
+
+def test_page_numbers_until_empty():
+    items = list(range(7))
+    session = FakeSession(lambda url, p: (items[(p['page'] - 1) * 2 :][:2],))
+    pages = utils.get_pages(
+        session, 'https://x', pagination=utils.PageNumbers(2), pool_size=3
+    )
+    assert [i for page in pages for i in page] == items
+    # pages 1-4 hold items, then a window of 3 finds page 5 empty
+    assert len(session.requests) == 7
+
+
+def test_cursor_and_link_pages():
+    session = FakeSession(
+        lambda url, p: (
+            {
+                'items': [p['after']] if p['after'] < 3 else [],
+            },
+        )
+    )
+    cursor = utils.CursorPages(
+        'after',
+        next_cursor=lambda page: page['items'] and page['items'][0] + 1,
+        items=lambda page: page['items'],
+    )
+    pages = utils.get_pages(session, 'https://x', {'after': 0}, cursor)
+    assert [page['items'] for page in pages] == [[0], [1], [2], []]
+
+    links = {'https://x': 'https://x?2', 'https://x?2': None}
+    session = FakeSession(lambda url, p: ([url], links[url]))
+    pages = utils.get_pages(session, 'https://x', {'a': 1}, utils.LinkPages())
+    assert list(pages) == [['https://x'], ['https://x?2']]
+    assert session.requests == [('https://x', {'a': 1}), ('https://x?2', None)]
+
+
+def test_rate_limit_spaces_threads():
+    rate_limit = utils.RateLimit(50)
+    start = time.monotonic()
+    with ThreadPoolExecutor(5) as pool:
+        list(pool.map(lambda _: rate_limit.wait(), range(10)))
+    # the first call goes right away, the other 9 are 1/50s apart
+    assert 0.17 < time.monotonic() - start < 0.4
@@ -1,11 +1,29 @@
 import aioboto3
+import asyncio
 import boto3
+from datetime import datetime, timedelta, timezone
+import fcntl
+from functools import partial
+import hashlib
+import json
+from math import ceil
+from multiprocessing.pool import ThreadPool
+import os
+import queue
 import random
+import requests
+from requests.adapters import HTTPAdapter
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, DefaultDict, Dict, List, Tuple
+from urllib3.util.retry import Retry
 import yaml
 import multiprocessing as mp
 
-from runners.helpers import db
+from runners.helpers import db, log
 from runners.helpers.dbconfig import ROLE as SA_ROLE
+from runners.utils import json_dumps
 
 
 def updated(d=None, *ds, **kwargs):
@@ -47,62 +65,568 @@ def qmap_mp(num_threads, f, args):
         p.kill()
 
 
-def sts_assume_role(src_role_arn, dest_role_arn, dest_external_id=None):
-    session_name = ''.join(random.choice('0123456789ABCDEF') for i in range(16))
-    src_role = boto3.client('sts').assume_role(
-        RoleArn=src_role_arn, RoleSessionName=session_name
+def prefetched(iterable, depth=4):
+    """Iterates over iterable in a background thread, up to depth items ahead,
+    so that producing the next items overlaps with consuming the current one
+    """
+    items: queue.Queue = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+    done = object()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stopped.set()
+
+
+# REST toolkit: a pooled, retrying session plus declarative pagination, e.g.
+#
+#   session = http_session(headers={'Authorization': f'Bearer {token}'})
+#   pages = OffsetPages(100, total=lambda page: page['total'])
+#   with InsertSink() as sink:
+#       for page in get_pages(session, url, pagination=pages):
+#           for row in page['items']:
+#               sink.add(table, row)
+#
+# pages after the first are fetched pool_size at a time where the pagination
+# allows it, i.e. numbered pages, and one after another for cursors and links.
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+def http_session(headers=None, auth=None, pool_size=10, retries=5, backoff_factor=1):
+    """requests.Session keeping up to pool_size connections alive and retrying
+    connection errors and HTTP_RETRY_STATUSES with exponential backoff, or
+    after a Retry-After header
+    """
+    session = requests.Session()
+    session.headers.update(headers or {})
+    session.auth = auth
+    adapter = HTTPAdapter(
+        pool_maxsize=pool_size,
+        max_retries=Retry(
+            total=retries,
+            backoff_factor=backoff_factor,
+            status_forcelist=HTTP_RETRY_STATUSES,
+            raise_on_status=False,
+        ),
+    )
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def http_get(session, url, params=None):
+    log.debug(f"Preparing GET: url={url} with params={params}")
+    response = session.get(url, params=params)
+    try:
+        response.raise_for_status()
+    except requests.HTTPError as http_err:
+        log.error(f"Error GET: url={url}")
+        log.error(f"HTTP error occurred: {http_err}")
+        raise
+    return response
+
+
+def get_json(session, url, params=None):
+    return http_get(session, url, params).json()
+
+
+class RateLimit:
+    """Spaces out calls to wait() from any number of threads to rate per second"""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.next_at = 0.0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+        time.sleep(at - now)
+
+
+def concurrently(f, args, pool_size=4):
+    """maps f over args in pool_size threads, yielding results in order"""
+    with ThreadPool(pool_size) as pool:
+        yield from pool.imap(f, args)
+
+
+class NumberedPages:
+    """Pages selected by a numeric param, start, start + step, start + 2 * step..
+
+    With total(first page) giving the number of items, the remaining pages are
+    fetched concurrently. Without it, pages are fetched pool_size at a time
+    until items(page) is empty.
+    """
+
+    def __init__(
+        self,
+        param,
+        size,
+        size_param=None,
+        start=0,
+        step=1,
+        total=None,
+        items=lambda page: page,
+    ):
+        self.param = param
+        self.size = size
+        self.size_param = size_param
+        self.start = start
+        self.step = step
+        self.total = total
+        self.items = items
+
+    def params(self, params, i):
+        return updated(
+            dict(params),
+            {self.size_param: self.size} if self.size_param else None,
+            {self.param: self.start + i * self.step},
+        )
+
+    def pages(self, session, url, params, pool_size):
+        def get(i):
+            return get_json(session, url, self.params(params, i))
+
+        first = get(0)
+        yield first
+
+        if self.total is not None:
+            num_pages = ceil(self.total(first) / self.size)
+            yield from concurrently(get, range(1, num_pages), pool_size)
+            return
+
+        if not self.items(first):
+            return
+
+        i = 1
+        while True:
+            for page in concurrently(get, range(i, i + pool_size), pool_size):
+                if not self.items(page):
+                    return
+                yield page
+            i += pool_size
+
+
+class OffsetPages(NumberedPages):
+    def __init__(
+        self,
+        size,
+        total=None,
+        offset_param='offset',
+        limit_param='limit',
+        items=lambda page: page,
+    ):
+        super().__init__(
+            offset_param, size, limit_param, 0, size, total=total, items=items
+        )
+
+
+class PageNumbers(NumberedPages):
+    def __init__(
+        self,
+        size,
+        total=None,
+        page_param='page',
+        size_param='limit',
+        start=1,
+        items=lambda page: page,
+    ):
+        super().__init__(page_param, size, size_param, start, 1, total, items)
+
+
+class CursorPages:
+    """Pages each giving the param value selecting the next, until a page has
+    no next_cursor(page) or no items(page)
+    """
+
+    def __init__(self, param, next_cursor, items=lambda page: page):
+        self.param = param
+        self.next_cursor = next_cursor
+        self.items = items
+
+    def pages(self, session, url, params, pool_size):
+        params = dict(params)
+        while True:
+            page = get_json(session, url, params)
+            yield page
+            cursor = self.next_cursor(page)
+            if not cursor or not self.items(page):
+                return
+            params[self.param] = cursor
+
+
+class LinkPages:
+    """Pages linked by Link: <url>; rel="next" response headers, requested at
+    the pace of rate_limit if given
+    """
+
+    def __init__(self, rate_limit=None):
+        self.rate_limit = rate_limit
+
+    def linked_pages(self, session, url, params=None):
+        """yields each page with the url of the next, e.g. to resume from"""
+        while url:
+            if self.rate_limit is not None:
+                self.rate_limit.wait()
+            response = http_get(session, url, params)
+            # next links carry the query of the first request
+            url = response.links.get('next', {}).get('url')
+            params = None
+            yield response.json(), url
+
+    def pages(self, session, url, params, pool_size):
+        for page, _ in self.linked_pages(session, url, params):
+            yield page
+
+
+def get_pages(session, url, params=None, pagination=None, pool_size=4):
+    """yields decoded JSON pages of url, as paginated by pagination"""
+    if pagination is None:
+        yield get_json(session, url, params)
+    else:
+        yield from pagination.pages(session, url, params or {}, pool_size)
+
+
+class TokenBucket:
+    """Async token bucket whose refill rate adapts AIMD-style to throttling
+
+    rate grows by `increase` tokens/s on every success up to `max_rate`, and
+    is multiplied by `decrease` on every throttle down to `min_rate`.
+    """
+
+    def __init__(
+        self, rate, capacity, min_rate=None, max_rate=None, increase=None, decrease=0.5
+    ):
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = rate / 20 if min_rate is None else min_rate
+        self.max_rate = rate if max_rate is None else max_rate
+        self.increase = self.max_rate / 50 if increase is None else increase
+        self.decrease = decrease
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.capacity, self.tokens + (now - self.updated_at) * self.rate
+        )
+        self.updated_at = now
+
+    async def acquire(self, tokens=1):
+        while True:
+            self.refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            await asyncio.sleep((tokens - self.tokens) / self.rate)
+
+    def succeeded(self):
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def throttled(self):
+        self.refill()
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        self.tokens = 0
+
+    def defer(self, seconds):
+        """holds back every acquire() on this bucket for at least `seconds`"""
+        self.refill()
+        self.tokens = min(self.tokens, -seconds * self.rate)
+
+
+class KeyedTokenBuckets:
+    """Lazily creates one TokenBucket per key, e.g. (account, region, service)
+
+    limits maps a key prefix to (rate, capacity), and falls back to default.
+    """
+
+    def __init__(self, default, limits=None, key_prefix=lambda key: key):
+        self.default = default
+        self.limits = limits or {}
+        self.key_prefix = key_prefix
+        self.buckets = {}
+
+    def __getitem__(self, key):
+        if key not in self.buckets:
+            rate, capacity = self.limits.get(self.key_prefix(key), self.default)
+            self.buckets[key] = TokenBucket(rate, capacity)
+        return self.buckets[key]
+
+
+class CircuitBreaker:
+    """Opens after max_failures consecutive failures, holding wait() callers
+    for timeout seconds. Once it lapses, one more failure re-opens it for
+    twice as long, up to max_timeout, and a success closes it again.
+    """
+
+    def __init__(self, max_failures=5, timeout=30, max_timeout=600):
+        self.max_failures = max_failures
+        self.min_timeout = timeout
+        self.max_timeout = max_timeout
+        self.timeout = timeout
+        self.failures = 0
+        self.open_until = 0.0
+
+    @property
+    def is_open(self):
+        return self.open_until > time.monotonic()
+
+    async def wait(self):
+        while self.is_open:
+            await asyncio.sleep(self.open_until - time.monotonic())
+
+    def succeeded(self):
+        self.failures = 0
+        self.timeout = self.min_timeout
+
+    def failed(self):
+        self.failures += 1
+        if self.failures >= self.max_failures and not self.is_open:
+            self.open_until = time.monotonic() + self.timeout
+            self.timeout = min(self.max_timeout, self.timeout * 2)
+
+
+class InsertSink:
+    """Buffers rows per table, inserting a table's rows once they reach max_rows
+    or roughly max_bytes of JSON, so memory use is independent of data size
+    """
+
+    def __init__(
+        self,
+        insert: Callable[[str, list], dict] = db.insert,
+        max_rows=16384,
+        max_bytes=8 * 1024 * 1024,
+    ):
+        self.insert = insert
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.rows: DefaultDict[str, List] = defaultdict(list)
+        self.num_bytes: DefaultDict[str, int] = defaultdict(int)
+        self.num_inserted = 0
+
+    def buffer(self, table, row):
+        self.rows[table].append(row)
+        self.num_bytes[table] += len(json_dumps(row, sort_keys=False))
+        return (
+            len(self.rows[table]) >= self.max_rows
+            or self.num_bytes[table] >= self.max_bytes
+        )
+
+    def take(self, table):
+        self.num_bytes.pop(table, None)
+        return self.rows.pop(table, [])
+
+    def do_insert(self, table, rows):
+        response = self.insert(table, rows)
+        log.info(f'inserted {len(rows)} rows into {table}: {response}')
+
+    def add(self, table, row):
+        if self.buffer(table, row):
+            self.flush(table)
+
+    def flush(self, table=None):
+        for t in [table] if table else list(self.rows):
+            rows = self.take(t)
+            if rows:
+                self.do_insert(t, rows)
+                self.num_inserted += len(rows)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.flush()
+
+
+class AioInsertSink(InsertSink):
+    """InsertSink running inserts in a thread pool, at most max_pending at once
+
+    add() waits while that many inserts are in flight, which in turn slows
+    down the coroutines producing rows. A failed insert is raised from the
+    next add() or close().
+    """
+
+    def __init__(self, *args, max_pending=2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pending = asyncio.Semaphore(max_pending)
+        self.inserts: List[asyncio.Future] = []
+
+    def raise_failed(self):
+        failed = [i for i in self.inserts if i.done() and i.exception()]
+        self.inserts = [i for i in self.inserts if not i.done()]
+        if failed:
+            raise failed[0].exception()
+
+    async def add(self, table, row):
+        self.raise_failed()
+        if self.buffer(table, row):
+            await self.flush(table)
+
+    async def flush(self, table=None):
+        for t in [table] if table else list(self.rows):
+            rows = self.take(t)
+            if rows:
+                await self.pending.acquire()
+                insert = asyncio.get_event_loop().run_in_executor(
+                    None, self.do_insert, t, rows
+                )
+                insert.add_done_callback(partial(self.inserted, len(rows)))
+                self.inserts.append(insert)
+
+    def inserted(self, num_rows, insert):
+        self.pending.release()
+        if not insert.cancelled() and insert.exception() is None:
+            self.num_inserted += num_rows
+
+    async def close(self):
+        self.raise_failed()
+        await self.flush()
+        await asyncio.gather(*self.inserts)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+# assumed role credentials are cached per (source role, destination role,
+# external id) and refreshed once within STS_REFRESH_AHEAD of expiring. async
+# callers keep using the old credentials during a background refresh until
+# they are within STS_MIN_VALIDITY of expiring.
+STS_REFRESH_AHEAD = timedelta(minutes=15)
+STS_MIN_VALIDITY = timedelta(minutes=5)
+
+_STS_CREDENTIALS: Dict[tuple, dict] = {}
+_STS_LOCKS: Dict[tuple, threading.Lock] = {}
+_STS_LOCKS_LOCK = threading.Lock()
+
+_AIO_STS_SESSIONS: Dict[tuple, Tuple[datetime, aioboto3.Session]] = {}
+_AIO_STS_REFRESHES: Dict[tuple, asyncio.Future] = {}
+
+
+def random_session_name():
+    return ''.join(random.choice('0123456789ABCDEF') for i in range(16))
+
+
+def time_to_expiry(expiration):
+    return expiration - datetime.now(timezone.utc)
+
+
+def credentials_session(credentials, session_class=boto3.Session):
+    return session_class(
+        aws_access_key_id=credentials['AccessKeyId'],
+        aws_secret_access_key=credentials['SecretAccessKey'],
+        aws_session_token=credentials['SessionToken'],
     )
-    sts_client = boto3.Session(
-        aws_access_key_id=src_role['Credentials']['AccessKeyId'],
-        aws_secret_access_key=src_role['Credentials']['SecretAccessKey'],
-        aws_session_token=src_role['Credentials']['SessionToken'],
-    ).client('sts')
-
-    sts_role = (
-        sts_client.assume_role(
-            RoleArn=dest_role_arn,
-            RoleSessionName=session_name,
-            ExternalId=dest_external_id,
+
+
+def cached_sts_credentials(src_role_arn, dest_role_arn, dest_external_id=None):
+    key = (src_role_arn, dest_role_arn, dest_external_id)
+    cached = _STS_CREDENTIALS.get(key)
+    if cached and time_to_expiry(cached['Expiration']) > STS_REFRESH_AHEAD:
+        return cached
+
+    with _STS_LOCKS_LOCK:
+        lock = _STS_LOCKS.setdefault(key, threading.Lock())
+
+    # only one thread assumes each role, the rest wait for its credentials
+    with lock:
+        cached = _STS_CREDENTIALS.get(key)
+        if cached and time_to_expiry(cached['Expiration']) > STS_REFRESH_AHEAD:
+            return cached
+
+        src_session = (
+            credentials_session(cached_sts_credentials(None, src_role_arn))
+            if src_role_arn
+            else boto3
         )
-        if dest_external_id
-        else sts_client.assume_role(RoleArn=dest_role_arn, RoleSessionName=session_name)
+        external_id = {'ExternalId': dest_external_id} if dest_external_id else {}
+        credentials = _STS_CREDENTIALS[key] = src_session.client('sts').assume_role(
+            RoleArn=dest_role_arn, RoleSessionName=random_session_name(), **external_id
+        )['Credentials']
+        return credentials
+
+
+def sts_assume_role(src_role_arn, dest_role_arn, dest_external_id=None):
+    # boto3 Sessions are not thread-safe, so each caller gets its own
+    return credentials_session(
+        cached_sts_credentials(src_role_arn, dest_role_arn, dest_external_id)
     )
 
-    return boto3.Session(
-        aws_access_key_id=sts_role['Credentials']['AccessKeyId'],
-        aws_secret_access_key=sts_role['Credentials']['SecretAccessKey'],
-        aws_session_token=sts_role['Credentials']['SessionToken'],
+
+async def aio_assume_role(session, role_arn, external_id=None):
+    external_id = {'ExternalId': external_id} if external_id else {}
+    async with session.client('sts') as sts_client:
+        sts_role = await sts_client.assume_role(
+            RoleArn=role_arn, RoleSessionName=random_session_name(), **external_id
+        )
+    credentials = sts_role['Credentials']
+    return (
+        credentials['Expiration'],
+        credentials_session(credentials, aioboto3.Session),
     )
 
 
 async def aio_sts_assume_role(src_role_arn, dest_role_arn, dest_external_id=None):
-    session_name = ''.join(random.choice('0123456789ABCDEF') for i in range(16))
-    async with aioboto3.client('sts') as sts:
-        src_role = await sts.assume_role(
-            RoleArn=src_role_arn, RoleSessionName=session_name
-        )
-        async with aioboto3.Session(
-            aws_access_key_id=src_role['Credentials']['AccessKeyId'],
-            aws_secret_access_key=src_role['Credentials']['SecretAccessKey'],
-            aws_session_token=src_role['Credentials']['SessionToken'],
-        ).client('sts') as sts_client:
-            sts_role = await (
-                sts_client.assume_role(
-                    RoleArn=dest_role_arn,
-                    RoleSessionName=session_name,
-                    ExternalId=dest_external_id,
+    key = (src_role_arn, dest_role_arn, dest_external_id)
+    cached = _AIO_STS_SESSIONS.get(key)
+    ttl = time_to_expiry(cached[0]) if cached else None
+    if cached and ttl and ttl > STS_REFRESH_AHEAD:
+        return cached[1]
+
+    # single-flight: concurrent callers share one in-progress assume_role
+    if key not in _AIO_STS_REFRESHES:
+
+        async def refresh():
+            try:
+                src_session = (
+                    await aio_sts_assume_role(None, src_role_arn)
+                    if src_role_arn
+                    else aioboto3
                 )
-                if dest_external_id
-                else sts_client.assume_role(
-                    RoleArn=dest_role_arn, RoleSessionName=session_name
+                _AIO_STS_SESSIONS[key] = await aio_assume_role(
+                    src_session, dest_role_arn, dest_external_id
                 )
-            )
+            finally:
+                del _AIO_STS_REFRESHES[key]
+
+        _AIO_STS_REFRESHES[key] = asyncio.ensure_future(refresh())
 
-            return aioboto3.Session(
-                aws_access_key_id=sts_role['Credentials']['AccessKeyId'],
-                aws_secret_access_key=sts_role['Credentials']['SecretAccessKey'],
-                aws_session_token=sts_role['Credentials']['SessionToken'],
-            )
+    if cached and ttl and ttl > STS_MIN_VALIDITY:
+        return cached[1]
+
+    await asyncio.shield(_AIO_STS_REFRESHES[key])
+    return _AIO_STS_SESSIONS[key][1]
 
 
 def yaml_dump(**kwargs):
@@ -120,3 +644,111 @@ def create_metadata_table(table, cols, addition):
     if any(name == addition[0].upper() for name in table_names):
         return
     db.execute(f'ALTER TABLE {table} ADD COLUMN {addition[0]} {addition[1]}')
+
+
+# Azure AD access tokens are cached per (client, tenant, secret, resource) in
+# process memory and in 0600 files under AZURE_TOKEN_CACHE_DIR, which must be
+# private to its owner, so pool workers and later runs reuse them. refreshes are
+# single-flight across threads and, through a file lock, across processes. the
+# Azure SDK is imported where needed, so other connectors don't depend on it.
+AZURE_TOKEN_CACHE_DIR = os.environ.get(
+    'AZURE_TOKEN_CACHE_DIR', os.path.expanduser('~/.cache/snowalert/azure_tokens')
+)
+AZURE_TOKEN_MIN_VALIDITY = 300
+
+_AZURE_TOKENS: Dict[str, dict] = {}
+_AZURE_TOKEN_LOCKS: DefaultDict[str, threading.Lock] = defaultdict(threading.Lock)
+
+
+def azure_cloud_environment(cloud):
+    from msrestazure.azure_cloud import AZURE_US_GOV_CLOUD, AZURE_PUBLIC_CLOUD
+
+    return AZURE_US_GOV_CLOUD if cloud in ('usgov', 'gov') else AZURE_PUBLIC_CLOUD
+
+
+def azure_token_is_fresh(token):
+    return token and float(token['expires_on']) - time.time() > AZURE_TOKEN_MIN_VALIDITY
+
+
+def read_azure_token(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_azure_token(path, token):
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(token, f)
+    os.replace(tmp_path, path)
+
+
+def azure_token_cache_dir():
+    os.makedirs(AZURE_TOKEN_CACHE_DIR, mode=0o700, exist_ok=True)
+    st = os.stat(AZURE_TOKEN_CACHE_DIR)
+    if st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise PermissionError(
+            f'{AZURE_TOKEN_CACHE_DIR} must only be accessible to its owner, '
+            f'e.g. chmod 700 {AZURE_TOKEN_CACHE_DIR}'
+        )
+    return AZURE_TOKEN_CACHE_DIR
+
+
+def fetch_azure_token(cloud, client_id, tenant, secret, resource):
+    from azure.common.credentials import ServicePrincipalCredentials
+
+    token = ServicePrincipalCredentials(
+        client_id=client_id,
+        tenant=tenant,
+        secret=secret,
+        resource=resource,
+        cloud_environment=azure_cloud_environment(cloud),
+    ).token
+    return {
+        'access_token': token['access_token'],
+        'expires_on': float(token['expires_on']),
+    }
+
+
+def azure_access_token(cloud, client_id, tenant, secret, resource):
+    """returns an access token valid for at least AZURE_TOKEN_MIN_VALIDITY"""
+    key = hashlib.sha256(
+        json_dumps([cloud, client_id, tenant, secret, resource]).encode()
+    ).hexdigest()
+    token = _AZURE_TOKENS.get(key)
+    if azure_token_is_fresh(token):
+        return token['access_token']
+
+    with _AZURE_TOKEN_LOCKS[key]:
+        token = _AZURE_TOKENS.get(key)
+        if azure_token_is_fresh(token):
+            return token['access_token']
+
+        path = os.path.join(azure_token_cache_dir(), key)
+        lock_fd = os.open(f'{path}.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        with os.fdopen(lock_fd) as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                token = read_azure_token(path)
+                if not azure_token_is_fresh(token):
+                    token = fetch_azure_token(
+                        cloud, client_id, tenant, secret, resource
+                    )
+                    write_azure_token(path, token)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+        _AZURE_TOKENS[key] = token
+        return token['access_token']
+
+
+def azure_credentials(cloud, client_id, tenant, secret, resource):
+    """msrest credentials for azure-mgmt clients, from the shared token cache"""
+    from msrest.authentication import BasicTokenAuthentication
+
+    return BasicTokenAuthentication(
+        {'access_token': azure_access_token(cloud, client_id, tenant, secret, resource)}
+    )
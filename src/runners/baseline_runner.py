@@ -1,19 +1,21 @@
-from typing import List, Dict, Any
-import subprocess
+from typing import List, Dict, Any, Optional
+from multiprocessing import Pool
 
-from runners.config import DATA_SCHEMA
+from runners.config import BASELINE_POOLSIZE, DATA_SCHEMA
 
 from runners.helpers import db, log
+from runners.utils import json_dumps
 
 import math
 import os
 import shutil
+import tempfile
+import time
 import pandas
 import yaml
 
-import random
-
-FORMATTED_CODE_DIRECTORY = ''.join(random.choice('abcdefghijklmnop') for i in range(10))
+MODULES_DIRECTORY = '../baseline_modules'
+METADATA_KEYS = ['log source', 'required values', 'module name', 'filter', 'history']
 
 
 def format_code(code, vars):
@@ -22,6 +24,43 @@ def format_code(code, vars):
     return code
 
 
+def format_module(directory, code_location, required_values):
+    """new directory in `directory` with run_module.R and the module's files
+    formatted with required_values
+    """
+    path = tempfile.mkdtemp(dir=directory)
+    shutil.copyfile(f"{MODULES_DIRECTORY}/run_module.R", f"{path}/run_module.R")
+    for file in os.listdir(f'{MODULES_DIRECTORY}/{code_location}'):
+        if not file.startswith('.'):
+            with open(f"{MODULES_DIRECTORY}/{code_location}/{file}") as f:
+                r_code = f.read()
+            r_code = format_code(r_code, required_values)
+            with open(f"{path}/{file}", 'w+') as ff:
+                ff.write(r_code)
+    return path
+
+
+def format_modules(directory, tables):
+    """formats the module of each table with valid metadata into directory,
+    once per module name and required values, setting the table's 'path'
+    """
+    paths: Dict[str, Optional[str]] = {}
+    for table in tables:
+        metadata = table['metadata']
+        if metadata is None:
+            continue
+        code_location = metadata['module name']
+        required_values = metadata['required values']
+        key = json_dumps([code_location, required_values], sort_keys=True)
+        if key not in paths:
+            try:
+                paths[key] = format_module(directory, code_location, required_values)
+            except Exception as e:
+                log.error(e, f"failed to format {code_location} for {table['name']}")
+                paths[key] = None
+        table['path'] = paths[key]
+
+
 def pack(data: List[Dict[Any, Any]]) -> Dict[Any, List[Any]]:
     keys = {k for row in data for k in row.keys()}
     return {k: [d.get(k) for d in data] for k in keys}
@@ -54,44 +93,46 @@ def query_log_source(source, time_filter, time_column):
     return r_dataframe
 
 
-def run_baseline(name, comment):
-    from rpy2 import robjects as ro
+def baseline_metadata(name, comment) -> Optional[dict]:
+    metadata = None
     try:
         metadata = yaml.safe_load(comment)
         assert type(metadata) is dict
-
-        source = metadata['log source']
-        required_values = metadata['required values']
-        code_location = metadata['module name']
-        time_filter = metadata['filter']
-        time_column = metadata['history']
+        missing = [k for k in METADATA_KEYS if k not in metadata]
+        assert not missing, f'missing {missing}'
 
     except Exception as e:
         log.error(e, f"{name} has invalid metadata: >{metadata}<, skipping")
-        return
+        return None
 
-    os.mkdir(FORMATTED_CODE_DIRECTORY)
-    files = os.listdir(f'../baseline_modules/{code_location}')
+    return metadata
 
-    shutil.copyfile(
-        "../baseline_modules/run_module.R", f"{FORMATTED_CODE_DIRECTORY}/run_module.R"
-    )
 
-    for file in files:
-        print(file)
-        if not file.startswith('.'):
-            with open(f"../baseline_modules/{code_location}/{file}") as f:
-                r_code = f.read()
-            r_code = format_code(r_code, required_values)
-            with open(f"{FORMATTED_CODE_DIRECTORY}/{file}", 'w+') as ff:
-                ff.write(r_code)
+def run_baseline(name, metadata, path):
+    from rpy2 import robjects as ro
 
-    with open(f"{FORMATTED_CODE_DIRECTORY}/run_module.R") as fr:
+    if metadata is None:
+        return
+    if path is None:
+        raise RuntimeError(f"module {metadata['module name']} failed to format")
+
+    source = metadata['log source']
+    time_filter = metadata['filter']
+    time_column = metadata['history']
+
+    with open(f"{path}/run_module.R") as fr:
         r_code = fr.read()
     frame = query_log_source(source, time_filter, time_column)
+
+    # modules share this process' R session, so each starts from a clean one
+    cwd = os.getcwd()
+    ro.r('rm(list = ls())')
     ro.globalenv['input_table'] = frame
-    ro.r(f"setwd('./{FORMATTED_CODE_DIRECTORY}')")
-    output = ro.r(r_code)
+    ro.r(f"setwd('{path}')")
+    try:
+        output = ro.r(r_code)
+    finally:
+        os.chdir(cwd)
     output = output.to_dict()
 
     results = unpack(output)
@@ -100,24 +141,57 @@ def run_baseline(name, comment):
 
     columns = [row['name'] for row in db.fetch(f'desc table {DATA_SCHEMA}.{name}')]
     columns.remove('EXPORT_TIME')
+    log.info(f"{name} generated {len(results)} rows")
+    db.insert(f"{DATA_SCHEMA}.{name}", results, columns=columns, overwrite=True)
+    return len(results)
+
+
+def start_worker():
+    # connections are not shared with the parent, and R starts once per worker
+    db.connect(flush_cache=True)
+    from rpy2 import robjects as ro
+    from rpy2.robjects import pandas2ri
+
+    pandas2ri.activate()
+    ro.r('library(testthat)')
+
+
+def timed_run_baseline(table):
+    name = table['name']
+    log.info(f'{name} started...')
+    start = time.time()
     try:
-        log.info(f"{name} generated {len(results)} rows")
-        db.insert(f"{DATA_SCHEMA}.{name}", results, columns=columns, overwrite=True)
+        rows = run_baseline(name, table['metadata'], table.get('path'))
+        error = None
     except Exception as e:
-        log.error("Failed to insert the results into the target table", e)
-    finally:
-        shutil.rmtree(f"../{FORMATTED_CODE_DIRECTORY}")
+        log.error(f'{name} failed', e)
+        rows = None
+        error = str(e)
+    seconds = round(time.time() - start, 1)
+    log.info(f'{name} done in {seconds}s.')
+    return {'name': name, 'seconds': seconds, 'rows': rows, 'error': error}
 
 
 def main(baseline='%_BASELINE'):
     db.connect()
     baseline_tables = list(db.fetch(f"show tables like '{baseline}' in {DATA_SCHEMA}"))
-    for table in baseline_tables:
-        name = table['name']
-        comment = table['comment']
-        log.info(f'{name} started...')
-        if len(baseline_tables) > 1:
-            subprocess.call(f"python ./run.py baseline {name}", shell=True)
+    tables = [
+        {'name': t['name'], 'metadata': baseline_metadata(t['name'], t['comment'])}
+        for t in baseline_tables
+    ]
+
+    # formatted before the pool starts, as its workers exit without cleanup
+    modules_directory = tempfile.mkdtemp('_baselines')
+    try:
+        format_modules(modules_directory, tables)
+        if len(tables) > 1:
+            with Pool(BASELINE_POOLSIZE, initializer=start_worker) as pool:
+                timings = pool.map(timed_run_baseline, tables, chunksize=1)
         else:
-            run_baseline(name, comment)
-        log.info(f'{name} done.')
+            timings = [timed_run_baseline(t) for t in tables]
+    finally:
+        shutil.rmtree(modules_directory, ignore_errors=True)
+
+    for t in sorted(timings, key=lambda t: -t['seconds']):
+        log.info(f"{t['name']}: {t['seconds']}s, {t['rows']} rows, error: {t['error']}")
+    return timings
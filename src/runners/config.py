@@ -6,6 +6,7 @@ from .helpers.dbconfig import DATABASE
 ENV = environ.get('SA_ENV', 'unset')
 POOLSIZE = int(environ.get('SA_POOLSIZE', '4'))
 DC_POOLSIZE = int(environ.get('SA_DC_POOLSIZE', '4'))
+BASELINE_POOLSIZE = int(environ.get('SA_BASELINE_POOLSIZE', '4'))
 
 # generated once per runtime
 RUN_ID = uuid.uuid4().hex
@@ -27,6 +28,7 @@ RUN_METADATA_TABLE_NAME = environ.get('SA_RUN_METADATA_TABLE_NAME', "run_metadat
 DC_METADATA_TABLE_NAME = environ.get(
     'SA_CONNECTOR_METADATA_TABLE_NAME', 'ingestion_metadata'
 )
+PIPE_METADATA_TABLE_NAME = environ.get('SA_PIPE_METADATA_TABLE_NAME', 'pipe_metadata')
 
 # schemas
 DATA_SCHEMA = environ.get('SA_DATA_SCHEMA', f"{DATABASE}.{DATA_SCHEMA_NAME}")
@@ -49,6 +51,9 @@ RUN_METADATA_TABLE = environ.get(
 DC_METADATA_TABLE = environ.get(
     'SA_METADATA_CONNECTOR_TABLE', f"{RESULTS_SCHEMA}.{DC_METADATA_TABLE_NAME}"
 )
+PIPE_METADATA_TABLE = environ.get(
+    'SA_METADATA_PIPE_TABLE', f"{RESULTS_SCHEMA}.{PIPE_METADATA_TABLE_NAME}"
+)
 
 # misc
 ALERT_QUERY_POSTFIX = "ALERT_QUERY"
@@ -56,6 +61,9 @@ ALERT_SQUELCH_POSTFIX = "ALERT_SUPPRESSION"
 VIOLATION_QUERY_POSTFIX = "VIOLATION_QUERY"
 VIOLATION_SQUELCH_POSTFIX = "VIOLATION_SUPPRESSION"
 
+# pipes and tasks this many minutes behind raise alerts
+PIPE_LAG_ALERT_MINUTES = int(environ.get('SA_PIPE_LAG_ALERT_MINUTES', '60'))
+
 # exception tracking
 AIRBRAKE_PROJECT_ID = environ.get('AIRBRAKE_PROJECT_ID')
 AIRBRAKE_PROJECT_KEY = environ.get('AIRBRAKE_PROJECT_KEY')
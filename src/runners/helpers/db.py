@@ -629,8 +629,11 @@ def copy_file_to_table_stage(table_name, file_path):
     execute(f"PUT file://{file_path} @{DATA_SCHEMA}.%{table_name}")
 
 
-def load_from_table_stage(table_name):
-    execute(f"COPY INTO {DATA_SCHEMA}.{table_name} FROM @{DATA_SCHEMA}.%{table_name}")
+def load_from_table_stage(table_name, files=None):
+    query = f"COPY INTO {DATA_SCHEMA}.{table_name} FROM @{DATA_SCHEMA}.%{table_name}"
+    if files:
+        query += " FILES = (" + ", ".join(f"'{f}'" for f in files) + ")"
+    execute(query)
 
 
 def create_stage(
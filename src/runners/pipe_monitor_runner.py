@@ -0,0 +1,189 @@
+"""SnowAlert Pipe Monitor
+
+Records the ingestion lag and throughput of the pipes and tasks in the data
+schema, which connectors create at finalize, into results.pipe_metadata where
+rules.SNOWALERT_INGESTION_LAG_ALERT_QUERY alerts on those falling behind.
+"""
+from datetime import datetime, timezone
+import json
+import re
+
+from dateutil.parser import parse as parse_date
+import fire
+
+from runners.config import (
+    DATA_SCHEMA,
+    PIPE_LAG_ALERT_MINUTES,
+    PIPE_METADATA_TABLE,
+    RUN_ID,
+)
+from runners.helpers import db, log
+
+# throughput and task runs are counted over the last WINDOW_MINUTES
+WINDOW_MINUTES = 60
+
+PIPE_COPY_HISTORY_QUERY = f"""
+SELECT COUNT(*) AS files
+  , SUM(row_count) AS rows
+  , SUM(error_count) AS errors
+  , AVG(DATEDIFF(second, pipe_received_time, last_load_time)) AS latency
+FROM TABLE(information_schema.copy_history(
+  table_name=>'{{table}}',
+  start_time=>DATEADD(minute, -{WINDOW_MINUTES}, CURRENT_TIMESTAMP())
+))
+WHERE pipe_name = '{{pipe}}'
+"""
+
+# pipe status has no time for the oldest pending file, so it is taken to be
+# the first of this monitor's consecutive records of the pipe having some, in
+# the last PENDING_LOOKBACK_MINUTES, which is as far behind as pipes show
+PENDING_LOOKBACK_MINUTES = max(4 * PIPE_LAG_ALERT_MINUTES, 24 * 60)
+PIPE_PENDING_SINCE_QUERY = f"""
+SELECT MIN(event_time) AS pending_since
+FROM {PIPE_METADATA_TABLE}
+WHERE event_time > DATEADD(minute, -{PENDING_LOOKBACK_MINUTES}, CURRENT_TIMESTAMP())
+  AND v:NAME = '{{name}}'
+  AND v:PENDING
+  AND event_time > (
+    SELECT COALESCE(MAX(event_time), '1970-01-01'::TIMESTAMP_LTZ)
+    FROM {PIPE_METADATA_TABLE}
+    WHERE event_time > DATEADD(minute, -{PENDING_LOOKBACK_MINUTES}, CURRENT_TIMESTAMP())
+      AND v:NAME = '{{name}}'
+      AND NOT v:PENDING
+  )
+"""
+
+TASK_HISTORY_QUERY = f"""
+SELECT COUNT_IF(state = 'SUCCEEDED') AS succeeded
+  , COUNT_IF(state = 'FAILED') AS failed
+FROM TABLE(information_schema.task_history(
+  task_name=>'{{task}}',
+  scheduled_time_range_start=>DATEADD(minute, -{WINDOW_MINUTES}, CURRENT_TIMESTAMP())
+))
+"""
+
+# over all the task history information_schema keeps, rather than the window
+TASK_LAST_HEALTHY_QUERY = """
+SELECT MAX(scheduled_time) AS last_healthy
+FROM TABLE(information_schema.task_history(
+  task_name=>'{task}',
+  result_limit=>10000
+))
+WHERE state IN ('SUCCEEDED', 'SKIPPED')
+"""
+
+
+def minutes_between(start, end):
+    return None if start is None else round((end - start).total_seconds() / 60, 1)
+
+
+def pipe_target_table(definition):
+    m = re.search(r'COPY\s+INTO\s+([^\s(]+)', definition, re.IGNORECASE)
+    return m.group(1) if m else None
+
+
+def pipe_pending(status):
+    last_ingested = status.get('lastIngestedTimestamp')
+    last_received = status.get('lastReceivedMessageTimestamp')
+    return status.get('pendingFileCount', 0) > 0 or (
+        last_received is not None
+        and (
+            last_ingested is None
+            or parse_date(last_received) > parse_date(last_ingested)
+        )
+    )
+
+
+def pipe_lag_minutes(status, pending_since, now):
+    """minutes the oldest file waiting to be loaded has waited, or 0 if none"""
+    if pending_since is None:
+        return 0
+    last_ingested = status.get('lastIngestedTimestamp')
+    if last_ingested is not None:
+        pending_since = max(pending_since, parse_date(last_ingested))
+    return minutes_between(pending_since, now)
+
+
+def pipe_metrics(pipe, now):
+    name = f"{pipe['schema_name']}.{pipe['name']}"
+    status = json.loads(
+        next(db.fetch(f"SELECT SYSTEM$PIPE_STATUS('{name}') AS status"))['STATUS']
+    )
+    table = pipe_target_table(pipe['definition'])
+    history = next(
+        db.fetch(PIPE_COPY_HISTORY_QUERY.format(table=table, pipe=pipe['name']))
+    )
+    pending = pipe_pending(status)
+    pending_since = None
+    if pending:
+        since = next(db.fetch(PIPE_PENDING_SINCE_QUERY.format(name=name)))
+        pending_since = since['PENDING_SINCE'] or now
+    lag = pipe_lag_minutes(status, pending_since, now)
+    return {
+        'KIND': 'pipe',
+        'NAME': name,
+        'TABLE': table,
+        'EXECUTION_STATE': status.get('executionState'),
+        'PENDING': pending,
+        'PENDING_FILE_COUNT': status.get('pendingFileCount'),
+        'LAST_INGESTED_AT': status.get('lastIngestedTimestamp'),
+        'LAST_RECEIVED_AT': status.get('lastReceivedMessageTimestamp'),
+        'LAG_MINUTES': lag,
+        'FILES_PER_MINUTE': history['FILES'] / WINDOW_MINUTES,
+        'ROWS_PER_MINUTE': (history['ROWS'] or 0) / WINDOW_MINUTES,
+        'LOAD_ERRORS': history['ERRORS'] or 0,
+        'LOAD_LATENCY_SECONDS': history['LATENCY'],
+        'LAGGING': (
+            lag > PIPE_LAG_ALERT_MINUTES or status.get('executionState') != 'RUNNING'
+        ),
+        'STATUS': status,
+    }
+
+
+def task_metrics(task, now):
+    name = f"{task['schema_name']}.{task['name']}"
+    history = next(db.fetch(TASK_HISTORY_QUERY.format(task=task['name'])))
+    last_healthy = next(db.fetch(TASK_LAST_HEALTHY_QUERY.format(task=task['name'])))
+    last_healthy = last_healthy['LAST_HEALTHY']
+    started = task['state'] == 'started'
+    # tasks after others, or on streams without data, need not have run lately
+    lag = minutes_between(last_healthy, now) if started else 0
+    return {
+        'KIND': 'task',
+        'NAME': name,
+        'STATE': task['state'],
+        'SCHEDULE': task['schedule'],
+        'SUCCEEDED_RUNS': history['SUCCEEDED'],
+        'FAILED_RUNS': history['FAILED'],
+        'LAST_HEALTHY_AT': last_healthy,
+        'LAG_MINUTES': lag,
+        'LAGGING': started
+        and (history['FAILED'] > 0 or lag is None or lag > PIPE_LAG_ALERT_MINUTES),
+    }
+
+
+def main(schema=DATA_SCHEMA):
+    now = datetime.now(timezone.utc)
+    rows = []
+    for kind, metrics in [('PIPES', pipe_metrics), ('TASKS', task_metrics)]:
+        for obj in db.fetch(f'SHOW {kind} IN {schema}'):
+            log.info(f"{kind[:-1].lower()} {obj['name']} processing...")
+            try:
+                v = metrics(obj, now)
+            except Exception as e:
+                # alerted on, as lag that can't be measured can't be ruled out
+                log.error(f"failed to measure {obj['name']}", e)
+                v = {
+                    'KIND': kind[:-1].lower(),
+                    'NAME': f"{obj['schema_name']}.{obj['name']}",
+                    'ERROR': str(e),
+                    'LAGGING': True,
+                }
+            rows.append({'event_time': now, 'v': dict(v, RUN_ID=RUN_ID)})
+
+    db.insert(PIPE_METADATA_TABLE, rows)
+    log.info(f"recorded {len(rows)} pipes and tasks")
+
+
+if __name__ == '__main__':
+    fire.Fire(main)
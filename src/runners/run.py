@@ -2,7 +2,9 @@
 
 import fire
 
+from runners import baseline_runner
 from runners import connectors_runner
+from runners import pipe_monitor_runner
 
 from runners import alert_queries_runner
 from runners import alert_suppressions_runner
@@ -35,6 +37,9 @@ def main(target="all", *rule_names):
     elif target == "dispatcher":
         alert_dispatcher.main()
 
+    elif target in ['pipe', 'pipes']:
+        pipe_monitor_runner.main()
+
     elif rule_names:
         for rule_name in rule_names:
             if rule_name.upper().endswith("_ALERT_SUPPRESSION"):
@@ -59,6 +64,9 @@ def main(target="all", *rule_names):
             for rule_name in rule_names or [None]:
                 connectors_runner.main(rule_name)
 
+        if target == 'all':
+            pipe_monitor_runner.main()
+
         if target in ['violation', 'violations', 'all']:
             violation_queries_runner.main()
             violation_suppressions_runner.main()
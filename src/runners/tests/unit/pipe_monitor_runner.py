@@ -0,0 +1,103 @@
+from datetime import datetime, timedelta, timezone
+
+from runners import pipe_monitor_runner
+from runners.pipe_monitor_runner import (
+    main,
+    pipe_lag_minutes,
+    pipe_pending,
+    task_metrics,
+)
+
+NOW = datetime(2020, 1, 1, 12, tzinfo=timezone.utc)
+
+
+def test_pipe_pending():
+    assert not pipe_pending({})
+    assert pipe_pending({'pendingFileCount': 2})
+    assert pipe_pending({'lastReceivedMessageTimestamp': '2020-01-01T11:00:00Z'})
+    assert pipe_pending(
+        {
+            'lastIngestedTimestamp': '2020-01-01T11:00:00Z',
+            'lastReceivedMessageTimestamp': '2020-01-01T11:30:00Z',
+        }
+    )
+    assert not pipe_pending(
+        {
+            'pendingFileCount': 0,
+            'lastIngestedTimestamp': '2020-01-01T11:30:00Z',
+            'lastReceivedMessageTimestamp': '2020-01-01T11:00:00Z',
+        }
+    )
+
+
+def test_pipe_lag_minutes():
+    assert pipe_lag_minutes({}, None, NOW) == 0
+    assert pipe_lag_minutes({}, NOW - timedelta(minutes=90), NOW) == 90
+    # files pending since before the last ingest waited only since then
+    assert (
+        pipe_lag_minutes(
+            {'lastIngestedTimestamp': '2020-01-01T11:45:00Z'},
+            NOW - timedelta(minutes=90),
+            NOW,
+        )
+        == 15
+    )
+
+
+def fetch_task_history(monkeypatch, succeeded, failed, last_healthy):
+    def fetch(query):
+        if 'last_healthy' in query:
+            return iter([{'LAST_HEALTHY': last_healthy}])
+        return iter([{'SUCCEEDED': succeeded, 'FAILED': failed}])
+
+    monkeypatch.setattr(pipe_monitor_runner.db, 'fetch', fetch)
+
+
+def test_task_metrics(monkeypatch):
+    task = {'schema_name': 'data', 'name': 't', 'schedule': '1 minute'}
+
+    fetch_task_history(monkeypatch, 60, 0, NOW - timedelta(minutes=1))
+    v = task_metrics(dict(task, state='started'), NOW)
+    assert v['NAME'] == 'data.t'
+    assert v['LAG_MINUTES'] == 1
+    assert not v['LAGGING']
+
+    fetch_task_history(monkeypatch, 0, 0, NOW - timedelta(hours=3))
+    v = task_metrics(dict(task, state='started'), NOW)
+    assert v['LAG_MINUTES'] == 180
+    assert v['LAGGING']
+
+    fetch_task_history(monkeypatch, 59, 1, NOW - timedelta(minutes=1))
+    assert task_metrics(dict(task, state='started'), NOW)['LAGGING']
+
+    # started tasks that never ran healthily lag, suspended ones don't
+    fetch_task_history(monkeypatch, 0, 0, None)
+    v = task_metrics(dict(task, state='started'), NOW)
+    assert v['LAG_MINUTES'] is None
+    assert v['LAGGING']
+    fetch_task_history(monkeypatch, 0, 3, None)
+    v = task_metrics(dict(task, state='suspended'), NOW)
+    assert v['LAG_MINUTES'] == 0
+    assert not v['LAGGING']
+
+
+def test_main_alerts_on_unmeasurable(monkeypatch):
+    inserted = []
+
+    def fetch(query):
+        if query.startswith('SHOW PIPES'):
+            return iter([{'schema_name': 'data', 'name': 'p', 'definition': ''}])
+        if query.startswith('SHOW TASKS'):
+            return iter([])
+        raise RuntimeError('insufficient privileges')
+
+    monkeypatch.setattr(pipe_monitor_runner.db, 'fetch', fetch)
+    monkeypatch.setattr(
+        pipe_monitor_runner.db, 'insert', lambda table, rows: inserted.extend(rows)
+    )
+
+    main()
+    (row,) = inserted
+    assert row['v']['NAME'] == 'data.p'
+    assert row['v']['ERROR'] == 'insufficient privileges'
+    assert row['v']['LAGGING']
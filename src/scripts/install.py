@@ -138,6 +138,12 @@ CREATE_TABLES_QUERIES = [
           , v VARIANT
           );
     """,
+    f"""
+      CREATE TABLE IF NOT EXISTS results.pipe_metadata(
+          event_time TIMESTAMP_LTZ
+          , v VARIANT
+          );
+    """,
 ]
 
 
@@ -285,6 +291,7 @@ def setup_schemas_and_tables(do_attempt, database):
     do_attempt("Creating alerts & violations tables", CREATE_TABLES_QUERIES)
     do_attempt("Creating standard UDTFs", read_queries('create-udtfs'))
     do_attempt("Creating standard data views", read_queries('data-views'))
+    do_attempt("Creating monitoring alerts", read_queries('monitoring-alert-queries'))
 
 
 def setup_user_and_role(do_attempt):